@@ -1,8 +1,6 @@
 #/bin/bash
 
-python process_packets.py
-
-python process_status_data.py
-python process_survey_data.py
-python generate_survey_quicklooks.py
-python process_burst_data.py
\ No newline at end of file
+# Run each processing stage once, in a single Python process.
+# (Or, instead of running this from cron, leave "python watch_daemon.py"
+# running, to process new telemetry as soon as it arrives.)
+python watch_daemon.py --once
@@ -5,12 +5,40 @@ import logging
 from scipy.io import loadmat
 import os
 import struct
-import csv
+import binascii
 import scipy.stats
 import itertools
 import psutil
+from concurrent.futures import ProcessPoolExecutor
+from packet_batch import PacketBatch
+from time_handlers import CCSDS_to_timestamp, GPS_week_to_timestamp, ISO_to_timestamp
 # global console_log
 
+# Packet indices and lengths (set in payload firmware)
+PACKET_SIZE = 512
+DATA_SEGMENT_LENGTH = PACKET_SIZE - 8
+PACKET_COUNT_INDEX = 1
+DATA_TYPE_INDEX = 5
+EXPERIMENT_INDEX = 6
+DATA_START_INDEX = 7
+DATA_END_INDEX = DATA_START_INDEX + DATA_SEGMENT_LENGTH
+CHECKSUM_INDEX = PACKET_SIZE - 2
+
+# Length of the AFRL CCSDS header preceding each packet in .TLM files
+CCSDS_HEADER_LEN = 26
+
+# Escape sequences within packets
+ESCAPED_7E = np.array([0x7D, 0x5E]) # [7D, 5E] -> 7E
+ESCAPED_7D = np.array([0x7D, 0x5D]) # [7D, 5D] -> 7D
+
+# Columns we need from the KSat-style CSV files, and the packet name of VPM payload data
+CSV_COLUMNS = [b'TARGET', b'PACKET', b'UTC_TIME', b'DYNAMIC_DATA']
+CSV_PAYLOAD_PACKET = b'PAYLOAD_INTERFACE_RECEIVE_RAW_PAYLOAD_DATA'
+
+# Novatel sync bytes + message IDs of the BESTPOS and BESTVEL logs
+BESTPOS_SYNC = np.array([0xAA, 0x44, 0x12, 0x1C, 0x2A])
+BESTVEL_SYNC = np.array([0xAA, 0x44, 0x12, 0x1C, 0x63])
+
 def decode_status(packets):
     '''
     Author:     Austin Sousa
@@ -21,7 +49,7 @@ def decode_status(packets):
         Locates any "status" packets, and prints a nicely-formatted string.
 
     inputs: 
-        packets: A list of "packet" dictionaries, as returned from decode_packets.py
+        packets: A PacketBatch (or list of "packet" dictionaries), as returned from decode_packets.py
     outputs:
         A list of dictionaries, containing all the keys + values from the status message.
         Use "print_status(list)" to print a nice string
@@ -33,7 +61,7 @@ def decode_status(packets):
     out_data = []
 
     # get status packets    
-    for p in filter(lambda packet: packet['dtype'] == 'I', packets):
+    for p in PacketBatch.from_packets(packets).by_dtype('I'):
         try:
             data = p['data'][:p['bytecount']]
 
@@ -41,7 +69,7 @@ def decode_status(packets):
             prev_command = np.array(np.flip(data[0:3]), dtype=np.uint8)
             prev_bbr_command = np.array(np.flip(data[4:7]), dtype=np.uint8)
             prev_burst_command = np.array(np.flip(data[12:15]), dtype=np.uint8)
-            total_commands = data[16] + 256*data[17]
+            total_commands = int(data[16]) + 256*int(data[17])
             
             system_config = np.flip(data[20:24])
 
@@ -341,20 +369,215 @@ def find_sequence(arr,seq):
     Find any instances of a sequence seq in 1d array arr.
     Returns an array of indexes corresponding to the first value in the sequence.
     '''
-    # Store sizes of input array and sequence
-    Na, Nseq = arr.size, seq.size
-    # Range of sequence
-    r_seq = np.arange(Nseq)
-    # Create a 2D array of sliding indices across the entire length of input array.
-    # Match up with the input sequence & get the matching starting indices.
-    M = (arr[np.arange(Na-Nseq+1)[:,None] + r_seq] == seq).all(1)
-    inds = np.where(M)[0]
-    return(inds)
-
-def decode_packets_TLM(data_root, fname):
+    return find_sequences(arr, [seq])[0]
+
+def find_sequences(arr, seqs):
+    '''
+    Find any instances of several sequences in 1d array arr, in a single pass.
+    Returns a list with one array of indexes per sequence in seqs, corresponding
+    to the first value in each sequence.
+
+    Candidate positions are found by matching the first value (once for all
+    sequences sharing it), then narrowed down one value at a time -- so the
+    work is linear in the length of arr, with no (len(arr) x len(seq)) temporaries.
+    '''
+    arr = np.asarray(arr)
+    seqs = [np.asarray(seq) for seq in seqs]
+    outs = [None]*len(seqs)
+
+    for first in np.unique([seq[0] for seq in seqs]):
+        candidates = np.flatnonzero(arr == first)
+
+        for ind, seq in enumerate(seqs):
+            if seq[0] != first:
+                continue
+            inds = candidates[candidates <= arr.size - seq.size]
+            for k in range(1, seq.size):
+                inds = inds[arr[inds + k] == seq[k]]
+            outs[ind] = inds
+
+    return outs
+
+def find_frame_starts(data, first=CCSDS_HEADER_LEN, last=None):
+    '''
+    Locates candidate packet frames in a raw byte buffer: a 0x7E start byte,
+    followed by the closing 0x7E exactly PACKET_SIZE - 1 bytes later.
+    Frames starting before "first" (too close to the start of the buffer to
+    have a CCSDS header) or at / after "last" are dropped.
+    '''
+    p_inds = np.flatnonzero(data == 0x7E)
+    p_start_inds = p_inds[:-1][np.diff(p_inds) == (PACKET_SIZE - 1)]
+    p_start_inds = p_start_inds[p_start_inds >= first]
+    if last is not None:
+        p_start_inds = p_start_inds[p_start_inds < last]
+    return p_start_inds
+
+def validate_frames(frames):
+    '''
+    Description:
+        Batch validation stage, run on all candidate frames before any of them are
+        decoded: calculates checksums, finds the escaped 7E/7D characters, and
+        reads the received checksum and bytecount fields from where they'll land
+        once the frame is un-escaped -- without un-escaping anything yet.
+    inputs:
+        frames:     2d uint8 array (num_frames x frame length) of raw, escaped
+                    frames, each starting and ending with 0x7E
+    outputs:
+        a dictionary of per-frame columns:
+        checksum_calc, checksum:        calculated (on the raw data) and received checksums
+        check_escaped, count_escaped:   1 if the checksum / bytecount field was escaped
+        escape_count:                   number of escaped characters in the frame
+        packet_length:                  length of each frame after un-escaping
+        bytecount:                      the bytecount field
+        valid:                          mask of frames which passed their checksum
+        keep, escaped_7E:               (num_frames x frame length) masks of the raw bytes
+                                        kept when un-escaping, and of the bytes which
+                                        start an escaped 7E (for decode_frames)
+        counts:                         totals for the whole set of frames (see frame_counts)
+    '''
+    num_frames, width = frames.shape
+
+    # Check if the bytecount or checksum fields were escaped
+    check_escaped = (frames[:, PACKET_SIZE - 2] != 0).astype(int)
+    count_escaped = (frames[:, PACKET_SIZE - 4] != 0).astype(int)
+
+    # Calculate the checksum (on the raw data):
+    checksum_calc = frames[:, 2:CHECKSUM_INDEX - 1].sum(axis=1, dtype=np.int64) % 256
+
+    # Escapes: [7D, 5E] -> 7E, [7D, 5D] -> 7D. The second byte of each pair is dropped.
+    # (An escaped 7E can't start a [7D, 5D] pair, so both can be found in the raw frame.)
+    esc1_inds, esc2_inds = find_sequences(frames.ravel(), [ESCAPED_7E, ESCAPED_7D])
+    esc1_inds = esc1_inds[esc1_inds % width != width - 1]
+    esc2_inds = esc2_inds[esc2_inds % width != width - 1]
+
+    escaped_7E = np.zeros(frames.shape, dtype=bool)
+    escaped_7E.ravel()[esc1_inds] = True
+    keep = np.ones(frames.shape, dtype=bool)
+    keep.ravel()[esc1_inds + 1] = False
+    keep.ravel()[esc2_inds + 1] = False
+
+    packet_length = keep.sum(axis=1)
+
+    # The un-escaped byte at index u comes from the raw byte with u kept bytes before it
+    kept_through = np.cumsum(keep, axis=1, dtype=np.int32)
+    rows = np.arange(num_frames)
+    def unescaped_byte(u):
+        raw_ind = np.sum(kept_through <= u[:, None], axis=1)
+        return np.where(escaped_7E[rows, raw_ind], 0x7E, frames[rows, raw_ind]).astype(np.int64)
+
+    # Get the (un-escaped) indices of the checksum and bytecount fields
+    checksum_index = packet_length + check_escaped - 3
+    bytecount_index = packet_length + check_escaped + count_escaped - 6
+
+    out = dict()
+    out['checksum_calc'] = checksum_calc
+    out['checksum'] = unescaped_byte(checksum_index)
+    out['check_escaped'] = check_escaped
+    out['count_escaped'] = count_escaped
+    out['escape_count'] = width - packet_length
+    out['packet_length'] = packet_length
+    out['bytecount'] = unescaped_byte(bytecount_index)*256 + unescaped_byte(bytecount_index + 1)
+    out['valid'] = out['checksum'] == checksum_calc
+    out['keep'] = keep
+    out['escaped_7E'] = escaped_7E
+    out['counts'] = frame_counts(out)
+    return out
+
+def frame_counts(validated):
+    ''' Totals for a set of validated frames, for the per-file decoding counters '''
+    counts = dict()
+    counts['frames'] = len(validated['valid'])
+    counts['checksum_failures'] = int(np.sum(~validated['valid']))
+    counts['escapes'] = int(np.sum(validated['escape_count']))
+    counts['escaped_checksums'] = int(np.sum(validated['check_escaped']))
+    counts['escaped_bytecounts'] = int(np.sum(validated['count_escaped']))
+    return counts
+
+def add_counts(total, counts):
+    ''' Adds a dictionary of decoding counters into another (if there is one) '''
+    if total is not None:
+        for k, v in counts.items():
+            total[k] = total.get(k, 0) + v
+    return total
+
+def decode_frames(frames, validated=None):
+    '''
+    Description:
+        Whole-array version of the per-packet decoding loop: un-escapes 7E/7D
+        characters and decodes the VPM header fields for a stack of raw frames
+        at once. Only the frames marked valid by validate_frames are decoded.
+    inputs:
+        frames:     2d uint8 array (num_frames x frame length) of raw, escaped
+                    frames, each starting and ending with 0x7E
+        validated:  the output of validate_frames(frames), if already computed
+    outputs:
+        a dictionary of columns, one entry per valid frame:
+        buffer:             the un-escaped frames, packed end-to-end into one uint8 array
+        offsets:            start index of each frame within buffer
+        packet_length:      length of each frame after un-escaping
+        start_ind, dtype, exp_num, bytecount: VPM header fields
+        checksum, checksum_calc: received and calculated checksums
+    '''
+    if validated is None:
+        validated = validate_frames(frames)
+    valid = validated['valid']
+
+    # Un-escape, and pack the remaining bytes end-to-end into a single buffer
+    unescaped = np.where(validated['escaped_7E'][valid], np.uint8(0x7E), frames[valid])
+    buffer = unescaped[validated['keep'][valid]]
+    packet_length = validated['packet_length'][valid]
+    offsets = np.cumsum(packet_length) - packet_length
+
+    # Decode metadata fields
+    start_ind = np.zeros(len(offsets), dtype=np.int64)
+    for k in range(4):
+        start_ind = start_ind*256 + buffer[offsets + PACKET_COUNT_INDEX + k]
+
+    out = dict()
+    out['buffer'] = buffer
+    out['offsets'] = offsets
+    out['packet_length'] = packet_length
+    out['start_ind'] = start_ind
+    out['dtype'] = buffer[offsets + DATA_TYPE_INDEX]
+    out['exp_num'] = buffer[offsets + EXPERIMENT_INDEX]
+    out['bytecount'] = validated['bytecount'][valid]
+    out['checksum'] = validated['checksum'][valid]
+    out['checksum_calc'] = validated['checksum_calc'][valid]
+    return out
+
+def decode_CCSDS_headers(headers):
+    ''' Decodes the fields of the AFRL CCSDS header from a (num_frames x CCSDS_HEADER_LEN) array '''
+
+    def field(a, b, fmt):
+        return np.ascontiguousarray(headers[:, a:b]).view(fmt).ravel().astype(np.int64)
+
+    out = dict()
+    out['C_packet_length'] = field(0, 4, '>u4')
+    out['C_component_ID'] = headers[:, 5]
+    out['C_interface_ID'] = headers[:, 6]
+    out['C_message_ID'] = headers[:, 7]
+    out['header_epoch_sec'] = field(8, 12, '>u4')
+    out['header_ns'] = field(12, 16, '>u4')
+    out['header_reboots'] = field(16, 18, '>u2')
+    return out
+
+def decode_packets_TLM(data_root, fname, counts=None):
     '''
     Author:     Austin Sousa
                 austin.sousa@colorado.edu
+    Version:    1.3
+        Date:   10.18.2026
+        - Validates every candidate frame (checksums, escapes) before decoding any,
+          and only decodes the valid ones. Per-file counters are added into the
+          optional dictionary "counts".
+    Version:    1.2
+        Date:   10.18.2026
+        - Returns a PacketBatch (columns + a single payload buffer), rather
+          than a list of dictionaries
+    Version:    1.1
+        Date:   10.18.2026
+        - Frames, checksums and un-escapes all packets at once, as whole-array
+          operations, rather than looping over packets
     Version:    1.0
         Date:   10.10.2019
     Description:
@@ -363,9 +586,11 @@ def decode_packets_TLM(data_root, fname):
     inputs: 
         data_root:          Root directory of the data file
         fname:              file name to load. Should end with .TLM
+        counts:             (optional) dictionary to add the decoding counters into
+                            (frames, checksum_failures, escapes, escaped_checksums, escaped_bytecounts)
     outputs:
-        a list of decoded packets:
-        Each packet is a dictionary with the following fields:
+        a PacketBatch of decoded packets. Iterating over it gives one
+        dictionary per packet, with the following fields:
         packet_data:        2d array of packet data (num_packets x data_segment_length)
         packet_start_index: Start index of the current data segment
         datatype:           Channel label. (Ascii 'S','E','B','L','G','I')
@@ -384,119 +609,222 @@ def decode_packets_TLM(data_root, fname):
     with open(fpath,'rb') as f:
         data = np.fromfile(f,dtype='uint8')
 
-    # Packet indices and lengths (set in payload firmware)
-    PACKET_SIZE = 512
-    DATA_SEGMENT_LENGTH = PACKET_SIZE - 8
-    PACKET_COUNT_INDEX = 1
-    DATA_TYPE_INDEX = 5
-    EXPERIMENT_INDEX = 6
-    DATA_START_INDEX = 7
-    DATA_END_INDEX = DATA_START_INDEX + DATA_SEGMENT_LENGTH
-    CHECKSUM_INDEX = PACKET_SIZE - 2
+    packets, cur_counts = decode_TLM_buffer(data, fname)
+    add_counts(counts, cur_counts)
 
-    CCSDS_HEADER_LEN = 26
+    if cur_counts['checksum_failures'] > 0:
+        logger.warning(f"--------------- {cur_counts['checksum_failures']} failed checksums ---------------")
 
-    leap_seconds = 18  # GPS time does not account for leap seconds; as of ~2019, GPS leads UTC by 18 seconds.
-    reference_date = datetime.datetime(1980,1,6,0,0, tzinfo=datetime.timezone.utc) - datetime.timedelta(seconds=leap_seconds)
+    logger.info(f"decoded {len(packets)} packets ({cur_counts['frames']} frames, {cur_counts['escapes']} escaped characters)")
 
+    return packets
 
-    # Find all packet start indices
-    p_inds_pre_escape = np.array(sorted(np.where(data==0x7E)))
-    p_length_pre_escape = np.diff(p_inds_pre_escape)
+def iter_packets_TLM(data_root, fname, chunk_size=32*1024*1024, start_offset=0, counts=None, data=None):
+    '''
+    Streaming version of decode_packets_TLM, for very large files.
+    The file is memory-mapped one window at a time, and decoded packets are
+    yielded in batches (one PacketBatch per chunk_size bytes),
+    so memory use doesn't grow with the size of the file.
+
+    Each window overlaps the previous one by a packet length plus the CCSDS
+    header, so packets straddling a chunk boundary are decoded in full.
+
+    Yields (packets, next_offset) tuples. next_offset is the file position up to
+    which all packet starts have been checked; pass it back in as start_offset
+    to pick up where we left off, once more data has been appended to the file.
+    The decoding counters for each chunk are added into the optional dictionary
+    "counts" as it goes (see decode_packets_TLM).
+
+    If the file has already been read into memory (e.g., by file_handlers.prefetch),
+    pass its contents as data, and it's decoded from there instead.
+    '''
+    logger = logging.getLogger(__name__ + '.iter_packets_TLM')
+
+    logger.info(f'Streaming file {fname} from byte {start_offset}')
+    fpath = os.path.join(data_root, fname)
+    if data is not None:
+        data = np.frombuffer(data, dtype='uint8')
+        file_size = len(data)
+    else:
+        file_size = os.path.getsize(fpath)
+
+    # Packets can start anywhere in [first, last_start]: they need a CCSDS header
+    # before them, and a complete frame after.
+    first = max(CCSDS_HEADER_LEN, start_offset)
+    last_start = file_size - PACKET_SIZE
+    total_packets = 0
+    file_counts = dict()
+
+    while first <= last_start:
+        last = min(first + chunk_size, last_start + 1)
+        window_start = first - CCSDS_HEADER_LEN
+        window_end = last + PACKET_SIZE - 1
+        if data is not None:
+            window = data[window_start:window_end]
+        else:
+            window = np.memmap(fpath, dtype='uint8', mode='r', offset=window_start,
+                               shape=(window_end - window_start,))
+
+        packets, cur_counts = decode_TLM_buffer(window, fname,
+                                                first=CCSDS_HEADER_LEN, last=last - window_start)
+        del window
+
+        total_packets += len(packets)
+        add_counts(file_counts, cur_counts)
+        add_counts(counts, cur_counts)
+        first = last
+
+        yield packets, first
+
+    if file_counts.get('checksum_failures', 0) > 0:
+        logger.warning(f"--------------- {file_counts['checksum_failures']} failed checksums ---------------")
+
+    logger.info(f"decoded {total_packets} packets ({file_counts.get('frames', 0)} frames, {file_counts.get('escapes', 0)} escaped characters)")
+
+def iter_packets_TLM_stream(f, fname, chunk_size=32*1024*1024, counts=None):
+    '''
+    Version of iter_packets_TLM for files which can only be read from start to
+    finish (e.g., while they're being decompressed): reads chunk_size bytes at a
+    time from the file object f, and holds back the tail of each chunk for the
+    next one, so packets straddling a chunk boundary are decoded in full.
+
+    Yields (packets, offset) tuples; offset is the (uncompressed) stream position
+    up to which all packet starts have been checked.
+    '''
+    logger = logging.getLogger(__name__ + '.iter_packets_TLM_stream')
+
+    logger.info(f'Streaming file {fname}')
+    total_packets = 0
+    file_counts = dict()
+
+    # The unused end of the previous chunk, and its position in the stream
+    carry = np.zeros(0, dtype=np.uint8)
+    carry_start = 0
+
+    while True:
+        block = f.read(chunk_size)
+        data = np.concatenate([carry, np.frombuffer(block, dtype=np.uint8)])
+
+        # Packets need a complete frame after them (unless this is the end of the file),
+        # and a CCSDS header before
+        last = len(data) - PACKET_SIZE + 1 if block else len(data)
+        if last > CCSDS_HEADER_LEN:
+            packets, cur_counts = decode_TLM_buffer(data, fname, first=CCSDS_HEADER_LEN, last=last)
+            total_packets += len(packets)
+            add_counts(file_counts, cur_counts)
+            add_counts(counts, cur_counts)
+
+            yield packets, carry_start + last
+
+            carry = data[last - CCSDS_HEADER_LEN:]
+            carry_start += last - CCSDS_HEADER_LEN
+        else:
+            carry = data
+
+        if not block:
+            break
+
+    if file_counts.get('checksum_failures', 0) > 0:
+        logger.warning(f"--------------- {file_counts['checksum_failures']} failed checksums ---------------")
+
+    logger.info(f"decoded {total_packets} packets ({file_counts.get('frames', 0)} frames, {file_counts.get('escapes', 0)} escaped characters)")
+
+def TLM_header_times(data):
+    '''
+    The header timestamps of the packets in a raw .TLM byte buffer (e.g., the first
+    few kB of a file), from their CCSDS headers alone: nothing is validated or decoded.
+    '''
+    data = np.frombuffer(data, dtype=np.uint8)
+    p_start_inds = find_frame_starts(data, last=len(data) - PACKET_SIZE + 1)
+    if not len(p_start_inds):
+        return np.zeros(0)
+    header = decode_CCSDS_headers(data[p_start_inds[:, None] + np.arange(-CCSDS_HEADER_LEN, 0)])
+    return CCSDS_to_timestamp(header['header_epoch_sec'], header['header_ns'])
+
+def decode_TLM_buffer(data, fname, first=CCSDS_HEADER_LEN, last=None):
+    '''
+    Decodes any packets starting within data[first:last], from a raw .TLM byte buffer.
+    Every candidate frame is validated (see validate_frames) before any are decoded;
+    frames which fail their checksum are dropped.
+    Returns a PacketBatch of the decoded packets (see decode_packets_TLM), and a
+    dictionary of counts (frames, checksum_failures, escapes, escaped_checksums,
+    escaped_bytecounts).
+    '''
+    logger = logging.getLogger(__name__ + '.decode_TLM_buffer')
 
     # Select only the valid packet start indices
-    p_start_inds = p_inds_pre_escape[np.where(p_length_pre_escape == (PACKET_SIZE - 1))]
+    p_start_inds = find_frame_starts(data, first=first, last=last)
     logger.info(f"found {len(p_start_inds)} valid packets")
-    # Escape characters, and move packets into a list (since their length now varies)
-    packets = [];
-    checksum_failure_counter = 0
 
-    # for k in np.arange(-6, 20):
-    for x, pind in enumerate(p_start_inds):
-        try:
-            cur_packet = np.copy(data[pind:pind+PACKET_SIZE].astype('uint8'))
-            # cur_packet   = data[pind:pind+PACKET_SIZE]
-            ccsds_header = np.copy(data[pind-CCSDS_HEADER_LEN:pind]).astype('uint8')
-            # print(['{0:X}'.format(x) for x in data[pind:pind + EXPERIMENT_INDEX + 3]])
-
-            # grab data from the CTCSS header
-            C_packet_length = struct.unpack('>I', ccsds_header[0:4].tobytes())[0] # 534
-            C_component_ID  = struct.unpack('>B', ccsds_header[5:6].tobytes())[0] # 34
-            C_interface_ID  = struct.unpack('>B', ccsds_header[6:7].tobytes())[0] # 1
-            C_message_ID    = struct.unpack('>B', ccsds_header[7:8].tobytes())[0] # 2
-            C_epoch_seconds = struct.unpack('>I', ccsds_header[8:12].tobytes())[0]
-            C_nanoseconds   = struct.unpack('>I', ccsds_header[12:16].tobytes())[0]
-            C_reboot_count  = struct.unpack('>H', ccsds_header[16:18].tobytes())[0]
-
-
-            # Check if the bytecount or checksum fields were escaped
-            check_escaped = (cur_packet[PACKET_SIZE - 2]!=0)*1
-            count_escaped = (cur_packet[PACKET_SIZE - 4]!=0)*1
-
-            # Calculate the checksum (on the unescaped data):
-            checksum_calc = sum(cur_packet[2:CHECKSUM_INDEX - 1])%256
-
-            # Un-escape the packet (Destructive)
-            esc1_inds = find_sequence(cur_packet,np.array([0x7D, 0x5E])) # [7D, 5E] -> 7E
-            cur_packet[esc1_inds] =  0x7E
-            cur_packet = np.delete(cur_packet, esc1_inds + 1) 
-            esc2_inds = find_sequence(cur_packet,np.array([0x7D, 0x5D])) # [7D, 5D] -> 7D
-            cur_packet = np.delete(cur_packet, esc2_inds + 1)
-
-
-            # Get the new indices of the checksum and bytecount fields
-            packet_length_post_escape = len(cur_packet)
-            checksum_index = packet_length_post_escape + check_escaped - 3
-            bytecount_index= packet_length_post_escape + check_escaped + count_escaped - 6
-     
-            # Decode metadata fields
-            packet_start_index = struct.unpack('>L',cur_packet[PACKET_COUNT_INDEX:(PACKET_COUNT_INDEX + 4)])[0]
-
-            datatype = chr(cur_packet[DATA_TYPE_INDEX]) # works!
-            experiment_number = cur_packet[EXPERIMENT_INDEX]
-            # print(experiment_number)
-            # bytecount = 256*cur_packet[bytecount_index] + cur_packet[bytecount_index + 1]
-            bytecount = struct.unpack('>H', cur_packet[bytecount_index:(bytecount_index + 2)])[0]
-
-            checksum = cur_packet[checksum_index]
-
-            if (checksum - checksum_calc) != 0:
-                checksum_failure_counter += 1
-                logger.warning('invalid checksum at packet # %d -- skipping'%x)
-                continue
-            # Pack the decoded packet into a dictionary, and add it to the list
-            # (maybe there's a nicer data structure for this - but this is probably the most general case)
-            p = dict()
-            p['data'] = np.array(cur_packet[DATA_START_INDEX:(bytecount + DATA_START_INDEX)], dtype='uint8').tolist()
-            p['start_ind'] = packet_start_index
-            p['dtype'] = datatype
-            p['exp_num'] = experiment_number
-            p['bytecount'] = bytecount
-            p['checksum_verify'] = (checksum - checksum_calc)==0
-            p['packet_length'] = packet_length_post_escape
-            p['fname'] = fname
-            p['header_ns'] = C_nanoseconds
-            p['header_epoch_sec'] = C_epoch_seconds
-            p['header_reboots'] = C_reboot_count
-            p['header_timestamp'] = (reference_date + datetime.timedelta(seconds=C_epoch_seconds + C_nanoseconds*1e-9)).timestamp()
-                
-            packets.append(p)
+    # Cut out every frame, and the CCSDS header preceding it
+    frames = data[p_start_inds[:, None] + np.arange(PACKET_SIZE)]
+    ccsds_headers = data[p_start_inds[:, None] + np.arange(-CCSDS_HEADER_LEN, 0)]
 
+    validated = validate_frames(frames)
+    valid = validated['valid']
+    for x in np.flatnonzero(~valid):
+        logger.warning('invalid checksum at packet # %d -- skipping'%x)
 
-        except:
-            logger.warning('exception at packet # %d',x)
-        
-    if checksum_failure_counter > 0:
-        logger.warning(f'--------------- {checksum_failure_counter} failed checksums ---------------')
+    decoded = decode_frames(frames, validated)
+    header = decode_CCSDS_headers(ccsds_headers[valid])
+    header_timestamps = CCSDS_to_timestamp(header['header_epoch_sec'], header['header_ns'])
 
-    logger.info(f'decoded {len(packets)} packets')
+    packets = frames_to_batch(decoded, fname,
+                              header_ns=header['header_ns'],
+                              header_epoch_sec=header['header_epoch_sec'],
+                              header_reboots=header['header_reboots'],
+                              header_timestamp=header_timestamps)
 
-    return packets
+    return packets, validated['counts']
 
-def decode_packets_CSV(data_root, filename):
+def frames_to_batch(decoded, fname, **extra_columns):
+    '''
+    Packs the output of decode_frames into a PacketBatch, with any extra per-frame
+    columns (e.g., header timestamps). The payloads stay in the un-escaped buffer.
+    '''
+    data_start = decoded['offsets'] + DATA_START_INDEX
+    data_end = decoded['offsets'] + np.minimum(decoded['bytecount'] + DATA_START_INDEX, decoded['packet_length'])
+
+    num_frames = len(decoded['offsets'])
+    columns = dict()
+    columns['start_ind'] = decoded['start_ind']
+    columns['dtype'] = decoded['dtype'].astype(np.uint32).view('U1')
+    columns['exp_num'] = decoded['exp_num']
+    columns['bytecount'] = decoded['bytecount']
+    columns['checksum_verify'] = np.ones(num_frames, dtype=bool)
+    columns['packet_length'] = decoded['packet_length']
+    columns['fname'] = np.full(num_frames, fname, dtype=object)
+    for k, v in extra_columns.items():
+        columns[k] = np.asarray(v)
+
+    return PacketBatch(decoded['buffer'], data_start, data_end - data_start, columns)
+
+def decode_packets_CSV(data_root, filename, chunk_size=16*1024*1024, workers=1,
+                       min_range_size=4*1024*1024, counts=None):
     '''
     Author:     Austin Sousa
                 austin.sousa@colorado.edu
+    Version:    1.5
+        Date:   10.18.2026
+        - Validates every frame (checksums, escapes) before decoding any, and only
+          decodes the valid ones. Per-file counters (rows, frames, checksum_failures,
+          escapes, escaped_checksums, escaped_bytecounts, exceptions) are added into
+          the optional dictionary "counts".
+    Version:    1.4
+        Date:   10.18.2026
+        - Optional parallel decoding: with workers > 1, large files are split into
+          byte ranges on line boundaries (at least min_range_size bytes each),
+          decoded in separate processes, and merged back in file order.
+          file_index still counts rows from the top of the file.
+    Version:    1.3
+        Date:   10.18.2026
+        - Reads the file once, in chunks: the header row and delimiter are found
+          from the first few kB, only the TARGET, PACKET, UTC_TIME and DYNAMIC_DATA
+          columns are kept, the hex payloads are decoded in bulk, and the frames
+          are decoded with the same whole-array framer as the .TLM files
+    Version:    1.2
+        Date:   10.18.2026
+        - Returns a PacketBatch, rather than a list of dictionaries
     Version:    1.1
         Date    6.12.2020
         - Modified to detect delimiter and to be more robust against header row weirdness
@@ -510,135 +838,277 @@ def decode_packets_CSV(data_root, filename):
     logger = logging.getLogger('decode_packets_CSV')
 
     fpath = os.path.join(data_root, filename)
-    
-    with open(fpath) as csvfile:
-        # cur = csvfile.read().split('\n')
-        cur = csvfile.readlines()
-
-    # Find the header row
-    for header_index, line in enumerate(cur):
-        if 'TARGET' in line:
-            header_line = line
-            break
-    logger.debug(f'Header index: {header_index}')            
+    header = scan_CSV_header(fpath)
+    file_size = os.path.getsize(fpath)
+
+    num_ranges = min(workers, int(np.ceil((file_size - header['data_start'])/min_range_size)))
+    if num_ranges > 1:
+        ranges = split_CSV_ranges(fpath, header['data_start'], file_size, num_ranges)
+        logger.info(f'decoding {len(ranges)} byte ranges with {workers} workers')
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(decode_CSV_range, fpath, filename, header, a, b, chunk_size=chunk_size)
+                       for a, b in ranges]
+            results = [f.result() for f in futures]
+
+        # Each range counts rows from zero; shift them by the rows in the ranges before
+        batches = []
+        file_counts = dict(rows=0)
+        for cur_packets, cur_counts in results:
+            cur_packets.columns['file_index'] = cur_packets['file_index'] + file_counts['rows']
+            batches.append(cur_packets)
+            add_counts(file_counts, cur_counts)
+        packets = PacketBatch.concatenate(batches)
+    else:
+        packets, file_counts = decode_CSV_range(fpath, filename, header, header['data_start'],
+                                                file_size, chunk_size=chunk_size)
+    add_counts(counts, file_counts)
 
-    # Detect the delimeter -- either comma or tab so far
-    delimeters = [',',' ','\t']
-    for delimeter in delimeters:
+    logger.info(f"decoded {len(packets)} packets ({file_counts.get('checksum_failures', 0)} failed checksums, {file_counts.get('exceptions', 0)} exceptions)")
 
-        counts = header_line.count(delimeter)
-        logger.debug(f'Delimter: " {delimeter}" counts: {counts}')
+    return packets
 
-        # header_string = str(header_line).split()
-        
-        if counts>3:
-            logger.info(f'using delimeter "{delimeter}"')
-            header_string = header_line.split(delimeter)
-            logger.debug(f'Header string: {header_string}')
+def decode_packets_CSV_stream(f, fname, chunk_size=16*1024*1024, counts=None):
+    '''
+    Version of decode_packets_CSV for files which can only be read from start to
+    finish (e.g., while they're being decompressed): reads the file object f
+    once, chunk_size bytes at a time. Returns a PacketBatch.
+    '''
+    logger = logging.getLogger('decode_packets_CSV_stream')
+
+    header, head = read_CSV_header(f, fname)
+    packets, file_counts = decode_CSV_stream(f, fname, header, first_index=0, chunk_size=chunk_size,
+                                             carry=head[header['data_start']:])
+    add_counts(counts, file_counts)
+
+    logger.info(f"decoded {len(packets)} packets ({file_counts.get('checksum_failures', 0)} failed checksums, {file_counts.get('exceptions', 0)} exceptions)")
+
+    return packets
+
+def scan_CSV_header(fpath, sniff_size=64*1024):
+    '''
+    Locates the header row of a CSV file (the first line containing "TARGET"),
+    and detects the delimiter -- either comma, space or tab so far.
+    Only reads as far into the file as it needs to.
+
+    Returns a dictionary with:
+        data_start: byte offset of the first line after the header
+        delimiter:  the delimiter, as bytes
+        columns:    indices of the TARGET, PACKET, UTC_TIME and DYNAMIC_DATA columns
+    '''
+    with open(fpath, 'rb') as f:
+        return read_CSV_header(f, fpath, sniff_size)[0]
+
+def read_CSV_header(f, name, sniff_size=64*1024):
+    '''
+    scan_CSV_header, for an open file object f (read from its current position).
+    Returns the header dictionary, and the bytes read from f so far.
+    '''
+    logger = logging.getLogger('scan_CSV_header')
+
+    head = b''
+    while True:
+        block = f.read(sniff_size)
+        head += block
+        ind = head.find(b'TARGET')
+        # Wait until we have the whole header line
+        if ind >= 0 and (head.find(b'\n', ind) >= 0 or not block):
             break
-    
+        if not block:
+            raise ValueError(f'No header row found in {name}')
+
+    line_start = head.rfind(b'\n', 0, ind) + 1
+    line_end = head.find(b'\n', ind)
+    line_end = len(head) if line_end < 0 else line_end
+    header_line = head[line_start:line_end].rstrip(b'\r')
+    logger.debug(f'Header line: {header_line}')
+
+    # Detect the delimeter
+    for delimiter in [b',', b' ', b'\t']:
+        counts = header_line.count(delimiter)
+        logger.debug(f'Delimter: " {delimiter}" counts: {counts}')
+        if counts > 3:
+            break
+    logger.info(f'using delimeter "{delimiter.decode()}"')
 
-    # Packet indices and lengths (set in payload firmware)
-    PACKET_SIZE = 512
-    DATA_SEGMENT_LENGTH = PACKET_SIZE - 8
-    PACKET_COUNT_INDEX = 1
-    DATA_TYPE_INDEX = 5
-    EXPERIMENT_INDEX = 6
-    DATA_START_INDEX = 7
-    DATA_END_INDEX = DATA_START_INDEX + DATA_SEGMENT_LENGTH
-    CHECKSUM_INDEX = PACKET_SIZE - 2
-
-    packets = [];
-    checksum_failure_counter = 0
-    exception_counter = 0
-
-    with open(fpath) as csvfile:
-        # Skip up to the header row:
-        for i in range(header_index):
-            csvfile.readline()
-        
-        # Read the remaining entries into dicts
-        reader = csv.DictReader(csvfile, delimiter=delimeter)
-        
-        # Parse the entry list, grab data and timestamp
-        timestamps = []
-        raw_data = []
-        for ind, row in enumerate(reader):
-            try:
-                if ('VPM' in row['TARGET']) and row['PACKET'] == 'PAYLOAD_INTERFACE_RECEIVE_RAW_PAYLOAD_DATA':
-                    # timestamps.append(row['UTC_TIME'])
-                    # raw_data.append(bytes.fromhex(row['DYNAMIC_DATA']))
-                    timestamp = row['UTC_TIME']
-                    p_data = bytes.fromhex(row['DYNAMIC_DATA'])
-                    
-                    # if ind%100==0:
-                    #     logger.debug(f'ind: {ind}, mem: {psutil.virtual_memory()}')
+    names = [x.strip().strip(b'"') for x in header_line.split(delimiter)]
+    columns = []
+    for column in CSV_COLUMNS:
+        if column not in names:
+            raise ValueError(f'No {column.decode()} column in {name}')
+        # (Repeated names: like csv.DictReader, use the last one)
+        columns.append(len(names) - 1 - names[::-1].index(column))
 
-                    # Decode the current packet
-                    try:
-                        cur_packet = np.array([int(x) for x in p_data], dtype='uint8')
-                        p_inds = np.array(sorted(np.where(cur_packet==0x7E)))
-                        cur_packet = np.copy(cur_packet[p_inds[0][0]:(p_inds[0][1] + 1)])
-
-                        # Check if the bytecount or checksum fields were escaped
-                        check_escaped = (cur_packet[PACKET_SIZE - 2]!=0)*1
-                        count_escaped = (cur_packet[PACKET_SIZE - 4]!=0)*1
-
-                        # Calculate the checksum (on the unescaped data):
-                        checksum_calc = sum(cur_packet[2:CHECKSUM_INDEX - 1])%256
-
-                        # Un-escape the packet (Destructive)
-                        esc1_inds = find_sequence(cur_packet,np.array([0x7D, 0x5E])) # [7D, 5E] -> 7E
-                        cur_packet[esc1_inds] =  0x7E
-                        cur_packet = np.delete(cur_packet, esc1_inds + 1) 
-                        esc2_inds = find_sequence(cur_packet,np.array([0x7D, 0x5D])) # [7D, 5D] -> 7D
-                        cur_packet = np.delete(cur_packet, esc2_inds + 1)
-
-
-                        # Get the new indices of the checksum and bytecount fields
-                        packet_length_post_escape = len(cur_packet)
-                        checksum_index = packet_length_post_escape + check_escaped - 3
-                        bytecount_index= packet_length_post_escape + check_escaped + count_escaped - 6
-
-                        # Decode metadata fields
-                        packet_start_index = struct.unpack('>L',cur_packet[PACKET_COUNT_INDEX:(PACKET_COUNT_INDEX + 4)])[0]
-
-                        datatype = chr(cur_packet[DATA_TYPE_INDEX]) # works!
-                        experiment_number = cur_packet[EXPERIMENT_INDEX]
-                        bytecount = struct.unpack('>H', cur_packet[bytecount_index:(bytecount_index + 2)])[0]
-                        checksum = cur_packet[checksum_index]
-
-                        if (checksum - checksum_calc) != 0:
-                            checksum_failure_counter += 1
-                            logger.warning('invalid checksum at packet # %d -- skipping'%ind)
-                            continue
-
-                        # Pack the decoded packet into a dictionary, and add it to the list
-                        # (maybe there's a nicer data structure for this - but this is probably the most general case)
-                        p = dict()
-                        p['data'] = np.array(cur_packet[DATA_START_INDEX:(bytecount + DATA_START_INDEX)], dtype='uint8').tolist()
-                        p['start_ind'] = packet_start_index
-                        p['dtype'] = datatype
-                        p['exp_num'] = experiment_number
-                        p['bytecount'] = bytecount
-                        p['checksum_verify'] = (checksum - checksum_calc)==0
-                        p['packet_length'] = packet_length_post_escape
-                        p['fname'] = filename
-                        p['header_timestamp'] = datetime.datetime.fromisoformat(timestamp[0:-1]).replace(tzinfo=datetime.timezone.utc).timestamp()
-                        p['file_index'] = ind # Order of arrival in file 
-                        packets.append(p)
-                    except:
-                        exception_counter += 1
-                        logger.warning('exception at packet # %d',ind)
-            except:
-                logger.info(f'skipped CSV line {ind}: {row}')
-        
-    # if checksum_failure_counter > 0:
-        # logger.warning(f'--------------- {checksum_failure_counter} failed checksums ---------------')
+    out = dict()
+    out['data_start'] = line_end + 1
+    out['delimiter'] = delimiter
+    out['columns'] = columns
+    return out, head
 
-    logger.info(f'decoded {len(packets)} packets ({checksum_failure_counter} failed checksums, {exception_counter} exceptions)')
+def split_CSV_ranges(fpath, start, stop, num_ranges):
+    '''
+    Splits bytes [start, stop) of a file into (up to) num_ranges byte ranges of
+    about the same size, each ending on a line boundary.
+    Returns a list of (start, stop) tuples.
+    '''
+    bounds = [start]
+    with open(fpath, 'rb') as f:
+        for k in range(1, num_ranges):
+            # Move each target position forward to the start of the next line
+            f.seek(start + (stop - start)*k//num_ranges - 1)
+            f.readline()
+            if bounds[-1] < f.tell() < stop:
+                bounds.append(f.tell())
+    bounds.append(stop)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def decode_CSV_range(fpath, fname, header, start, stop, first_index=0, chunk_size=16*1024*1024):
+    '''
+    Decodes the packets in bytes [start, stop) of a CSV file, reading chunk_size
+    bytes at a time. start and stop should fall on line boundaries.
+    header is the output of scan_CSV_header; first_index is the row number
+    (file_index) of the first line in the range.
 
-    return packets
+    Returns a PacketBatch, and a dictionary of counts (see decode_CSV_lines).
+    '''
+    with open(fpath, 'rb') as f:
+        f.seek(start)
+        return decode_CSV_stream(f, fname, header, stop - start, first_index, chunk_size)
+
+def decode_CSV_stream(f, fname, header, size=None, first_index=0, chunk_size=16*1024*1024, carry=b''):
+    '''
+    Decodes the packets in the next "size" bytes of the file object f (or up to the
+    end of the file, if size is None), reading chunk_size bytes at a time.
+    carry is any data already read from f, to go in front.
+
+    Returns a PacketBatch, and a dictionary of counts (see decode_CSV_lines).
+    '''
+    batches = []
+    counts = dict(rows=0)
+
+    pos = 0
+    done = False
+    while not done:
+        block = f.read(chunk_size if size is None else min(chunk_size, size - pos))
+        pos += len(block)
+        done = not block or (size is not None and pos >= size)
+        block = carry + block
+
+        # Hold back any partial line for the next chunk
+        if not done:
+            cut = block.rfind(b'\n') + 1
+            block, carry = block[:cut], block[cut:]
+
+        if block:
+            packets, cur_counts = decode_CSV_lines(block, header, fname, first_index + counts['rows'])
+            batches.append(packets)
+            add_counts(counts, cur_counts)
+
+    return PacketBatch.concatenate(batches), counts
+
+def decode_CSV_lines(text, header, fname, first_index=0):
+    '''
+    Decodes the packets in a block of complete lines from a CSV file (as bytes).
+    Blank lines are skipped, and don't count towards the row numbers (file_index).
+    Returns a PacketBatch, and a dictionary of counts (rows, frames, checksum_failures,
+    escapes, escaped_checksums, escaped_bytecounts, exceptions).
+    '''
+    logger = logging.getLogger('decode_CSV_lines')
+
+    lines = [line for line in text.splitlines() if line]
+    target_col, packet_col, time_col, data_col = header['columns']
+    min_fields = max(header['columns']) + 1
+
+    # Keep only the payload packets, and the columns we need
+    hex_data = []
+    timestamps = []
+    row_inds = []
+    for ind, line in enumerate(lines):
+        fields = line.split(header['delimiter'])
+        if len(fields) < min_fields:
+            logger.info(f'skipped CSV line {first_index + ind}: {line}')
+            continue
+        if (b'VPM' in fields[target_col]) and fields[packet_col] == CSV_PAYLOAD_PACKET:
+            hex_data.append(fields[data_col])
+            timestamps.append(fields[time_col])
+            row_inds.append(ind)
+
+    counts = dict(rows=len(lines), frames=0, checksum_failures=0, escapes=0,
+                  escaped_checksums=0, escaped_bytecounts=0, exceptions=0)
+
+    # Decode the hex strings all at once, if they're clean; otherwise one by one
+    try:
+        if any(len(x) % 2 for x in hex_data):
+            raise ValueError('odd-length hex string')
+        raw = np.frombuffer(binascii.unhexlify(b''.join(hex_data)), dtype=np.uint8)
+        row_lengths = np.array([len(x)//2 for x in hex_data], dtype=np.int64)
+    except (ValueError, binascii.Error):
+        decoded_rows = []
+        for ind, x in zip(list(row_inds), hex_data):
+            try:
+                decoded_rows.append(bytes.fromhex(x.decode()))
+            except ValueError:
+                logger.info(f'skipped CSV line {first_index + ind}: {lines[ind]}')
+                decoded_rows.append(None)
+        keep = [x is not None for x in decoded_rows]
+        row_inds = list(itertools.compress(row_inds, keep))
+        timestamps = list(itertools.compress(timestamps, keep))
+        decoded_rows = list(itertools.compress(decoded_rows, keep))
+        raw = np.frombuffer(b''.join(decoded_rows), dtype=np.uint8)
+        row_lengths = np.array([len(x) for x in decoded_rows], dtype=np.int64)
+
+    row_inds = np.array(row_inds, dtype=np.int64)
+    row_offsets = np.cumsum(row_lengths) - row_lengths
+
+    # Each row's frame runs from its first 0x7E to the second
+    flag_inds = np.flatnonzero(raw == 0x7E)
+    flag_rows = np.searchsorted(row_offsets, flag_inds, side='right') - 1
+    firsts = np.flatnonzero(np.r_[True, flag_rows[1:] != flag_rows[:-1]]) if flag_inds.size else flag_inds
+    firsts = firsts[firsts + 1 < flag_inds.size]
+    firsts = firsts[flag_rows[firsts + 1] == flag_rows[firsts]]
+    frame_rows = flag_rows[firsts]
+    frame_starts = flag_inds[firsts]
+    frame_lengths = flag_inds[firsts + 1] - frame_starts + 1
+
+    # Frames need to reach the checksum field
+    complete = frame_lengths >= CHECKSUM_INDEX + 1
+    frame_rows, frame_starts, frame_lengths = frame_rows[complete], frame_starts[complete], frame_lengths[complete]
+
+    for x in np.setdiff1d(np.arange(len(row_inds)), frame_rows):
+        counts['exceptions'] += 1
+        logger.warning('exception at packet # %d', first_index + row_inds[x])
+
+    # Decode the frames, a group of equal-length frames at a time (almost all will be PACKET_SIZE)
+    batches = []
+    for width in np.unique(frame_lengths):
+        group = frame_lengths == width
+        frames = raw[frame_starts[group][:, None] + np.arange(width)]
+        cur_rows = frame_rows[group]
+
+        validated = validate_frames(frames)
+        valid = validated['valid']
+        add_counts(counts, validated['counts'])
+        for x in np.flatnonzero(~valid):
+            logger.warning('invalid checksum at packet # %d -- skipping'%(first_index + row_inds[cur_rows[x]]))
+
+        header_timestamps = ISO_to_timestamp([timestamps[x] for x in cur_rows])
+        bad_times = np.isnan(header_timestamps) & valid
+        for x in np.flatnonzero(bad_times):
+            counts['exceptions'] += 1
+            logger.warning('exception at packet # %d', first_index + row_inds[cur_rows[x]])
+
+        # Only decode the frames which passed, and have a usable timestamp
+        validated['valid'] = valid & ~bad_times
+        decoded = decode_frames(frames, validated)
+        batches.append(frames_to_batch(decoded, fname,
+                                       header_timestamp=header_timestamps[validated['valid']],
+                                       file_index=first_index + row_inds[cur_rows[validated['valid']]]))
+
+    # Back into file order
+    packets = PacketBatch.concatenate(batches)
+    if len(batches) > 1:
+        packets = packets.sort('file_index')
+    return packets, counts
 
 def remove_trailing_nans(arr1d):
     ''' Trims off the trailing NaNs of a vector.'''
@@ -703,12 +1173,12 @@ def decode_burst_data_by_experiment_number(packets, burst_cmd = None, burst_puls
     logger = logging.getLogger(__name__+'.decode_burst_data_by_experiment_number')
 
     # Select burst packets
-    burst_packets = list(filter(lambda packet: packet['dtype'] in ['E','B','G'], packets))
+    burst_packets = PacketBatch.from_packets(packets).by_dtype('EBG')
     
     # Get all unique experiment numbers for this set of packets 
     # (chances are real good that we'll only have 1 or 2 unique numbers)
-    avail_exp_nums = np.unique([x['exp_num'] for x in burst_packets])
-    logger.info(f"available burst experiment numbers: {avail_exp_nums}")
+    packets_by_e_num = burst_packets.group_by_exp_num()
+    logger.info(f"available burst experiment numbers: {list(packets_by_e_num)}")
 
     completed_bursts = []
 
@@ -720,12 +1190,9 @@ def decode_burst_data_by_experiment_number(packets, burst_cmd = None, burst_puls
     else:
         burst_config = None
 
-    for e_num in avail_exp_nums:
+    for e_num, current_packets in packets_by_e_num.items():
         logger.info(f"processing experiment number {e_num}")
-        filt_inds = [p['exp_num']==e_num for p in burst_packets]
-        current_packets = list(itertools.compress(burst_packets, filt_inds))
-        cur_G_packets   = list(filter(lambda p: p['dtype']=='G', current_packets))
-        header_timestamps = sorted([p['header_timestamp'] for p in current_packets])
+        header_timestamps = np.sort(current_packets['header_timestamp'])
 
         # # The burst command is echoed at the top of each GPS packet, if we have any
         # if (burst_config is None) and cur_G_packets:
@@ -740,10 +1207,10 @@ def decode_burst_data_by_experiment_number(packets, burst_cmd = None, burst_puls
 
             
         processed = process_burst(current_packets, burst_config)
-        processed['header_timestamp'] = header_timestamps[0]
+        processed['header_timestamp'] = float(header_timestamps[0])
         processed['experiment_number'] = e_num
         completed_bursts.append(processed)
-        burst_packets = list(itertools.compress(burst_packets, np.logical_not(filt_inds)))
+        burst_packets = burst_packets[burst_packets['exp_num'] != e_num]
         logger.info(f"{len(burst_packets)} packets remaining")
     unused_packets = burst_packets
     logger.info(f"returning {len(burst_packets)} unused burst packets")
@@ -754,12 +1221,12 @@ def decode_burst_data_in_range(packets, ta, tb, burst_cmd = None, burst_pulses =
         Use this in the event that we want to decode an incomplete burst.
     '''
     logger = logging.getLogger(__name__ +'.decode_burst_data_in_range')
-    burst_packets = list(filter(lambda packet: packet['dtype'] in ['E','B','G'], packets))
-    burst_packets = sorted(burst_packets, key = lambda p: p['header_timestamp'])
-    header_timestamps = ([p['header_timestamp'] for p in burst_packets])
+    burst_packets = PacketBatch.from_packets(packets).by_dtype('EBG')
+    burst_packets = burst_packets.sort('header_timestamp')
+    header_timestamps = burst_packets['header_timestamp']
 
 
-    avail_exp_nums = np.unique([x['exp_num'] for x in burst_packets])
+    avail_exp_nums = np.unique(burst_packets['exp_num'])
     logger.debug(f'Available burst experiment numbers: {avail_exp_nums}')
 
     completed_bursts = []
@@ -778,9 +1245,9 @@ def decode_burst_data_in_range(packets, ta, tb, burst_cmd = None, burst_pulses =
     for e_num in avail_exp_nums:
         logger.info(f"processing experiment number {e_num}")
 
-        filt_inds = [p['header_timestamp'] >= ta and p['header_timestamp'] <= tb for p in burst_packets]
-        current_packets = list(itertools.compress(burst_packets, filt_inds))
-        header_timestamps = sorted([p['header_timestamp'] for p in current_packets])
+        filt_inds = (burst_packets['header_timestamp'] >= ta) & (burst_packets['header_timestamp'] <= tb)
+        current_packets = burst_packets[filt_inds]
+        header_timestamps = np.sort(current_packets['header_timestamp'])
 
         if len(current_packets) > 100:
             logger.info(f'------ exp num {e_num} ------')
@@ -791,17 +1258,37 @@ def decode_burst_data_in_range(packets, ta, tb, burst_cmd = None, burst_pulses =
 
             processed['ta'] = ta
             processed['tb'] = tb
-            processed['header_timestamp'] = header_timestamps[0]
+            processed['header_timestamp'] = float(header_timestamps[0])
             processed['experiment_number'] = e_num
 
             completed_bursts.append(processed)
-            burst_packets = list(itertools.compress(burst_packets, np.logical_not(filt_inds)))
+            burst_packets = burst_packets[~filt_inds]
             logger.info(f"{len(burst_packets)} packets remaining")
 
     unused_packets = burst_packets    
     logger.info(f"returning {len(burst_packets)} unused burst packets")
     return completed_bursts, unused_packets
 
+def remove_packet(packets, packet):
+    ''' list.remove() for packet dictionaries. Matches by identity, since
+        payload arrays can't be compared with == '''
+    for ind, p in enumerate(packets):
+        if p is packet:
+            del packets[ind]
+            return
+    raise ValueError('packet not in list')
+
+def check_GPS_command_echo(packets, cmd):
+    ''' The burst command is echoed at the top of each GPS packet; warn if any don't match cmd. '''
+    logger = logging.getLogger(__name__ +'.check_GPS_command_echo')
+
+    G_packets = packets.by_dtype('G')
+    for ind in np.flatnonzero(G_packets['start_ind'] == 0):
+        cmd_gps = np.flip(G_packets.data(ind)[0:3])
+        logger.debug(cmd_gps)
+        if (cmd != cmd_gps).any():
+            logger.warning("GPS and status command echo mismatch")
+
 def decode_burst_data_between_status_packets(packets):
     ''' Decode burst data by sorting packets by arrival time, and binning bursts
         between two status packets. 
@@ -809,14 +1296,14 @@ def decode_burst_data_between_status_packets(packets):
 
     logger = logging.getLogger(__name__ +'.decode_burst_data_between_status_packets')
 
-    I_packets     = list(filter(lambda p: (p['dtype'] == 'I' and chr(p['data'][3])=='B'), packets))
-    I_packets     = sorted(I_packets, key = lambda p: p['header_timestamp'])
-    burst_packets = list(filter(lambda packet: packet['dtype'] in ['E','B','G'], packets))
-    burst_packets = sorted(burst_packets, key = lambda p: p['header_timestamp'])
+    packets = PacketBatch.from_packets(packets)
+    I_packets     = packets.by_dtype('I').sort('header_timestamp')
+    I_packets     = list(filter(lambda p: chr(p['data'][3])=='B', I_packets))
+    burst_packets = packets.by_dtype('EBG').sort('header_timestamp')
     # stats = decode_status(I_packets)
 
 
-    avail_exp_nums = np.unique([x['exp_num'] for x in burst_packets])
+    avail_exp_nums = np.unique(burst_packets['exp_num'])
     logging.info(f"exp nums in dataset: {avail_exp_nums}")
     completed_bursts = []
 
@@ -840,12 +1327,12 @@ def decode_burst_data_between_status_packets(packets):
 
         # (At this point, there will be only one available experiment number)
         for e_num in avail_exp_nums:
-            filt_inds = [p['header_timestamp'] >= ta and p['header_timestamp'] <= tb for p in burst_packets]
-            packets_in_time_range = list(itertools.compress(burst_packets, filt_inds))
+            filt_inds = (burst_packets['header_timestamp'] >= ta) & (burst_packets['header_timestamp'] <= tb)
+            packets_in_time_range = burst_packets[filt_inds]
 
 
-            packets_with_matching_e_num = list(filter(lambda p: p['exp_num']==e_num, burst_packets))
-            logger.info(f"packets in time range: {len(packets_in_time_range)}; packets with exp_num {e_num}: {len(packets_with_matching_e_num)}")
+            num_with_matching_e_num = np.sum(burst_packets['exp_num'] == e_num)
+            logger.info(f"packets in time range: {len(packets_in_time_range)}; packets with exp_num {e_num}: {num_with_matching_e_num}")
 
             if len(packets_in_time_range) > 100:
                 logger.info(f'------ exp num {e_num} ------')
@@ -858,12 +1345,7 @@ def decode_burst_data_between_status_packets(packets):
                 
                 # The burst command is echoed at the top of each GPS packet; we're using the
                 # command listed in the status packet, but let's confirm it matches.
-                for gg in filter(lambda packet: packet['dtype'] == 'G', packets_in_time_range):
-                    if gg['start_ind'] ==0:
-                        cmd_gps = np.flip(gg['data'][0:3])
-                        logger.debug(cmd_gps)
-                        if (IA_cmd != cmd_gps).any():
-                            logger.warning("GPS and status command echo mismatch")
+                check_GPS_command_echo(packets_in_time_range, IA_cmd)
 
                 # Get burst configuration parameters:
                 cmd = np.flip(IA['data'][12:15])
@@ -887,13 +1369,13 @@ def decode_burst_data_between_status_packets(packets):
 
                 
                 # Remove processed packets from data_dict
-                burst_packets = list(itertools.compress(burst_packets, np.logical_not(filt_inds)))
-                I_packets.remove(IA)
-                I_packets.remove(IB)
+                burst_packets = burst_packets[~filt_inds]
+                remove_packet(I_packets, IA)
+                remove_packet(I_packets, IB)
 
             logger.info(f"{len(burst_packets)} packets remaining")
 
-    unused_packets = burst_packets + I_packets
+    unused_packets = PacketBatch.concatenate([burst_packets, I_packets])
     logger.info(f"returning {len(unused_packets)} unused burst packets")    
     return completed_bursts, unused_packets
 
@@ -906,14 +1388,14 @@ def decode_burst_data_by_trailing_status_packet(packets):
 
     logger = logging.getLogger(__name__)
 
-    I_packets     = list(filter(lambda p: (p['dtype'] == 'I' and chr(p['data'][3])=='B'), packets))
-    I_packets     = sorted(I_packets, key = lambda p: p['header_timestamp'])
-    burst_packets = list(filter(lambda packet: packet['dtype'] in ['E','B','G'], packets))
-    burst_packets = sorted(burst_packets, key = lambda p: p['header_timestamp'])
+    packets = PacketBatch.from_packets(packets)
+    I_packets     = packets.by_dtype('I').sort('header_timestamp')
+    I_packets     = list(filter(lambda p: chr(p['data'][3])=='B', I_packets))
+    burst_packets = packets.by_dtype('EBG').sort('header_timestamp')
     # stats = decode_status(I_packets)
 
 
-    avail_exp_nums = np.unique([x['exp_num'] for x in burst_packets])
+    avail_exp_nums = np.unique(burst_packets['exp_num'])
     logging.info(f"exp nums in dataset: {avail_exp_nums}")
     completed_bursts = []
 
@@ -933,12 +1415,12 @@ def decode_burst_data_by_trailing_status_packet(packets):
 
         # (At this point, there will be only one available experiment number)
         for e_num in avail_exp_nums:
-            filt_inds = [p['header_timestamp'] >= ta and p['header_timestamp'] <= tb for p in burst_packets]
-            packets_in_time_range = list(itertools.compress(burst_packets, filt_inds))
+            filt_inds = (burst_packets['header_timestamp'] >= ta) & (burst_packets['header_timestamp'] <= tb)
+            packets_in_time_range = burst_packets[filt_inds]
 
 
-            packets_with_matching_e_num = list(filter(lambda p: p['exp_num']==e_num, burst_packets))
-            logger.info(f"packets in time range: {len(packets_in_time_range)}; packets with exp_num {e_num}: {len(packets_with_matching_e_num)}")
+            num_with_matching_e_num = np.sum(burst_packets['exp_num'] == e_num)
+            logger.info(f"packets in time range: {len(packets_in_time_range)}; packets with exp_num {e_num}: {num_with_matching_e_num}")
 
             if len(packets_in_time_range) > 100:
                 logger.info(f'------ exp num {e_num} ------')
@@ -951,12 +1433,7 @@ def decode_burst_data_by_trailing_status_packet(packets):
                 
                 # The burst command is echoed at the top of each GPS packet; we're using the
                 # command listed in the status packet, but let's confirm it matches.
-                for gg in filter(lambda packet: packet['dtype'] == 'G', packets_in_time_range):
-                    if gg['start_ind'] ==0:
-                        cmd_gps = np.flip(gg['data'][0:3])
-                        logger.debug(cmd_gps)
-                        if (IB_cmd != cmd_gps).any():
-                            logger.warning("GPS and status command echo mismatch")
+                check_GPS_command_echo(packets_in_time_range, IB_cmd)
 
                 # Get burst configuration parameters:
                 burst_config = decode_burst_command(IB_cmd)
@@ -979,12 +1456,12 @@ def decode_burst_data_by_trailing_status_packet(packets):
 
                 
                 # Remove processed packets from data_dict
-                burst_packets = list(itertools.compress(burst_packets, np.logical_not(filt_inds)))
-                I_packets.remove(IB)
+                burst_packets = burst_packets[~filt_inds]
+                remove_packet(I_packets, IB)
 
             logger.info(f"{len(burst_packets)} packets remaining")
 
-    unused_packets = burst_packets + I_packets
+    unused_packets = PacketBatch.concatenate([burst_packets, I_packets])
     logger.info(f"returning {len(unused_packets)} unused burst packets")    
     return completed_bursts, unused_packets
 
@@ -999,39 +1476,23 @@ def process_burst(packets, burst_config=None):
     logger = logging.getLogger(__name__ +'.process_burst')
 
     # Sort the packets by data stream:
-    E_packets = list(filter(lambda packet: packet['dtype'] == 'E', packets))
-    B_packets = list(filter(lambda packet: packet['dtype'] == 'B', packets))
-    G_packets = list(filter(lambda packet: packet['dtype'] == 'G', packets))
-
-
+    packets = PacketBatch.from_packets(packets)
+    E_packets = packets.by_dtype('E')
+    B_packets = packets.by_dtype('B')
+    G_packets = packets.by_dtype('G')
 
-    # Loop through all packets to get the maximum data index:    
-    if E_packets:
-        max_E_ind = max([p['start_ind'] + p['bytecount'] for p in E_packets])
-    else: max_E_ind = 0
-    if B_packets:
-        max_B_ind = max([p['start_ind'] + p['bytecount'] for p in B_packets])
-    else: max_B_ind = 0
-    if G_packets:
-        max_G_ind = max([p['start_ind'] + p['bytecount'] for p in G_packets])
-    else: max_G_ind = 0
-
-    E_data = np.zeros(max_E_ind)*np.nan
-    B_data = np.zeros(max_B_ind)*np.nan
-    G_data = np.zeros(max_G_ind)*np.nan
-
-    logger.debug(f'Max E ind: {max_E_ind}  Max B ind: {max_B_ind}, Max G ind: {max_G_ind}')
+    # Place each packet's data at its start index; the arrays are sized
+    # to the maximum data index of each stream.
     logger.info("reassembling E")
-    for p in E_packets:
-        E_data[p['start_ind']:(p['start_ind'] + p['bytecount'])] = p['data']
+    E_data = E_packets.reassemble()
 
     logger.info("reassembling B")
-    for p in B_packets:
-        B_data[p['start_ind']:(p['start_ind'] + p['bytecount'])] = p['data']
+    B_data = B_packets.reassemble()
 
     logger.info("reassembling GPS")
-    for p in G_packets:
-        G_data[p['start_ind']:(p['start_ind'] + p['bytecount'])] = p['data']
+    G_data = G_packets.reassemble()
+
+    logger.debug(f'Max E ind: {len(E_data)}  Max B ind: {len(B_data)}, Max G ind: {len(G_data)}')
 
 
     # Decode any GPS data we might have
@@ -1042,10 +1503,9 @@ def process_burst(packets, burst_config=None):
         # Burst command is echo'ed at the top of each GPS packet:
         gps_echoed_cmds = []
 
-        for g in G_packets:
-            if g['start_ind'] == 0:
-                cmd = np.flip(g['data'][0:3])
-                gps_echoed_cmds.append(cmd)
+        for ind in np.flatnonzero(G_packets['start_ind'] == 0):
+            cmd = np.flip(G_packets.data(ind)[0:3])
+            gps_echoed_cmds.append(cmd)
         if gps_echoed_cmds:
             # Check that they're all the same, if we have more entries...
             cmd = gps_echoed_cmds[0]
@@ -1111,6 +1571,10 @@ def decode_GPS_data(data):
     '''
     Author:     Austin Sousa
                 austin.sousa@colorado.edu
+    Version:    1.1
+        Date:   10.18.2026
+        - Timestamps are converted all at once (time_handlers.GPS_week_to_timestamp),
+          using the leap second table rather than a fixed 18-second offset
     Version:    1.0
         Date:   10.15.2019
     Description:
@@ -1131,11 +1595,7 @@ def decode_GPS_data(data):
 
     logger = logging.getLogger(__name__ +'.decode_GPS_data')
 
-    # GPS time is delivered as: weeks from reference date, plus seconds into the week.
-    leap_seconds = 18  # GPS time does not account for leap seconds; as of ~2019, GPS leads UTC by 18 seconds.
-    reference_date = datetime.datetime(1980,1,6,0,0, tzinfo=datetime.timezone.utc) - datetime.timedelta(seconds=leap_seconds)
-    pos_inds = find_sequence(data,np.array([0xAA, 0x44, 0x12, 0x1C, 0x2A]))
-    vel_inds = find_sequence(data,np.array([0xAA, 0x44, 0x12, 0x1C, 0x63]))
+    pos_inds, vel_inds = find_sequences(data, [BESTPOS_SYNC, BESTVEL_SYNC])
 
     if len(pos_inds)==0 and len(vel_inds)==0:
         logger.debug("No GPS logs found")
@@ -1248,17 +1708,24 @@ def decode_GPS_data(data):
 	                out['solution_type'] = vel_type
         	except:
         		logger.warning(f'exception decoding velocity message {i}')
-        # timestamp
-        out['timestamp'] = (reference_date + datetime.timedelta(weeks=out['weeknum']) + \
-                      datetime.timedelta(seconds=out['sec_offset'])).timestamp()
         outs.append(out)
 
+    # GPS time is delivered as: weeks from reference date, plus seconds into the week.
+    timestamps = GPS_week_to_timestamp([out['weeknum'] for out in outs], [out['sec_offset'] for out in outs])
+    for out, t in zip(outs, timestamps.tolist()):
+        out['timestamp'] = t
+
     return outs
 
 def decode_survey_data(packets, separation_time = 4.5):
     '''
     Author:     Austin Sousa
                 austin.sousa@colorado.edu
+    Version:    1.2
+        Date:   10.18.2026
+        - Works on a PacketBatch: sorting, grouping by experiment number and
+          reassembly are whole-array operations. Unused packets are returned
+          as a PacketBatch.
     Version:    1.1
         Date:   2.25.2020
     Description:
@@ -1270,7 +1737,7 @@ def decode_survey_data(packets, separation_time = 4.5):
         Gathers and reassembles any "survey" data contained within a set of packets.
 
     inputs: 
-        packets: A list of "packet" dictionaries, as returned from decode_packets.py
+        packets: A PacketBatch (or list of "packet" dictionaries), as returned from decode_packets.py
         separation_time: The maximum time, in seconds, between packet arrivals
                 for which we'll group by experiment number.
     outputs:
@@ -1284,18 +1751,15 @@ def decode_survey_data(packets, separation_time = 4.5):
                     the current survey product
     '''
 
-    # leap_seconds = 18  # GPS time does not account for leap seconds; as of ~2019, GPS leads UTC by 18 seconds.
-    # reference_date = datetime.datetime(1980,1,6,0,0, tzinfo=datetime.timezone.utc) - datetime.timedelta(seconds=leap_seconds)
-    # logger = logging.getLogger(__name__ +'.decode_survey_data')
     logger = logging.getLogger(__name__ +'.decode_survey_data')
-    S_packets = list(filter(lambda packet: packet['dtype'] == 'S', packets))
+    S_packets = PacketBatch.from_packets(packets).by_dtype('S')
     # Sort by arrival time
     # S_packets = sorted(S_packets, key=lambda p: p['header_epoch_sec'] + p['header_ns']*1e-9)
-    S_packets = sorted(S_packets, key=lambda p: p['header_timestamp'])
+    S_packets = S_packets.sort('header_timestamp')
 
     if len(S_packets) == 0:
         logger.info("no survey data present!")
-        return [], []
+        return [], S_packets
 
     # These will roll over every 256 survey columns... need to deal with that
     # in this search. For now, just assume they're unique
@@ -1303,9 +1767,10 @@ def decode_survey_data(packets, separation_time = 4.5):
     
     # ax.plot(np.diff([x['exp_num'] for x in S_packets]),'.')
     # plt.show()
-    e_nums = np.unique([x['exp_num'] for x in S_packets])
+    # (Packets stay sorted by arrival time within each experiment number)
+    packets_by_e_num = S_packets.group_by_exp_num()
 
-    logging.debug(f'available survey experiment numbers: {e_nums}')
+    logging.debug(f'available survey experiment numbers: {list(packets_by_e_num)}')
 
     survey_packet_length = 1212
 
@@ -1324,14 +1789,11 @@ def decode_survey_data(packets, separation_time = 4.5):
     complete_surveys = []
     unused = []
     # separation_time = 4.5 # 0.5  # seconds
-    for e_num in e_nums:
-
-        # Reassemble into a single survey data packet
-        cur_packets   = list(filter(lambda packet: packet['exp_num'] == e_num, S_packets))
+    for e_num, cur_packets in packets_by_e_num.items():
 
         # Divide this list up into segments with nearby arrival times:
         # arrival_times = [p['header_epoch_sec'] + p['header_ns']*1e-9 for p in cur_packets]
-        arrival_times = [p['header_timestamp'] for p in cur_packets]
+        arrival_times = cur_packets['header_timestamp']
 
         # Find any significant time differences
         splits = np.where(np.diff(arrival_times) > separation_time)[0] + 1  
@@ -1342,11 +1804,8 @@ def decode_survey_data(packets, separation_time = 4.5):
         dt_prev = 10
         for s1,s2 in zip(splits[0:-1],splits[1:]):
             try:
-                # Start with all nans
-                cur_data = np.zeros(survey_packet_length)*np.nan
-                # Insert each packets' payload
-                for p in cur_packets[s1:s2]:
-                    cur_data[p['start_ind']:(p['start_ind'] + p['bytecount'])] = p['data']
+                # Insert each packets' payload into a survey product (all nans where missing)
+                cur_data = cur_packets[s1:s2].reassemble(survey_packet_length)
                 # Did we get a full packet? 
                 if np.sum(np.isnan(cur_data)) == 0:
                     # Complete packet!
@@ -1365,7 +1824,7 @@ def decode_survey_data(packets, separation_time = 4.5):
                     d['E_data'] = E_data.astype('uint8')
                     d['B_data'] = B_data.astype('uint8')
                     # d['header_epoch_sec'] = cur_packets[s1]['header_epoch_sec']
-                    d['header_timestamp'] = cur_packets[s1]['header_timestamp']
+                    d['header_timestamp'] = float(arrival_times[s1])
                     d['exp_num'] = e_num
                     
                     # find gain and filter char.
@@ -1387,9 +1846,10 @@ def decode_survey_data(packets, separation_time = 4.5):
                 else:
                     # If not, put the unused packets aside, so we can possibly
                     # combine with packets from other files
-                    unused.extend(cur_packets[s1:s2])
+                    unused.append(cur_packets[s1:s2])
             except:
                 logging.warning(f'bad survey packet between {s1} and {s2}')
+    unused = PacketBatch.concatenate(unused)
     # Send it
     logger.info(f'Recovered {len(S_data)} survey products, leaving {len(unused)} unused packets')
     return S_data, unused
@@ -3,9 +3,46 @@ from sqlite3 import Error
 
 import numpy as np
 import os, sys
+import itertools
+import hashlib
 import logging
 import datetime
+import atexit
+import threading
+import pathlib
+from contextlib import contextmanager
 
+from packet_batch import PacketBatch, HEADER_FIELDS
+
+# Page cache for each packet database connection, in kB
+CACHE_SIZE_KB = 64*1024
+
+# Indexes on the packets table, for the pipeline's queries: packets by type and
+# header time (and the per-day summaries, from the index alone), packets added
+# since a stage's last run, and packets by file
+PACKET_INDEXES = [('packets_dtype_time', 'dtype, header_timestamp, added'),
+                  ('packets_added', 'added'),
+                  ('packets_fname', 'fname')]
+
+# The fields (besides the payload) which identify a packet, for packet_hashes
+HASH_FIELDS = ['start_ind', 'dtype', 'exp_num', 'header_epoch_sec', 'header_ns']
+
+# ... and, for packets with no CCSDS time (from .CSV files), the fields which tell
+# the same payload received at different times apart
+NO_CCSDS_HASH_FIELDS = ['header_timestamp', 'file_index']
+
+# The fields which have to match for two packets to be the same packet (everything
+# but where and when it was decoded), for remove_duplicate_packets
+PACKET_FIELDS = ['data', 'start_ind', 'dtype', 'exp_num', 'bytecount', 'checksum_verify', 'packet_length',
+                 'header_timestamp', 'file_index', 'header_ns', 'header_epoch_sec', 'header_reboots']
+
+# The number of migrate_packets_table steps applied to an up-to-date database
+# (kept in the database's user_version)
+PACKET_DB_VERSION = 4
+
+# Connections kept open for reuse, by (process ID, thread, database path, read only),
+# along with the identity of the file each one opened: see db_connection
+_connections = dict()
 
 
 
@@ -28,6 +65,76 @@ def create_connection(db_file):
 
     return conn
 
+def set_connection_pragmas(conn, read_only=False):
+    ''' Tune a new connection: a bigger page cache, and (for writing, in WAL mode) fewer syncs to disk '''
+    conn.execute(f'PRAGMA cache_size = {-CACHE_SIZE_KB}')
+    if not read_only:
+        # (In WAL mode, the last commits can be lost in a power failure, but the database
+        # is never corrupted. In the rollback journal modes it can be, so they sync fully.)
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        if journal_mode.lower() == 'wal':
+            conn.execute('PRAGMA synchronous = NORMAL')
+        else:
+            conn.execute('PRAGMA synchronous = FULL')
+
+@contextmanager
+def db_connection(db_file, read_only=True):
+    '''
+    A connection to db_file, opened the first time it's asked for in this process
+    (and thread), with its pragmas set, and reused by every query after that:
+
+        with db_connection(packet_db) as conn:
+            rows = conn.execute(...).fetchall()
+
+    Read-only connections use a read-only URI, so the query stages can't modify
+    the database (or create an empty one, if it's missing). Writable connections
+    commit at the end of the block, or roll back if it raises. A connection which
+    raises a database error, or whose file has been deleted or replaced since, is
+    closed and opened again.
+    '''
+    key = (os.getpid(), threading.get_ident(), os.path.abspath(db_file), read_only)
+    conn, file_id = _connections.get(key, (None, None))
+    try:
+        stat = os.stat(db_file)
+        current_id = (stat.st_dev, stat.st_ino)
+    except OSError:
+        current_id = None
+    if conn is not None and file_id != current_id:
+        _connections.pop(key)
+        conn.close()
+        conn = None
+
+    if conn is None:
+        if read_only:
+            uri = f'{pathlib.Path(os.path.abspath(db_file)).as_uri()}?mode=ro'
+            conn = sqlite3.connect(uri, uri=True)
+        else:
+            conn = sqlite3.connect(db_file)
+            if current_id is None:
+                stat = os.stat(db_file)
+                current_id = (stat.st_dev, stat.st_ino)
+        set_connection_pragmas(conn, read_only)
+        _connections[key] = (conn, current_id)
+
+    try:
+        yield conn
+        if not read_only:
+            conn.commit()
+    except Error:
+        _connections.pop(key, None)
+        conn.close()
+        raise
+    except:
+        if not read_only:
+            conn.rollback()
+        raise
+
+@atexit.register
+def close_connections():
+    ''' Close the connections db_connection has kept open in this process '''
+    for key in [k for k in _connections if k[0] == os.getpid()]:
+        _connections.pop(key)[0].close()
+
 
 def create_table(conn, create_table_sql):
     """ create a table from the create_table_sql statement
@@ -44,22 +151,57 @@ def create_table(conn, create_table_sql):
         logger.error(e)
 
 def packet_hash(el):
-    # A hash of a single packet. This is a little sloppy, since
-    # it casts the whole dict to a string, sorted by keys.
-    # It will fail on nested dictionaries if the nested
-    # dicts are in different orders, since we're only sorting the
-    # top level.
-    return hash(str(sorted(el.items())))
-    
+    # A hash of a single packet dictionary (see packet_hashes)
+    return packet_hashes(PacketBatch.from_packets([el]))[0]
+
+def packet_hashes(packets, blobs=None):
+    # Hashes of every packet in a PacketBatch (with its payloads as blobs, if
+    # already split out), as signed 64-bit ints: a blake2b digest of the fields
+    # which identify a packet -- its payload, VPM header (start_ind, dtype,
+    # exp_num) and CCSDS time. The same packet hashes the same in every file and
+    # every run, so duplicate downlinks can be rejected by the UNIQUE index on hash.
+    # Packets without a CCSDS time (.CSV packets) hash their header_timestamp and
+    # file_index too, so repeats of the same payload (e.g. fill packets) are kept.
+    n = len(packets)
+    fields = np.zeros((n, len(HASH_FIELDS)), dtype='<i8')
+    for i, k in enumerate(HASH_FIELDS):
+        if k == 'dtype':
+            fields[:, i] = np.asarray(packets.columns.get(k, np.full(n, '')), dtype='U1').view('<i4')
+        else:
+            fields[:, i] = packets.columns.get(k, np.full(n, HEADER_FIELDS[k][1]))
+    keys = fields.tobytes()
+    width = fields.shape[1]*8
+
+    no_ccsds = (fields[:, HASH_FIELDS.index('header_epoch_sec')] < 0).tolist()
+    ts = np.asarray(packets.columns.get('header_timestamp', np.full(n, np.nan)), dtype='<f8')
+    ts = np.where(np.isnan(ts), np.nan, ts)
+    file_index = np.asarray(packets.columns.get('file_index', np.full(n, -1)), dtype='<i8')
+    extra_keys = np.stack([ts.view('<i8'), file_index], axis=1).tobytes()
+    extra_width = len(NO_CCSDS_HASH_FIELDS)*8
+
+    if blobs is None:
+        buf = memoryview(np.ascontiguousarray(packets.payload))
+        blobs = [buf[a:a + l] for a, l in zip(packets.offsets.tolist(), packets.lengths.tolist())]
+
+    hashes = []
+    for i, d in enumerate(blobs):
+        h = hashlib.blake2b(keys[i*width:(i + 1)*width], digest_size=8)
+        if no_ccsds[i]:
+            h.update(extra_keys[i*extra_width:(i + 1)*extra_width])
+        h.update(d)
+        hashes.append(int.from_bytes(h.digest(), 'little', signed=True))
+    return hashes
+
 def add_metadata(in_list):
     # Add metadata to each entry -- a hash value, and the time added.
     for el in in_list:
         el['hash'] = packet_hash(el)
         el['added'] = datetime.datetime.now().timestamp()
 
-def connect_packet_db(db_name):
+def connect_packet_db(db_name, journal_mode=None):
     # Connect to a database, and create the packets table,
-    # if it doesn't already exist
+    # if it doesn't already exist. journal_mode (e.g. 'WAL', for the
+    # ingest writer) is set if given; it's kept in the database file.
 
     logger = logging.getLogger('connect_packet_db')
 
@@ -78,7 +220,38 @@ def connect_packet_db(db_name):
                                         header_ns INTEGER,
                                         header_epoch_sec INTEGER,
                                         header_reboots INTEGER,
-                                        added REAL
+                                        added REAL,
+                                        path TEXT
+                                    ); """
+
+    # Manifest of every telemetry file we've decoded, by path: what it looked like
+    # at the time (size, mtime, digest), how it went, how many bytes were decoded
+    # (for picking up files which were still being written on the previous run),
+    # and roughly when its data was recorded (for deciding which files to do first)
+    sql_create_files_table = """ CREATE TABLE IF NOT EXISTS files (
+                                        path TEXT PRIMARY KEY,
+                                        fname TEXT,
+                                        size INTEGER,
+                                        bytes_decoded INTEGER,
+                                        updated REAL,
+                                        mtime REAL,
+                                        digest TEXT,
+                                        status TEXT,
+                                        packet_count INTEGER,
+                                        checksum_failures INTEGER,
+                                        data_time REAL
+                                    ); """
+
+    # Processing tasks (stage, UTC day) run by process_pipeline, with the version of
+    # the packet data each was last run on, so unchanged days aren't run again
+    sql_create_tasks_table = """ CREATE TABLE IF NOT EXISTS tasks (
+                                        stage TEXT,
+                                        day TEXT,
+                                        version TEXT,
+                                        status TEXT,
+                                        updated REAL,
+                                        completed REAL,
+                                        PRIMARY KEY (stage, day)
                                     ); """
 
     # create a database connection
@@ -87,56 +260,244 @@ def connect_packet_db(db_name):
     # create tables
     if conn is not None:
         logger.info('connected to db')
+        if journal_mode:
+            try:
+                conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+            except Error as e:
+                logger.warning(f'could not set journal_mode={journal_mode}: {e}')
+        set_connection_pragmas(conn)
         # create projects table
         create_table(conn, sql_create_packets_table)
+        migrate_packets_table(conn)
+        files_columns = get_table_columns(conn, 'files')
+        if files_columns[:1] != ['path']:
+            migrate_files_table(conn, files_columns, sql_create_files_table)
+        elif 'data_time' not in files_columns:
+            conn.execute('ALTER TABLE files ADD COLUMN data_time REAL')
+        create_table(conn, sql_create_tasks_table)
     else:
         logger.error("Error! cannot create the database connection.")
 
     return conn
 
-def write_to_db(conn, packets, db_field = 'packets'):
-    logger = logging.getLogger('write_to_db')
+def get_table_columns(conn, table):
+    ''' Column names of a table (an empty list, if it doesn't exist) '''
+    cur = conn.cursor()
+    cur.execute(f'PRAGMA table_info({table})')
+    return [x[1] for x in cur.fetchall()]
+
+def migrate_packets_table(conn):
+    '''
+    Brings the packets table up to date, applying each step it hasn't had yet
+    (the number applied is kept in the database's user_version):
+        1. creates PACKET_INDEXES
+        2. recomputes every packet's hash (see packet_hashes), and makes hash a
+           UNIQUE index (see remove_duplicate_packets)
+        3. adds the path column (the file each packet was decoded from), and its index
+        4. recomputes the hashes of packets without a CCSDS time, which hash their
+           header_timestamp and file_index too, as in step 2
+    and runs ANALYZE afterwards, so the query planner uses the indexes.
+    If another process holds the database, it's left for the next connection.
+    '''
+    logger = logging.getLogger('migrate_packets_table')
+
+    cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    if cur.fetchone()[0] >= PACKET_DB_VERSION:
+        return
 
-    for p in packets:
-
-        # add metadata
-        p['hash'] = packet_hash(p)
-        p['added'] = datetime.datetime.now().timestamp()
-
-        sql = f'INSERT INTO {db_field}('
-        vals = []
-
-
-        for k, v in p.items():
-            sql+=k + ','
-            if type(v) == list:
-                # Here we're assuming the list is of uint8s. Can
-                # we abstract this better? We could do the array conversion
-                # before this call, and just read the dtype...
-                # vals.append(str(v))
-                # vals.append(sqlite3.Binary(np.array(v,dtype=np.uint8)))
-                vals.append(sqlite3.Binary(np.array(v, dtype=np.uint8)).tobytes())
-                # To reconstruct on the other end, do:
-                # y = np.frombuffer(x, dtype=np.uint8)  
-            elif type(v) == np.uint8:
-                vals.append(int(v))
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        # (Another process may have done it in the meantime)
+        cur.execute('PRAGMA user_version')
+        version = cur.fetchone()[0]
+
+        if version < 1:
+            logger.info('creating packet indexes (this can take a while, on a large database)')
+            for name, cols in PACKET_INDEXES:
+                cur.execute(f'CREATE INDEX IF NOT EXISTS {name} ON packets ({cols})')
+
+        if version < 3:
+            if 'path' not in get_table_columns(conn, 'packets'):
+                cur.execute('ALTER TABLE packets ADD COLUMN path TEXT')
+            cur.execute('CREATE INDEX IF NOT EXISTS packets_path ON packets (path)')
+
+        if version < 4:
+            logger.info('hashing packets')
+            cur.execute('DROP INDEX IF EXISTS packets_hash')
+            if version < 2:
+                rehash_packets(conn)
             else:
-                vals.append(v)
+                rehash_packets(conn, 'header_epoch_sec IS NULL OR header_epoch_sec < 0')
+            removed, collisions = remove_duplicate_packets(conn)
+            logger.info(f'removed {removed} duplicate packets')
+            if collisions:
+                logger.warning(f'{collisions} packets have the same hash as a different packet; '
+                               'kept, without a hash (so later copies of them will be kept too)')
+            cur.execute('CREATE UNIQUE INDEX packets_hash ON packets (hash)')
+
+        cur.execute('ANALYZE')
+
+        cur.execute(f'PRAGMA user_version = {max(version, PACKET_DB_VERSION)}')
+        conn.commit()
+    except Error as e:
+        conn.rollback()
+        logger.warning(f'could not update the packets table; will try again next time ({e})')
 
-        sql = sql[:-1] + ') VALUES(' + ''.join(['?,' for x in p])
-        sql = sql[:-1] + ')'                                           
-        
-        cur = conn.cursor()
-        cur.execute(sql, vals)
-    return cur.lastrowid
+def rehash_packets(conn, where=None, batch_size=100000):
+    '''
+    Recomputes the hash of every packet in the database (or those matching the SQL
+    condition where), batch_size packets at a time (see packet_hashes)
+    '''
+    cur = conn.cursor()
+    last = 0
+    while True:
+        cur.execute(f"SELECT rowid, data, {', '.join(HASH_FIELDS + NO_CCSDS_HASH_FIELDS)} FROM packets "
+                    f"WHERE rowid > ? {f'AND ({where})' if where else ''} ORDER BY rowid LIMIT ?",
+                    (last, batch_size))
+        names = [x[0] for x in cur.description]
+        rows = cur.fetchall()
+        if not rows:
+            break
+        packets = PacketBatch.from_rows(names, rows)
+        rowids = packets['rowid'].tolist()
+        cur.executemany('UPDATE packets SET hash=? WHERE rowid=?', zip(packet_hashes(packets), rowids))
+        last = rowids[-1]
+
+def remove_duplicate_packets(conn):
+    '''
+    Deals with packets which share a hash, so hash can be made a UNIQUE index: a
+    packet which matches an earlier one in every one of PACKET_FIELDS (the same
+    packet, decoded twice) is removed. Packets which only share a hash with a
+    different packet (a collision) are kept, with their hash cleared.
+    Returns the number of packets removed, and the number of collisions.
+    '''
+    cur = conn.cursor()
+    cur.execute('CREATE INDEX packets_hash_dups ON packets (hash)')
+    cur.execute('CREATE TEMP TABLE dup_hashes AS SELECT hash FROM packets GROUP BY hash HAVING COUNT(*) > 1')
+
+    pairs = '''SELECT b.rowid FROM dup_hashes d
+               JOIN packets a ON a.hash = d.hash
+               JOIN packets b ON b.hash = d.hash AND a.rowid < b.rowid'''
+    match = ' AND '.join(f'a.{k} IS b.{k}' for k in PACKET_FIELDS)
+    cur.execute(f'DELETE FROM packets WHERE rowid IN ({pairs} WHERE {match})')
+    removed = cur.rowcount
+    cur.execute(f'UPDATE packets SET hash = NULL WHERE rowid IN ({pairs})')
+    collisions = cur.rowcount
+
+    cur.execute('DROP TABLE dup_hashes')
+    cur.execute('DROP INDEX packets_hash_dups')
+    return removed, collisions
+
+def migrate_files_table(conn, old_columns, create_sql):
+    '''
+    Creates the files table (with create_sql), bringing that of an older database
+    (with old_columns, keyed by file name) up to date: its entries are keyed by
+    path, and the packets decoded from each file are tagged with its path. Files
+    which already have packets in the database, but aren't in the manifest, are
+    listed by name, so they aren't decoded a second time.
+    '''
+    logger = logging.getLogger('migrate_files_table')
+
+    cur = conn.cursor()
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        if old_columns:
+            cur.execute('ALTER TABLE files RENAME TO files_old')
+        cur.execute(create_sql)
+
+        if old_columns:
+            cols = ', '.join(c for c in old_columns if c not in ('fname', 'path'))
+            cur.execute(f'''INSERT OR IGNORE INTO files (path, fname, {cols})
+                            SELECT COALESCE(path, fname), fname, {cols} FROM files_old''')
+            if 'status' not in old_columns:
+                cur.execute("UPDATE files SET status='decoded'")
+            # (Each name was only listed once, so its packets are all from that path)
+            cur.execute('''UPDATE packets SET path = (SELECT path FROM files_old WHERE files_old.fname = packets.fname)
+                           WHERE path IS NULL AND fname IN (SELECT fname FROM files_old WHERE path IS NOT NULL)''')
+            cur.execute('DROP TABLE files_old')
+
+        # (Files listed here without a size can't be checked for changes; they're just skipped)
+        sql = '''INSERT OR IGNORE INTO files (path, fname, status, updated)
+                 SELECT DISTINCT fname, fname, 'decoded', ? FROM packets
+                 WHERE fname IS NOT NULL AND fname NOT IN (SELECT fname FROM files)'''
+        cur.execute(sql, (datetime.datetime.now().timestamp(),))
+        sql = '''UPDATE files SET packet_count =
+                 (SELECT COUNT(*) FROM packets WHERE packets.fname = files.fname)
+                 WHERE packet_count IS NULL'''
+        cur.execute(sql)
+        conn.commit()
+    except Error as e:
+        conn.rollback()
+        logger.warning(f'could not update the file manifest; will try again next time ({e})')
+        return
 
-def get_packets_within_range(database, dtype=None, date_added=None, t1=None, t2=None):
+    cur.execute('SELECT COUNT(*) FROM files')
+    logger.info(f'file manifest updated: {cur.fetchone()[0]} files')
+
+def write_to_db(conn, packets, db_field = 'packets', path=None):
+    '''
+    Insert a batch of packets (a PacketBatch, or list of packet dictionaries) into db_field,
+    using one prepared statement for the whole batch. Each packet is tagged with its
+    hash, the time it was added (the same for the whole batch), and the path of
+    the file it was decoded from, if given; packets already in the database (by hash)
+    are skipped. Runs inside the caller's transaction.
+    Returns the row ID of the last packet inserted.
+    '''
+    logger = logging.getLogger('write_to_db')
+
+    packets = PacketBatch.from_packets(packets)
+    if not len(packets):
+        return None
+
+    # Payloads are bound as BLOBs straight from the payload buffer, without copying
+    names = [k for k in packets.columns if k not in ('hash', 'added', 'path')]
+    buf = memoryview(np.ascontiguousarray(packets.payload))
+    blobs = [buf[a:a + l] for a, l in zip(packets.offsets.tolist(), packets.lengths.tolist())]
+    values = [packets.column_values(k) for k in names]
+
+    # add metadata
+    hashes = packet_hashes(packets, blobs)
+    added = datetime.datetime.now().timestamp()
+
+    sql = f"INSERT OR IGNORE INTO {db_field} (data, {', '.join(names)}, hash, added, path) VALUES ({', '.join('?'*(len(names) + 4))})"
+    cur = conn.cursor()
+    cur.executemany(sql, zip(blobs, *values, hashes, itertools.repeat(added), itertools.repeat(path)))
+    if cur.rowcount < len(packets):
+        logger.info(f'skipped {len(packets) - cur.rowcount} packets already in the database')
+    cur.execute('SELECT last_insert_rowid()')
+    return cur.fetchone()[0]
+
+def get_packets_within_range(database, dtype=None, date_added=None, t1=None, t2=None, added_before=None,
+                             columns=None):
     '''
     Load packets from the database, with header_timestamps between datetimes t1 and t2,
-    and added after date_added, for data type specified by dtype (S, E, B, G, I)
+    and added after date_added (and, if given, no later than added_before),
+    for data type specified by dtype (S, E, B, G, I). Only the given columns are
+    loaded (all of them, if None; include 'data' for the payloads).
+    Returns a PacketBatch, sorted by header_timestamp.
     '''
     logger = logging.getLogger('get_packets_within_range')
 
+    batches = list(iter_packets_within_range(database, dtype=dtype, date_added=date_added, t1=t1, t2=t2,
+                                             added_before=added_before, columns=columns, batch_size=100000))
+    if not batches:
+        packets = PacketBatch.empty([k for k in columns if k != 'data'] if columns else None)
+    elif len(batches) == 1:
+        packets = batches[0]
+    else:
+        packets = PacketBatch.concatenate(batches)
+
+    logger.debug(f'Retrieved {len(packets)} packets from db')
+    return packets
+
+def iter_packets_within_range(database, dtype=None, date_added=None, t1=None, t2=None, added_before=None,
+                              columns=None, batch_size=10000):
+    '''
+    As get_packets_within_range, but yields the packets as they're read from the
+    database, in PacketBatches of up to batch_size packets (in header_timestamp
+    order), so memory use stays the same however long the time range is.
+    '''
     if date_added is None:
         date_added = datetime.datetime.utcfromtimestamp(0)
     if t1 is None:
@@ -144,61 +505,161 @@ def get_packets_within_range(database, dtype=None, date_added=None, t1=None, t2=
     if t2 is None:
         t2 = datetime.datetime.now()
 
-    conn = create_connection(database)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
+    if columns is None:
+        columns = ['data'] + list(HEADER_FIELDS)
+    unknown = [k for k in columns if k != 'data' and k not in HEADER_FIELDS]
+    if unknown:
+        raise ValueError(f'no such packet columns: {unknown}')
+
+    sql = f'''SELECT {', '.join(columns)} FROM packets
+            WHERE header_timestamp > ?
+            AND header_timestamp < ?
+            AND added > ?'''
+    params = [t1.timestamp(), t2.timestamp(), date_added.timestamp()]
     if dtype:
-        sql = '''SELECT DISTINCT * FROM packets 
-                WHERE header_timestamp > ? 
-                AND header_timestamp < ? 
-                AND dtype=?
-                AND added > ?
-                ORDER BY header_timestamp'''
-
-        cur.execute(sql, (t1.timestamp(), t2.timestamp(), dtype, date_added.timestamp()))
-    else:
-        sql = '''SELECT DISTINCT * FROM packets 
-                WHERE header_timestamp > ? 
-                AND header_timestamp < ? 
-                AND added > ?
-                ORDER BY header_timestamp'''
-
-        cur.execute(sql, (t1.timestamp(), t2.timestamp(), date_added.timestamp()))
-
-    rows = cur.fetchall()
-
-    logger.debug(f'Retrieved {np.shape(rows)[0]} packets from db')
-    packets = []
-    for row in rows:
-        p = dict(row)
-        p['data'] = np.frombuffer(p['data'],dtype=np.uint8).tolist()
-        packets.append(p)
-        
-    return packets
+        sql += ' AND dtype=?'
+        params.append(dtype)
+    if added_before is not None:
+        sql += ' AND added <= ?'
+        params.append(added_before.timestamp())
+    sql += ' ORDER BY header_timestamp'
+
+    with db_connection(database) as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield PacketBatch.from_rows(columns, rows)
+        finally:
+            # (Ends the read, even if the caller stops early)
+            cur.close()
 
 
 def get_files_in_db(db_name, db_field):
     try:
         # Get filenames already in the database, so we don't reprocess them:
         sql = '''SELECT DISTINCT fname FROM ''' + db_field
-        conn = create_connection(db_name)
-        cur = conn.cursor()
-        cur.execute(sql)
-        rows = cur.fetchall()
+        with db_connection(db_name) as conn:
+            cur = conn.cursor()
+            cur.execute(sql)
+            rows = cur.fetchall()
         return [x[0] for x in rows]
     except:
         return []
 
+def get_file_manifest(db_name):
+    '''
+    Get the files table, as a dict of path: dict(fname, size, bytes_decoded, updated,
+    mtime, digest, status, packet_count, checksum_failures, data_time). (Files listed before the
+    manifest kept track of paths are keyed by their name alone.)
+    '''
+    try:
+        with db_connection(db_name) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM files')
+            names = [x[0] for x in cur.description]
+            rows = cur.fetchall()
+        return {x[0]: dict(zip(names[1:], x[1:])) for x in rows}
+    except:
+        return dict()
+
+def set_file_entry(conn, path, fname, size, mtime, bytes_decoded, status,
+                   packet_count=0, checksum_failures=0, digest=None, data_time=None):
+    '''
+    Record a telemetry file (by path) in the manifest: its size and modification time when
+    it was decoded, the number of bytes decoded from it (so the next run can resume
+    from there if the file grows), the outcome (status), packet counts, and when its
+    data was recorded.
+    '''
+    sql = '''INSERT OR REPLACE INTO files (path, fname, size, bytes_decoded, updated, mtime,
+                                          digest, status, packet_count, checksum_failures, data_time)
+             VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    cur = conn.cursor()
+    cur.execute(sql, (path, fname, size, bytes_decoded, datetime.datetime.now().timestamp(),
+                      mtime, digest, status, packet_count, checksum_failures, data_time))
+
+def set_file_data_times(conn, files):
+    '''
+    Record roughly when the data in each of files was recorded, as a list of
+    (path, fname, size, mtime, data_time) tuples, so it's only worked out once.
+    Files which aren't in the manifest yet are listed as pending.
+    '''
+    sql = '''INSERT INTO files (path, fname, size, bytes_decoded, updated, mtime, status, data_time)
+             VALUES(?, ?, ?, 0, ?, ?, 'pending', ?)
+             ON CONFLICT (path) DO UPDATE SET data_time=excluded.data_time'''
+    now = datetime.datetime.now().timestamp()
+    cur = conn.cursor()
+    cur.executemany(sql, [(path, fname, size, now, mtime, data_time) for path, fname, size, mtime, data_time in files])
+
+def delete_file_packets(conn, path):
+    '''
+    Remove all packets decoded from the file at path (e.g., before decoding a changed file again)
+    '''
+    cur = conn.cursor()
+    cur.execute('DELETE FROM packets WHERE path=?', (path,))
+    return cur.rowcount
+
+def get_packet_summary(db_name, bin_size=3600):
+    '''
+    The number of packets, and the latest time one was added, for each data type
+    and bin_size-second span of header timestamps, as a dict of
+    (dtype, bin index): (count, max added). Bin i covers header timestamps
+    [i*bin_size, (i + 1)*bin_size).
+    '''
+    sql = '''SELECT dtype, CAST(header_timestamp / ? AS INTEGER), COUNT(*), MAX(added)
+             FROM packets WHERE header_timestamp > 0
+             GROUP BY 1, 2'''
+    with db_connection(db_name) as conn:
+        cur = conn.cursor()
+        cur.execute(sql, (bin_size,))
+        rows = cur.fetchall()
+    return {(r[0], r[1]): (r[2], r[3]) for r in rows}
+
+def get_task_records(db_name):
+    '''
+    Get the tasks table, as a dict of (stage, day): dict(version, status, updated, completed)
+    '''
+    try:
+        with db_connection(db_name) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM tasks')
+            names = [x[0] for x in cur.description]
+            rows = cur.fetchall()
+        return {(x[0], x[1]): dict(zip(names[2:], x[2:])) for x in rows}
+    except:
+        return dict()
+
+def set_task_record(conn, stage, day, version, status, completed=None):
+    '''
+    Record the outcome (status) of a processing task: a stage, run for one UTC day
+    (YYYY-MM-DD), on the given version of its packet data. completed is the
+    time of the last successful run.
+    '''
+    sql = '''INSERT OR REPLACE INTO tasks (stage, day, version, status, updated, completed)
+             VALUES(?, ?, ?, ?, ?, ?)'''
+    cur = conn.cursor()
+    cur.execute(sql, (stage, day, version, status, datetime.datetime.now().timestamp(), completed))
+    conn.commit()
+
 def get_last_access_time(db_name, source_str):
     '''
-     Get the time of the last access entry for source_str.
+     Get the time of the last access entry for source_str
+     (0 if there isn't one, or the log hasn't been written yet).
     '''
+    if not os.path.exists(db_name):
+        return 0
+
     sql = f'SELECT * FROM log WHERE source="{source_str}"'
-    conn = create_connection(db_name)
-    cur = conn.cursor()
-    cur.execute(sql)
-    rows = cur.fetchall()
+    with db_connection(db_name) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='log'")
+        if cur.fetchone() is None:
+            return 0
+        cur.execute(sql)
+        rows = cur.fetchall()
     if rows:
         return max([r[0] for r in rows])
     else:
@@ -209,10 +670,10 @@ def get_time_range_for_updated_packets(db_name, ts):
     # Get header timestamps corresponding to newly-added packets:
     
     sql = f'SELECT header_timestamp FROM packets WHERE added > {ts}'
-    conn = create_connection(db_name)
-    cur = conn.cursor()
-    cur.execute(sql)
-    rows = cur.fetchall()
+    with db_connection(db_name) as conn:
+        cur = conn.cursor()
+        cur.execute(sql)
+        rows = cur.fetchall()
     if len(rows) < 1:
         # print(f'No packets added after {datetime.datetime.utcfromtimestamp(ts)}')
         return None, None
@@ -239,14 +700,10 @@ def log_access_time(db_name, source_str, desc_str=None):
                                     description TEXT
                                 ); """
 
-    conn = create_connection(db_name)
-    cur = conn.cursor()
-    cur.execute(sql_create_log_table)
-
     sql = f'INSERT INTO log (timestamp, time_str, source, description) VALUES(?, ?, ?, ?)'
-    cur = conn.cursor()
     t = datetime.datetime.now()
-    cur.execute(sql,(t.timestamp(), t.isoformat(), source_str, desc_str))
-    conn.commit()
-    conn.close()
+    with db_connection(db_name, read_only=False) as conn:
+        cur = conn.cursor()
+        cur.execute(sql_create_log_table)
+        cur.execute(sql,(t.timestamp(), t.isoformat(), source_str, desc_str))
     
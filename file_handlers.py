@@ -6,9 +6,20 @@ import datetime
 import os
 import logging
 import gzip
+import bz2
+import lzma
+import zipfile
 import pickle
+import io
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor, Future
 import scipy.io as spio
 
+# Telemetry file types, and the compressed formats we can read them from
+TELEMETRY_TYPES = ('.tlm', '.csv')
+COMPRESSED_TYPES = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
 def write_status_XML(in_data, filename="status_messages.xml"):
     '''write status messages to an xml file'''
 
@@ -406,6 +417,98 @@ def load_packets_from_tree(raw_root):
     return packets
 
 
+def telemetry_type(fname):
+    ''' The kind of telemetry file fname is: '.tlm' or '.csv' (including compressed
+        ones, e.g. .tlm.gz or .csv.xz), '.zip' for zip archives, or None '''
+    base, ext = os.path.splitext(fname)
+    if ext == '.zip':
+        return ext
+    if ext in COMPRESSED_TYPES:
+        base, ext = os.path.splitext(base)
+    return ext if ext in TELEMETRY_TYPES else None
+
+
+def iter_telemetry_streams(fpath, data=None):
+    ''' Opens a telemetry file for reading, decompressing it on the fly if needed
+        (nothing is written to disk). Yields (name, file object) for each .tlm or .csv
+        file inside -- just the one, unless fpath is a zip archive. If the file has
+        already been read into memory (e.g., by prefetch), pass its contents as data.
+    '''
+    logger = logging.getLogger(__name__ + '.iter_telemetry_streams')
+
+    ext = os.path.splitext(fpath)[1]
+    source = fpath if data is None else io.BytesIO(data)
+    if ext == '.zip':
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or telemetry_type(name) not in TELEMETRY_TYPES:
+                    logger.debug(f'skipping {info.filename} in {fpath}')
+                    continue
+                with archive.open(info) as member:
+                    member_ext = os.path.splitext(name)[1]
+                    if member_ext in COMPRESSED_TYPES:
+                        # (Compressed files inside the archive)
+                        with COMPRESSED_TYPES[member_ext](member, 'rb') as f:
+                            yield os.path.splitext(name)[0], f
+                    else:
+                        yield name, member
+
+    elif ext in COMPRESSED_TYPES:
+        with COMPRESSED_TYPES[ext](source, 'rb') as f:
+            yield os.path.splitext(os.path.basename(fpath))[0], f
+
+    elif data is not None:
+        yield os.path.basename(fpath), source
+
+    else:
+        with open(fpath, 'rb') as f:
+            yield os.path.basename(fpath), f
+
+
+def read_file(fpath):
+    ''' The contents of a file, as bytes '''
+    with open(fpath, 'rb') as f:
+        return f.read()
+
+
+def prefetch(items, load, read_ahead=4):
+    '''
+    Yields (item, future) for each of items, in order, where future.result() is
+    load(item) (or raises whatever load raised). The loads run on a pool of
+    read_ahead threads, up to read_ahead items ahead of the caller: while one
+    file is being decoded or plotted, the next few are being read in (e.g.,
+    from a network share). read_ahead = 0 loads each item as it's reached.
+    '''
+    if read_ahead < 1:
+        for item in items:
+            future = Future()
+            try:
+                future.set_result(load(item))
+            except Exception as e:
+                future.set_exception(e)
+            yield item, future
+        return
+
+    items = iter(items)
+    pool = ThreadPoolExecutor(max_workers=read_ahead)
+    queue = collections.deque()
+    try:
+        for item in itertools.islice(items, read_ahead):
+            queue.append((item, pool.submit(load, item)))
+        while queue:
+            item, future = queue.popleft()
+            # Keep read_ahead loads going behind this one
+            for next_item in itertools.islice(items, 1):
+                queue.append((next_item, pool.submit(load, next_item)))
+            yield item, future
+    finally:
+        # (If the caller stops early, don't wait on reads nobody needs)
+        for item, future in queue:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
 def loadmat(filename, var_names = None):
     '''
     this function should be called instead of direct spio.loadmat
@@ -9,7 +9,7 @@ import numpy as np
 from configparser import ConfigParser
 
 
-from file_handlers import read_status_XML, read_burst_XML, read_survey_XML, write_survey_XML
+from file_handlers import read_status_XML, read_burst_XML, read_survey_XML, write_survey_XML, prefetch
 from data_handlers import decode_packets_TLM, decode_packets_CSV, decode_survey_data
 # from db_handlers import log_access_time, get_last_access_time
 from cli_plots import plot_survey_data_and_metadata
@@ -43,7 +43,7 @@ def get_timestamp(x):
 
 def generate_survey_quicklooks(in_root, out_root, 
         start_date=None, stop_date=None, plot_length=3, last_run_time=None,
-        line_plots = ['Lshell','altitude','lat','lon','solution_status','daylight']):
+        line_plots = ['Lshell','altitude','lat','lon','solution_status','daylight'], read_ahead=4):
 
     logger = logging.getLogger('generate_survey_quicklooks')
 
@@ -58,6 +58,8 @@ def generate_survey_quicklooks(in_root, out_root,
     # edges for plot times
     hour_segs = np.arange(21,23,1)
 
+    # Find the survey files to plot
+    to_do = []
     for root, dirs, files in os.walk(in_root):
         for fname in files:
             if fname.startswith('VPM_survey_data_') and fname.endswith('.xml'):
@@ -68,39 +70,51 @@ def generate_survey_quicklooks(in_root, out_root,
                 else:
                     day = datetime.datetime.strptime(fname, 'VPM_survey_data_%Y-%m-%d.xml')
                     if (day >= start_date) and (day <= stop_date):
-
-                        filename = os.path.join(root, fname)
-                        print(f'Loading {filename}')
-                        S_data = read_survey_XML(filename)
-                        formatS = S_data[0]
-
-                        #for h1,h2 in zip(hour_segs[:-1], hour_segs[1:]):
-                        d1 = day + datetime.timedelta(hours=21,minutes=15)
-                        d2 = day + datetime.timedelta(hours=21,minutes=30)
-                        t1 = d1.replace(tzinfo = datetime.timezone.utc).timestamp()
-                        t2 = d2.replace(tzinfo = datetime.timezone.utc).timestamp()
-                        S_filt = list(filter(lambda x: (get_timestamp(x) >= t1) and (get_timestamp(x) < t2), S_data))
-                        
-                        outdir = os.path.join(out_root,f'{day.year}','{:02d}'.format(day.month))
-
-                        if S_filt:            
-                            fig = plot_survey_data_and_metadata(S_filt,t1=d1, t2=d2,
-                                            line_plots = [1],
-                                            show_plots=True, lshell_file='resources/Lshell_dict.pkl')
-                            
-                            fig.suptitle(f"VPM Survey Data: {day.strftime('%D')}\n" +\
-                                    f"{d1.strftime('%H:%M:%S')} -- {d2.strftime('%H:%M:%S')} UT \n gain = " + formatS['gain'] + ", filter = " + formatS['filter'])
-                            
-                            if not os.path.exists(outdir):
-                                os.makedirs(outdir)
-                            
-                            outfile = os.path.join(outdir,
-                                        f"VPM_survey_data_{d1.strftime('%Y-%m-%d_%H%M--')}{d2.strftime('%H%M')}.png")
-
-                            fig.savefig(outfile, dpi=120)
-
-                            plt.close(fig)
-
+                        to_do.append((os.path.join(root, fname), day))
+
+    # Read the next few files in while each one is plotted
+    for (filename, day), S_data in prefetch(to_do, lambda x: read_survey_XML(x[0]), read_ahead):
+        print(f'Loading {filename}')
+        S_data = S_data.result()
+        formatS = S_data[0]
+
+        #for h1,h2 in zip(hour_segs[:-1], hour_segs[1:]):
+        d1 = day + datetime.timedelta(hours=21,minutes=15)
+        d2 = day + datetime.timedelta(hours=21,minutes=30)
+        t1 = d1.replace(tzinfo = datetime.timezone.utc).timestamp()
+        t2 = d2.replace(tzinfo = datetime.timezone.utc).timestamp()
+        S_filt = list(filter(lambda x: (get_timestamp(x) >= t1) and (get_timestamp(x) < t2), S_data))
+        
+        outdir = os.path.join(out_root,f'{day.year}','{:02d}'.format(day.month))
+
+        if S_filt:            
+            fig = plot_survey_data_and_metadata(S_filt,t1=d1, t2=d2,
+                            line_plots = [1],
+                            show_plots=True, lshell_file='resources/Lshell_dict.pkl')
+            
+            fig.suptitle(f"VPM Survey Data: {day.strftime('%D')}\n" +\
+                    f"{d1.strftime('%H:%M:%S')} -- {d2.strftime('%H:%M:%S')} UT \n gain = " + formatS['gain'] + ", filter = " + formatS['filter'])
+            
+            if not os.path.exists(outdir):
+                os.makedirs(outdir)
+            
+            outfile = os.path.join(outdir,
+                        f"VPM_survey_data_{d1.strftime('%Y-%m-%d_%H%M--')}{d2.strftime('%H%M')}.png")
+
+            fig.savefig(outfile, dpi=120)
+
+            plt.close(fig)
+
+
+
+def generate_survey_quicklooks_day(day, in_root, out_root, **kwargs):
+    '''
+    Generate the quicklooks for one UTC day (a timezone-aware datetime at midnight),
+    whatever the age of its survey file. Run per day by process_pipeline. Other keyword
+    arguments are passed on to generate_survey_quicklooks.
+    '''
+    day = day.replace(tzinfo=None)
+    generate_survey_quicklooks(in_root, out_root, start_date=day, stop_date=day, **kwargs)
 
 
 def main():
@@ -124,6 +138,7 @@ def main():
     out_root = os.path.join(config['db_locations']['survey_tree_root'],'figures')
     line_plots = [x.strip() for x in config['survey_config']['line_plots'].split(',')]
     plot_length = int(config['survey_config']['plot_length'])
+    read_ahead = config.getint('survey_config', 'read_ahead', fallback=0)
     packet_db_file = config['db_locations']['packet_db_file']
     access_log = config['logging']['access_log']
 
@@ -132,7 +147,7 @@ def main():
 
     logging.info(f'Last ran at {last_run_time}')
     generate_survey_quicklooks(in_root, out_root, line_plots = line_plots, 
-        plot_length=plot_length, last_run_time=last_run_time)
+        plot_length=plot_length, last_run_time=last_run_time, read_ahead=read_ahead)
 
     # Success!
     log_access_time(access_log,"generate_survey_quicklooks")
@@ -0,0 +1,256 @@
+import numpy as np
+
+
+# Per-packet header fields, in the order they're stored in the packet database,
+# with the numpy type of each column and the placeholder used for missing values
+# (e.g., CSV packets have no CCSDS header; TLM packets have no file_index).
+HEADER_FIELDS = {
+    'start_ind':        (np.int64, -1),
+    'dtype':            ('U1', ''),
+    'exp_num':          (np.int64, -1),
+    'bytecount':        (np.int64, -1),
+    'checksum_verify':  (np.bool_, False),
+    'packet_length':    (np.int64, -1),
+    'fname':            (object, None),
+    'header_timestamp': (np.float64, np.nan),
+    'file_index':       (np.int64, -1),
+    'hash':             (np.int64, -1),
+    'header_ns':        (np.int64, -1),
+    'header_epoch_sec': (np.int64, -1),
+    'header_reboots':   (np.int64, -1),
+    'added':            (np.float64, np.nan),
+}
+
+
+def _as_uint8(data):
+    ''' A packet payload (list of ints, bytes, or array) as a uint8 array '''
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return np.frombuffer(data, dtype=np.uint8)
+    return np.asarray(data, dtype=np.uint8)
+
+
+def _column_values(name, vals):
+    ''' Replaces missing (None) values in a column with its placeholder '''
+    missing = HEADER_FIELDS[name][1] if name in HEADER_FIELDS else None
+    # (Older databases hold some numpy scalars, e.g. checksum_verify, as raw bytes)
+    return [missing if v is None else
+            int.from_bytes(v, 'little', signed=True) if isinstance(v, bytes) else
+            v for v in vals]
+
+
+def _gather_indices(offsets, lengths):
+    ''' Indices of every byte in the segments [offsets, offsets + lengths), end-to-end '''
+    total = int(np.sum(lengths))
+    starts = np.cumsum(lengths) - lengths
+    return np.arange(total, dtype=np.int64) + np.repeat(offsets - starts, lengths)
+
+
+class PacketBatch:
+    '''
+    A set of decoded packets, stored as columns rather than a list of dictionaries:
+    each header field is a numpy array with one entry per packet, and the packet
+    payloads are packed end-to-end in a single uint8 buffer, indexed by offsets
+    and lengths.
+
+    Selecting packets (by index, boolean mask, slice, or one of the by_dtype /
+    in_time_range / group_by_exp_num / sort views) shares the payload buffer,
+    rather than copying it.
+
+    For compatibility with code written for lists of packets, iterating over a
+    batch yields one dictionary per packet, with the same fields as before.
+    Each packet's 'data' is a read-only uint8 view into the payload buffer.
+    '''
+
+    def __init__(self, payload, offsets, lengths, columns):
+        self.payload = np.asarray(payload, dtype=np.uint8).view()
+        self.payload.flags.writeable = False
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.columns = dict()
+        for k, v in columns.items():
+            self.columns[k] = np.asarray(v, dtype=HEADER_FIELDS[k][0] if k in HEADER_FIELDS else None)
+            if len(self.columns[k]) != len(self.offsets):
+                raise ValueError(f'column {k} has {len(self.columns[k])} entries, for {len(self.offsets)} packets')
+
+    # ---------------- Construction -----------------
+    @classmethod
+    def empty(cls, columns=None):
+        ''' A batch with no packets '''
+        cols = dict()
+        for k in (columns if columns is not None else HEADER_FIELDS):
+            cols[k] = np.zeros(0, dtype=HEADER_FIELDS[k][0] if k in HEADER_FIELDS else object)
+        return cls(np.zeros(0, dtype=np.uint8), np.zeros(0), np.zeros(0), cols)
+
+    @classmethod
+    def from_packets(cls, packets):
+        ''' Builds a batch from a list of packet dictionaries. Batches are passed through as-is. '''
+        if isinstance(packets, PacketBatch):
+            return packets
+
+        packets = list(packets)
+        if not packets:
+            return cls.empty()
+        payloads = [_as_uint8(p['data']) for p in packets]
+        lengths = np.array([len(x) for x in payloads], dtype=np.int64)
+        payload = np.concatenate(payloads) if payloads else np.zeros(0, dtype=np.uint8)
+
+        # Every field present in any packet; keep the database column order
+        keys = set()
+        for p in packets:
+            keys.update(p.keys())
+        keys.discard('data')
+        keys = [k for k in HEADER_FIELDS if k in keys] + sorted(k for k in keys if k not in HEADER_FIELDS)
+
+        columns = {k: _column_values(k, [p.get(k) for p in packets]) for k in keys}
+        return cls(payload, np.cumsum(lengths) - lengths, lengths, columns)
+
+    @classmethod
+    def from_rows(cls, names, rows):
+        '''
+        Builds a batch from database rows (sequences of values, in the order of names).
+        The payload BLOBs are joined straight into the payload buffer, without
+        converting each one to an array first. Without a 'data' column, every
+        packet has an empty payload.
+        '''
+        if not rows:
+            return cls.empty()
+
+        values = dict(zip(names, zip(*rows)))
+        blobs = values.pop('data', None)
+        if blobs is not None:
+            lengths = np.fromiter(map(len, blobs), dtype=np.int64, count=len(blobs))
+            payload = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+        else:
+            # (Header fields only)
+            lengths = np.zeros(len(rows), dtype=np.int64)
+            payload = np.zeros(0, dtype=np.uint8)
+
+        columns = {k: _column_values(k, v) for k, v in values.items()}
+        return cls(payload, np.cumsum(lengths) - lengths, lengths, columns)
+
+    @classmethod
+    def concatenate(cls, batches):
+        ''' Joins several batches (or lists of packets) into one, with a new, compacted payload buffer '''
+        batches = [cls.from_packets(b) for b in batches]
+        batches = [b for b in batches if len(b)] or batches[:1]
+        if not batches:
+            return cls.empty()
+
+        keys = []
+        for b in batches:
+            keys.extend(k for k in b.columns if k not in keys)
+
+        payload = np.concatenate([b.payload[_gather_indices(b.offsets, b.lengths)] for b in batches])
+        lengths = np.concatenate([b.lengths for b in batches])
+
+        columns = dict()
+        for k in keys:
+            dtype, missing = HEADER_FIELDS.get(k, (object, None))
+            columns[k] = np.concatenate([b.columns[k] if k in b.columns else
+                                         np.full(len(b), missing, dtype=dtype) for b in batches])
+        return cls(payload, np.cumsum(lengths) - lengths, lengths, columns)
+
+    # ---------------- Access -----------------
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return f'PacketBatch({len(self)} packets, {len(self.payload)} payload bytes, columns={list(self.columns)})'
+
+    def keys(self):
+        return ['data'] + list(self.columns)
+
+    def data(self, ind):
+        ''' The payload of packet ind (a read-only view) '''
+        return self.payload[self.offsets[ind]:self.offsets[ind] + self.lengths[ind]]
+
+    def __getitem__(self, key):
+        ''' batch['field'] returns a column; batch[int] returns a packet dictionary;
+            batch[slice / mask / index array] returns a new batch '''
+        if isinstance(key, str):
+            if key == 'data':
+                return [self.data(i) for i in range(len(self))]
+            return self.columns[key]
+        if isinstance(key, (int, np.integer)):
+            return self.to_packets(np.arange(len(self))[key:key + 1 or None])[0]
+
+        return PacketBatch(self.payload, self.offsets[key], self.lengths[key],
+                           {k: v[key] for k, v in self.columns.items()})
+
+    def __iter__(self):
+        return iter(self.to_packets())
+
+    def column_values(self, key, inds=None):
+        ''' A column (or the entries at inds) as a list of python values, with None for missing values '''
+        vals = self.columns[key] if inds is None else self.columns[key][inds]
+        vals = vals.tolist()
+        missing = HEADER_FIELDS.get(key, (None, None))[1]
+        if missing is not None:
+            if isinstance(missing, float):
+                vals = [None if x != x else x for x in vals]
+            elif missing != '' and missing is not False:
+                vals = [None if x == missing else x for x in vals]
+        return vals
+
+    def to_packets(self, inds=None):
+        ''' Converts the batch (or the packets at inds) back to a list of packet dictionaries '''
+        if inds is None:
+            inds = np.arange(len(self))
+
+        fields = {k: self.column_values(k, inds) for k in self.columns}
+
+        packets = []
+        for n, (a, l) in enumerate(zip(self.offsets[inds].tolist(), self.lengths[inds].tolist())):
+            p = dict()
+            p['data'] = self.payload[a:a + l]
+            for k, vals in fields.items():
+                p[k] = vals[n]
+            packets.append(p)
+        return packets
+
+    # ---------------- Views -----------------
+    def by_dtype(self, dtypes):
+        ''' Packets with data type in dtypes (e.g., 'S', or 'EBG') '''
+        return self[np.isin(self.columns['dtype'], list(dtypes))]
+
+    def in_time_range(self, t1=None, t2=None):
+        ''' Packets with t1 <= header_timestamp <= t2 (unix timestamps; None for no limit) '''
+        ts = self.columns['header_timestamp']
+        mask = np.ones(len(self), dtype=bool)
+        if t1 is not None:
+            mask &= ts >= t1
+        if t2 is not None:
+            mask &= ts <= t2
+        return self[mask]
+
+    def group_by_exp_num(self):
+        ''' A dictionary of exp_num: batch, in order of experiment number.
+            Packets keep their current order within each group. '''
+        order = np.argsort(self.columns['exp_num'], kind='stable')
+        e_nums, starts = np.unique(self.columns['exp_num'][order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        return {e: self[order[a:b]] for e, a, b in zip(e_nums.tolist(), starts, stops)}
+
+    def sort(self, key='header_timestamp'):
+        ''' The batch, sorted by a column (stable, so ties keep their current order) '''
+        return self[np.argsort(self.columns[key], kind='stable')]
+
+    # ---------------- Reassembly -----------------
+    def reassemble(self, length=None):
+        '''
+        Places each packet's payload at [start_ind, start_ind + len(data)] in a float
+        array of the given length (by default, just long enough to hold every packet).
+        Any bytes not covered by a packet are left as NaN. Raises ValueError if a
+        packet extends past the end of the array.
+        '''
+        ends = self.columns['start_ind'] + self.lengths
+        if length is None:
+            length = int(ends.max()) if len(self) else 0
+        elif len(self) and ends.max() > length:
+            raise ValueError(f'packet data extends past the end of the output array ({ends.max()} > {length})')
+
+        out = np.zeros(length)*np.nan
+        src = _gather_indices(self.offsets, self.lengths)
+        dst = src + np.repeat(self.columns['start_ind'] - self.offsets, self.lengths)
+        out[dst] = self.payload[src]
+        return out
@@ -6,10 +6,13 @@ import gzip
 from scipy.io import savemat
 from configparser import ConfigParser
 import numpy as np
+from functools import partial
 from file_handlers import load_packets_from_tree
 from file_handlers import read_burst_XML, write_burst_XML
 from data_handlers import decode_status, decode_uBBR_command, decode_burst_command, process_burst
-from db_handlers import get_packets_within_range
+from data_handlers import check_GPS_command_echo
+from db_handlers import get_packets_within_range, iter_packets_within_range
+from packet_batch import PacketBatch
 from log_handlers import get_last_access_time, log_access_time
 from cli_plots import plot_burst_data, plot_burst_map, plot_burst_inc
 from compute_ground_track import fill_missing_GPS_entries
@@ -19,7 +22,13 @@ import matplotlib.pyplot as plt
 import logging
 
 
-def get_burst_pairs(packet_db, t1=None, t2=None, date_added=None, max_lookback_time=datetime.timedelta(hours=2)):
+def is_burst_status(packets):
+    ''' A mask of the status packets in a PacketBatch which were sent around a burst (source 'B') '''
+    mask = packets.lengths > 3
+    mask[mask] = packets.payload[packets.offsets[mask] + 3] == ord('B')
+    return mask
+
+def get_burst_pairs(packet_db, t1=None, t2=None, date_added=None, max_lookback_time=datetime.timedelta(hours=2), shared=None):
     ''' Find pairs of status packets which might be headers + footers for burst data.
         if date_added is provided, only do packets added to database after date_added.
         
@@ -27,10 +36,20 @@ def get_burst_pairs(packet_db, t1=None, t2=None, date_added=None, max_lookback_t
         Any lone packets will be treated as a footer packet, since typically the data
         is missing the header only. In this case, we'll injest any packets between the
         footer timestamp, and max_lookback_time previous.
+
+        If shared (a process_pipeline.SharedPackets) is provided, packets are read from it
+        rather than the database, where it holds them.
     '''
     logger = logging.getLogger('get_burst_pairs')
 
-    I_packets = get_packets_within_range(packet_db, dtype='I',t1=t1, t2=t2, date_added=date_added)
+    if shared is not None:
+        I_packets = shared.get_packets_within_range(dtype='I',t1=t1, t2=t2, date_added=date_added)
+    else:
+        # Streamed from the database, keeping only the burst status packets (and only
+        # the columns decode_status needs), so a long time range doesn't fill memory
+        batches = iter_packets_within_range(packet_db, dtype='I', t1=t1, t2=t2, date_added=date_added,
+                                            columns=['data', 'dtype', 'bytecount', 'header_timestamp'])
+        I_packets = PacketBatch.concatenate([b[is_burst_status(b)] for b in batches])
 
     if not I_packets:
         return []
@@ -80,10 +99,10 @@ def get_burst_pairs(packet_db, t1=None, t2=None, date_added=None, max_lookback_t
 
     return pairs
 
-def process_bursts_from_database(packet_db, pairs, max_lookback_time=datetime.timedelta(hours=2)):
+def process_bursts_from_database(packet_db, pairs, max_lookback_time=datetime.timedelta(hours=2), shared=None):
 
     ''' Decode bursts from the packet database, between a list of status packet tuples defined by pairs.
-        pairs is generated by get_burst_pairs().
+        pairs is generated by get_burst_pairs(). As there, packets are read from shared, if provided.
     '''
     logger = logging.getLogger('process_bursts_from_database')
 
@@ -102,10 +121,12 @@ def process_bursts_from_database(packet_db, pairs, max_lookback_time=datetime.ti
         
         
         # Load the rest of the packets within the time interval
-        statcheck = get_packets_within_range(packet_db, dtype='I', t1 = ta, t2 = tb)
-        E_packets = get_packets_within_range(packet_db, dtype='E', t1 = ta, t2 = tb)
-        B_packets = get_packets_within_range(packet_db, dtype='B', t1 = ta, t2 = tb)
-        G_packets = get_packets_within_range(packet_db, dtype='G', t1 = ta, t2 = tb)
+        load = shared.get_packets_within_range if shared is not None else \
+               partial(get_packets_within_range, packet_db)
+        statcheck = load(dtype='I', t1 = ta, t2 = tb)
+        E_packets = load(dtype='E', t1 = ta, t2 = tb)
+        B_packets = load(dtype='B', t1 = ta, t2 = tb)
+        G_packets = load(dtype='G', t1 = ta, t2 = tb)
 
         # Skip if there's no data to process
         if not E_packets and not B_packets and not G_packets:
@@ -115,20 +136,16 @@ def process_bursts_from_database(packet_db, pairs, max_lookback_time=datetime.ti
         logger.info(f'burst between {ta} and {tb} (dt = {tb - ta})')
         logger.info(f'loaded {len(E_packets)} E packets, {len(B_packets)} B packets, {len(G_packets)} GPS packets, and {len(statcheck)} status packets')
 
-        avail_exp_nums = np.unique([x['exp_num'] for x in (E_packets + B_packets + G_packets)])
+        burst_packets = PacketBatch.concatenate([E_packets, B_packets, G_packets])
+        packets_by_e_num = burst_packets.group_by_exp_num()
 
-        logger.debug(f'Available experiment nums: {avail_exp_nums}')
+        logger.debug(f'Available experiment nums: {list(packets_by_e_num)}')
 
 
-        for e_num in avail_exp_nums:
+        for e_num, packets_to_process in packets_by_e_num.items():
             try:
                 # Check echo'd command in the GPS packet
-                for gg in filter(lambda p: p['exp_num'] == e_num, G_packets):
-                    if gg['start_ind'] ==0:
-                        cmd_gps = np.flip(gg['data'][0:3])
-                        logger.debug(f'gps command: {cmd_gps}')
-                        if (IB['prev_burst_command'] != cmd_gps).any():
-                            logger.warning("GPS and status command echo mismatch")
+                check_GPS_command_echo(packets_to_process, IB['prev_burst_command'])
 
 
                 # Get burst configuration parameters:
@@ -137,7 +154,6 @@ def process_bursts_from_database(packet_db, pairs, max_lookback_time=datetime.ti
 
                 logger.debug(f'burst configuration: {burst_config}')
 
-                packets_to_process = list(filter(lambda p: p['exp_num'] == e_num, E_packets + B_packets + G_packets))
                 processed = process_burst(packets_to_process, burst_config)
 
 
@@ -148,7 +164,7 @@ def process_bursts_from_database(packet_db, pairs, max_lookback_time=datetime.ti
                     processed['header_timestamp'] = IA['header_timestamp']
                 else:
                     processed['status'] = [IB]
-                    processed['header_timestamp'] = min([x['header_timestamp'] for x in (E_packets + B_packets + G_packets)])
+                    processed['header_timestamp'] = float(np.min(burst_packets['header_timestamp']))
                 processed['experiment_number'] = e_num
 
                 completed_bursts.append(processed)
@@ -265,7 +281,57 @@ def gen_burst_plots(bursts, out_root, do_plots=True, do_maps=False,
         #            logger.warning('Problem plotting burst map')
         #except:
         #    logger.warning(f'Problem plotting burst {ind}')
-def main():
+def process_burst_pairs(packet_db, pairs, out_root, file_types, max_lookback_time=datetime.timedelta(hours=2),
+                        fill_GPS=True, do_plots=True, do_maps=False, dpi=150,
+                        cal_file=None, TLE_file=None, TX_file=None, shared=None):
+    ''' Decode, save and plot the bursts for each pair from get_burst_pairs(), one by one '''
+    logger = logging.getLogger('process_burst_pairs')
+
+    # Check each pair one by one, and saving + plotting as we go
+    for index, pair in enumerate(pairs):
+        logger.info(f'Doing pair {index}:')
+
+        # Process
+        bursts = process_bursts_from_database(packet_db, [pair], max_lookback_time=max_lookback_time, shared=shared)
+
+        # Replace any bad GPS positions with TLE-propagated data
+        if fill_GPS:
+            for B in bursts:
+                fill_missing_GPS_entries(B['G'])
+
+
+        # Save output files    
+        save_burst_to_file_tree(bursts, out_root, file_types)
+
+        # Plot
+        if do_plots or do_maps:
+            gen_burst_plots(bursts, out_root, do_plots=do_plots,
+                     do_maps=do_maps, dpi=dpi, cal_file=cal_file,
+                     TLE_file=TLE_file, TX_file=TX_file)
+
+def process_burst_day(day, packet_db, out_root, file_types, date_added=None,
+                      max_lookback_time=datetime.timedelta(hours=2), shared=None, **kwargs):
+    '''
+    Decode, save and plot the bursts whose footer status packet has a header timestamp
+    on one UTC day (a timezone-aware datetime at midnight), and was added to the database
+    after date_added. Run per day by process_pipeline; packets are read from shared
+    (a process_pipeline.SharedPackets), if provided. Other keyword arguments are passed
+    on to process_burst_pairs.
+    '''
+    logger = logging.getLogger('process_burst_day')
+
+    # (Starting early enough to find the headers of any bursts which span midnight)
+    t1 = day - max_lookback_time
+    t2 = day + datetime.timedelta(days=1)
+    pairs = get_burst_pairs(packet_db, t1=t1, t2=t2, date_added=date_added,
+                            max_lookback_time=max_lookback_time, shared=shared)
+    pairs = [p for p in pairs if p[1]['header_timestamp'] >= day.timestamp()]
+    logger.info(f"{len(pairs)} sets to check for {day.strftime('%Y-%m-%d')}")
+
+    process_burst_pairs(packet_db, pairs, out_root, file_types, max_lookback_time=max_lookback_time,
+                        shared=shared, **kwargs)
+
+def main(shared=None):
 
     # -------- Load configuration file --------
     config = ConfigParser()
@@ -317,7 +383,7 @@ def main():
     logging.info(f'file types: {file_types}')
     logging.info(f'Out root: {out_root}')
     # Get any sets of headers / footers to check:
-    pairs = get_burst_pairs(packet_db, date_added=last_time, max_lookback_time=max_lookback_time)
+    pairs = get_burst_pairs(packet_db, date_added=last_time, max_lookback_time=max_lookback_time, shared=shared)
 
     if not pairs:
         logging.info(f'No new burst data to decode')
@@ -325,27 +391,9 @@ def main():
 
         logging.info(f'Have {len(pairs)} sets to check')
 
-        # Check each pair one by one, and saving + plotting as we go
-        for index, pair in enumerate(pairs):
-            logging.info(f'Doing pair {index}:')
-
-            # Process
-            bursts = process_bursts_from_database(packet_db, [pair], max_lookback_time=max_lookback_time)
-
-            # Replace any bad GPS positions with TLE-propagated data
-            if fill_GPS:
-                for B in bursts:
-                    fill_missing_GPS_entries(B['G'])
-
-
-            # Save output files    
-            save_burst_to_file_tree(bursts, out_root, file_types)
-
-            # Plot
-            if do_plots or do_maps:
-                gen_burst_plots(bursts, out_root, do_plots=do_plots,
-                         do_maps=do_maps, dpi=dpi, cal_file=cal_file,
-                         TLE_file=TLE_file, TX_file=TX_file)
+        process_burst_pairs(packet_db, pairs, out_root, file_types, max_lookback_time=max_lookback_time,
+                            fill_GPS=fill_GPS, do_plots=do_plots, do_maps=do_maps, dpi=dpi,
+                            cal_file=cal_file, TLE_file=TLE_file, TX_file=TX_file, shared=shared)
         # Success!
         logging.info(f'saving access time')
         log_access_time(access_log,'process_burst_data')
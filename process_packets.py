@@ -1,29 +1,49 @@
 import sys
 import os
+import io
 
 import gzip
 import pickle
+import itertools
+import collections
+import hashlib
 import numpy as np
 import datetime
 import matplotlib.pyplot as plt
 from configparser import ConfigParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from data_handlers import decode_packets_TLM, decode_packets_CSV
+from data_handlers import decode_packets_TLM, decode_packets_CSV, iter_packets_TLM
+from data_handlers import iter_packets_TLM_stream, decode_packets_CSV_stream
 from data_handlers import decode_survey_data
-from data_handlers import unique_entries
+from data_handlers import unique_entries, add_counts, TLM_header_times
+from packet_batch import PacketBatch
+from time_handlers import UTC_days
 
-from db_handlers import write_to_db, connect_packet_db, get_files_in_db
+from db_handlers import write_to_db, connect_packet_db
+from db_handlers import get_file_manifest, set_file_entry, set_file_data_times, delete_file_packets
 from log_handlers import get_last_access_time, log_access_time
+from file_handlers import telemetry_type, iter_telemetry_streams, prefetch, read_file
 
 import logging
 
+# Packets written between commits, when ingesting a backlog of files
+COMMIT_PACKETS = 200000
+
+# Rows sampled from each index when refreshing the query planner's statistics, after ingesting
+ANALYSIS_LIMIT = 1000
+
+# Files bigger than this aren't read ahead into memory (they're streamed from disk as they're decoded)
+READ_AHEAD_MAX_BYTES = 256*1024*1024
+
 
 def load_from_telemetry(filepath, files_to_skip = [], do_TLM=True, do_CSV=True):
     ''' Walk through a file tree, and process any TLM and CSV files we can find '''
     # -------- Process all TLM and CSV files we can find -----------
 
     logger = logging.getLogger('load_from_telemetry')
-    packets = []
+    packet_batches = []
 
     for root, dirs, files in os.walk(filepath):
 
@@ -35,15 +55,15 @@ def load_from_telemetry(filepath, files_to_skip = [], do_TLM=True, do_CSV=True):
                     if do_TLM and fname.endswith('.tlm'):
                         logger.info(f'loading TLM from {root} {fname}')
                         # Load packets from each TLM file, tag with the source filename, and decode
-                        packets.extend(decode_packets_TLM(root, fname))
+                        packet_batches.append(decode_packets_TLM(root, fname))
 
                     if do_CSV and fname.endswith('.csv'):
                         logger.info(f'loading CSV from {root} {fname}')
-                        packets.extend(decode_packets_CSV(root, fname))
+                        packet_batches.append(decode_packets_CSV(root, fname))
                 except:
                     logger.warning(f'Problem loading {fname}')
 
-    return packets
+    return PacketBatch.concatenate(packet_batches)
 
 
 def save_packets_to_file_tree(packets, filepath, out_root):
@@ -52,8 +72,7 @@ def save_packets_to_file_tree(packets, filepath, out_root):
     '''
 
     logger = logging.getLogger('save_packets_to_file_tree')
-    dates = [datetime.datetime.fromtimestamp(x['header_timestamp'], tz=datetime.timezone.utc) for x in packets]
-    days_to_do = np.unique([x.replace(hour=0, minute=0, second=0, microsecond=0) for x in dates])
+    days_to_do = UTC_days(PacketBatch.from_packets(packets)['header_timestamp'])
 
     print(days_to_do)
 
@@ -96,7 +115,159 @@ def save_packets_to_file_tree(packets, filepath, out_root):
                 pickle.dump(P_filt, file)
 
 
-def process_packets():
+def iter_file_packets(root, fname, start_offset=0, csv_workers=1, counts=None, data=None):
+    '''
+    Decodes a single .tlm or .csv file (or a compressed one, or a zip archive of
+    them). Yields (packets, next_offset) tuples: .tlm files are streamed in batches
+    (see iter_packets_TLM), and .csv files come back as one batch, with
+    next_offset = None. The decoding counters are added into counts, if given.
+    If the file has already been read into memory, pass its contents as data.
+    '''
+    if fname.endswith('.tlm'):
+        logging.info(f'loading TLM from {root} {fname}')
+        # Stream packets from each TLM file in batches, tagged with the source filename
+        yield from iter_packets_TLM(root, fname, start_offset=start_offset, counts=counts, data=data)
+
+    elif fname.endswith('.csv'):
+        logging.info(f'loading CSV from {root} {fname}')
+        if data is not None:
+            yield decode_packets_CSV_stream(io.BytesIO(data), fname, counts=counts), None
+        else:
+            yield decode_packets_CSV(root, fname, workers=csv_workers, counts=counts), None
+
+    else:
+        # Compressed files and archives are decoded as they're decompressed.
+        # (Packets are tagged with the name of the file on disk, as for any other file.)
+        for name, f in iter_telemetry_streams(os.path.join(root, fname), data=data):
+            logging.info(f'loading {name} from {root} {fname}')
+            if telemetry_type(name) == '.tlm':
+                for packets, offset in iter_packets_TLM_stream(f, fname, counts=counts):
+                    yield packets, None
+            else:
+                yield decode_packets_CSV_stream(f, fname, counts=counts), None
+
+def decode_file(root, fname, start_offset=0, csv_workers=1):
+    '''
+    Decodes a whole file, in a worker process. Returns the list of (packets, next_offset)
+    tuples from iter_file_packets (one per chunk of a .tlm file, so each can be
+    written as it would have been here), and the decoding counters.
+    '''
+    counts = dict()
+    batches = list(iter_file_packets(root, fname, start_offset, csv_workers, counts))
+    return batches, counts
+
+def collect_file(future, counts=None):
+    ''' The output of decode_file from a worker process, adding its counters into counts '''
+    batches, file_counts = future.result()
+    add_counts(counts, file_counts)
+    return batches
+
+def submit_ahead(pool, jobs, ahead):
+    '''
+    Yields (job, future) for each of jobs, in order, where future is decode_file for the
+    job, submitted to pool. Only up to ahead files are decoded ahead of the caller, and
+    each future is dropped once it's been yielded, so no more than that many decoded
+    files are held in memory at once, however long the backlog is.
+    '''
+    jobs = iter(jobs)
+    queue = collections.deque()
+    try:
+        for job in itertools.islice(jobs, ahead):
+            queue.append((job, pool.submit(decode_file, job['root'], job['fname'], job['start_offset'])))
+        while queue:
+            job, future = queue.popleft()
+            for next_job in itertools.islice(jobs, 1):
+                queue.append((next_job, pool.submit(decode_file, next_job['root'], next_job['fname'],
+                                                    next_job['start_offset'])))
+            yield job, future
+            del future
+    finally:
+        # (If the caller stops early, don't decode files nobody needs)
+        for job, future in queue:
+            future.cancel()
+
+def read_ahead_file(job, csv_workers=1):
+    '''
+    The contents of a job's file, read ahead by prefetch -- or None, for files which
+    are decoded straight from disk: large files (which are streamed as they're decoded
+    anyway), and .csv files which are split between csv_workers processes.
+    '''
+    if job['size'] > READ_AHEAD_MAX_BYTES or (job['fname'].endswith('.csv') and csv_workers > 1):
+        return None
+    return read_file(job['path'])
+
+def iter_prefetched_packets(future, root, fname, start_offset=0, csv_workers=1, counts=None):
+    ''' iter_file_packets, for a file read ahead by prefetch (future holds read_ahead_file's result) '''
+    yield from iter_file_packets(root, fname, start_offset, csv_workers, counts, data=future.result())
+
+def file_data_time(job, peek_size=64*1024):
+    '''
+    Roughly when the data in a file was recorded, for deciding which files to decode
+    first: the median header timestamp of the packets in the first peek_size bytes of
+    a .tlm file (compressed or not), or the file's modification time otherwise (for
+    .csv files and zip archives, files we're resuming part-way through, and files
+    with no readable headers at the start).
+    '''
+    if job['start_offset'] == 0 and telemetry_type(job['fname']) == '.tlm':
+        try:
+            for name, f in iter_telemetry_streams(job['path']):
+                ts = TLM_header_times(f.read(peek_size))
+                ts = ts[~np.isnan(ts)]
+                if len(ts):
+                    return float(np.median(ts))
+        except:
+            logging.debug(f"couldn't read header timestamps from {job['fname']}")
+    return job['mtime']
+
+def file_digest(fpath, chunk_size=1024*1024):
+    ''' A digest of a file's contents (blake2b, hex), read chunk_size bytes at a time '''
+    h = hashlib.blake2b(digest_size=20)
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def plan_file(fname, entry, size, mtime, tail_follow=False):
+    '''
+    Decides what to do with a telemetry file, given its entry in the file manifest
+    (None if we haven't seen it before). Returns None to skip the file, or the
+    byte offset to start decoding from. Files which have changed since they were
+    decoded are started again from the top (and their old packets replaced).
+    '''
+    if entry is None:
+        return 0
+
+    if entry['status'] == 'pending':
+        # Seen on an earlier run, but not decoded yet
+        return 0
+
+    if entry['size'] is None:
+        # Decoded before the manifest kept track of file sizes
+        logging.debug(f'File {fname} already in database; skipping')
+        return None
+
+    if size == entry['size'] and entry['mtime'] in (None, mtime):
+        logging.debug(f"File {fname} unchanged since last run ({entry['status']}); skipping")
+        return None
+
+    if tail_follow and fname.endswith('.tlm') and entry['status'] == 'decoded' \
+            and size > entry['size'] and entry['bytes_decoded'] is not None:
+        # Pick up any data appended since the last run
+        logging.info(f"File {fname} has grown since last run; resuming from byte {entry['bytes_decoded']}")
+        return entry['bytes_decoded']
+
+    logging.info(f'File {fname} has changed since last run')
+    return 0
+
+def process_packets(lane=None, fresh_after=None, max_files=0):
+    '''
+    Decodes any new or changed telemetry files into the packet database, newest
+    data first (see file_data_time). lane picks which files to do: 'fresh' for files
+    with data from fresh_after (a unix timestamp) onwards, 'backlog' for the older
+    ones, or None for both. fresh_after defaults to [pipeline_config] fresh_hours
+    ago; a lane without either raises ValueError. At most max_files are decoded
+    (0 for no limit). Returns the number of files left for next time.
+    '''
 
     # -------- Load configuration file --------
     config = ConfigParser()
@@ -104,6 +275,14 @@ def process_packets():
     config.read_file(fp)
     fp.close()
 
+    if lane not in (None, 'fresh', 'backlog'):
+        raise ValueError(f"lane should be 'fresh', 'backlog' or None, not {lane!r}")
+    if lane is not None and fresh_after is None:
+        fresh_hours = config.getfloat('pipeline_config', 'fresh_hours', fallback=0)
+        if fresh_hours <= 0:
+            raise ValueError(f"lane='{lane}' needs fresh_after, or [pipeline_config] fresh_hours")
+        fresh_after = datetime.datetime.now().timestamp() - fresh_hours*3600
+
     # -------- Configure logger ---------
     logfile = config['logging']['log_file']
     logging.basicConfig(level=eval(f"logging.{config['logging']['log_level']}"),
@@ -125,60 +304,223 @@ def process_packets():
     do_TLM = True
     do_CSV = True
 
+    # Re-visit .tlm files which have grown since the last run
+    tail_follow = config.getint('packet_config', 'tail_follow', fallback=0) > 0
+
+    # Processes for decoding large .CSV files (0 for one per core)
+    csv_workers = config.getint('packet_config', 'csv_workers', fallback=1)
+    if csv_workers < 1:
+        csv_workers = os.cpu_count()
+
+    # Processes for decoding files in parallel (0 for one per core)
+    ingest_workers = config.getint('packet_config', 'ingest_workers', fallback=1)
+    if ingest_workers < 1:
+        ingest_workers = os.cpu_count()
+
+    # Files to read ahead, while the current one is digested / decoded
+    read_ahead = config.getint('packet_config', 'read_ahead', fallback=0)
+
+    # The packet database's journal mode (WAL, unless it's shared between hosts)
+    journal_mode = config.get('packet_config', 'journal_mode', fallback='').strip()
+
     logging.info(f'input paths: {in_roots}')
     
 
-    # Find any files to exclude from this run
-    # (We could also do this by tracking the file modification date)
+    # Find any files to exclude from this run, from the file manifest
     if 'db' in output_type:
         logging.info(f'output database: {db_name}')
-        files_to_skip = get_files_in_db(db_name, 'packets')
+        connect_packet_db(db_name, journal_mode=journal_mode or None).close()
+        manifest = get_file_manifest(db_name)
     else:
         logging.info(f'output path: {out_root}')
-        files_to_skip = []
+        manifest = dict()
 
-    # logging.info(f'Files to skip: {files_to_skip}')
+    # Contents of the files decoded so far (by path), for spotting the same file under another name
+    digests = {v['digest']: k for k, v in manifest.items() if v['digest'] and v['status'] == 'decoded'}
 
+    # Find the files to decode, and where to start in each
+    candidates = []
     for in_root in in_roots:
         logging.info(f'doing {in_root}:')
 
         for root, dirs, files in os.walk(in_root):
 
                 for fname in files:
-                    if fname in files_to_skip:
-                        logging.debug(f'File {fname} already in database; skipping')
-                    else:
-
-                        packets = []
-                        try:
-                            if do_TLM and fname.endswith('.tlm'):
-                                logging.info(f'loading TLM from {root} {fname}')
-                                # Load packets from each TLM file, tag with the source filename, and decode
-                                packets = decode_packets_TLM(root, fname)
-
-                            if do_CSV and fname.endswith('.csv'):
-                                logging.info(f'loading CSV from {root} {fname}')
-                                packets = decode_packets_CSV(root, fname)
-
-                            if packets:
-                                if 'files' in output_type:
-                                    save_packets_to_file_tree(packets, out_root)
-                                if 'db' in output_type:
-                                    conn = connect_packet_db(db_name)
-                                    line_id = write_to_db(conn, packets, db_field='packets')
-                                    logging.info(f'wrote to db: line ID = {line_id}')
-                                    conn.commit()
-                                    conn.close()
-
-                        except:
-                            logging.warning(f'Problem loading {fname}')
-
+                    file_type = telemetry_type(fname)
+                    if not ((do_TLM and file_type == '.tlm') or (do_CSV and file_type == '.csv') or file_type == '.zip'):
+                        continue
+
+                    fpath = os.path.join(root, fname)
+                    stat = os.stat(fpath)
+                    # (Files listed before the manifest kept track of paths are found by name)
+                    entry = manifest.get(fpath, manifest.get(fname))
+                    start_offset = plan_file(fpath, entry, stat.st_size, stat.st_mtime, tail_follow)
+                    if start_offset is None:
+                        continue
+
+                    candidates.append(dict(root=root, fname=fname, path=fpath, start_offset=start_offset,
+                                           size=stat.st_size, mtime=stat.st_mtime, entry=entry))
+
+    # Newest data first, so the latest passes aren't held up behind a backlog of old files.
+    # (Each file's data time is worked out the first time it's seen, and kept in the manifest.)
+    for job in candidates:
+        job['data_time'] = job['entry']['data_time'] if job['entry'] is not None else None
+    new_times = [job for job in candidates if job['data_time'] is None]
+    for job, data_time in prefetch(new_times, file_data_time, read_ahead):
+        job['data_time'] = data_time.result()
+    if 'db' in output_type and new_times:
+        conn = connect_packet_db(db_name)
+        set_file_data_times(conn, [(job['path'], job['fname'], job['size'], job['mtime'], job['data_time'])
+                                   for job in new_times])
+        conn.commit()
+        conn.close()
+    candidates.sort(key=lambda job: job['data_time'], reverse=True)
+    if lane == 'fresh':
+        candidates = [job for job in candidates if job['data_time'] >= fresh_after]
+    elif lane == 'backlog':
+        candidates = [job for job in candidates if job['data_time'] < fresh_after]
+
+    # Check the contents of each one (reading the next few in while each is hashed).
+    # Files we're resuming have only been appended to, and aren't hashed (that would
+    # mean reading the whole file again, for every few new bytes): their digest is
+    # left out of the manifest, until they're next decoded from the top.
+    jobs = []
+    duplicates = []
+    touched = []
+    checked = 0
+    hash_file = lambda job: file_digest(job['path']) if job['start_offset'] == 0 else None
+    for job, digest in prefetch(candidates, hash_file, read_ahead):
+        if max_files and len(jobs) >= max_files:
+            break
+        checked += 1
+        fpath, entry = job['path'], job['entry']
+        job['digest'] = digest.result()
+
+        if job['digest'] is not None:
+            if entry is not None and job['digest'] == entry['digest']:
+                logging.info(f'File {fpath} has been touched, but its contents are unchanged; skipping')
+                touched.append(job)
+                continue
+            if digests.get(job['digest'], fpath) != fpath:
+                logging.info(f"File {fpath} is a duplicate of {digests[job['digest']]}; skipping")
+                duplicates.append(job)
+                continue
+            digests.setdefault(job['digest'], fpath)
+
+        jobs.append(job)
+
+    remaining = len(candidates) - checked
+    logging.info(f'{len(jobs)} files to decode, {len(duplicates)} duplicates' +
+                 (f', {remaining} left for next time' if remaining else ''))
+
+    if 'db' in output_type and (duplicates or touched):
+        # List the duplicates and touched files in the manifest, so they're skipped from now on
+        conn = connect_packet_db(db_name)
+        for job in duplicates:
+            if job['entry'] is not None:
+                delete_file_packets(conn, job['path'])
+            set_file_entry(conn, job['path'], job['fname'], job['size'], job['mtime'], job['size'],
+                           'duplicate', digest=job['digest'], data_time=job['data_time'])
+        for job in touched:
+            entry = job['entry']
+            set_file_entry(conn, job['path'], job['fname'], job['size'], job['mtime'], entry['bytes_decoded'],
+                           entry['status'], entry['packet_count'], entry['checksum_failures'], job['digest'],
+                           job['data_time'])
+        conn.commit()
+        conn.close()
+
+    # Decode in worker processes (a few files ahead of the writer), or here (streaming .tlm files in batches).
+    # Either way, a single connection writes everything, committing every COMMIT_PACKETS packets.
+    pool = None
+    if ingest_workers > 1 and len(jobs) > 1:
+        logging.info(f'decoding with {ingest_workers} workers')
+        pool = ProcessPoolExecutor(max_workers=ingest_workers)
+        # (One level of parallelism only -- .csv files aren't split up again inside the workers.
+        # One file is decoded ahead of each worker, so they're kept busy while this one writes.)
+        decoders = (partial(collect_file, future) for job, future in submit_ahead(pool, jobs, ingest_workers + 1))
+    elif read_ahead > 0:
+        # Read the next few files into memory while each one is decoded and written
+        decoders = (partial(iter_prefetched_packets, future, job['root'], job['fname'], job['start_offset'], csv_workers)
+                    for job, future in prefetch(jobs, partial(read_ahead_file, csv_workers=csv_workers), read_ahead))
+    else:
+        decoders = [partial(iter_file_packets, job['root'], job['fname'], job['start_offset'], csv_workers)
+                    for job in jobs]
 
+    if 'db' in output_type:
+        conn = connect_packet_db(db_name)
+    uncommitted = 0
+
+    for job, decoder in zip(jobs, decoders):
+        fname, entry = job['fname'], job['entry']
+        resumed = job['start_offset'] > 0
+        try:
+            if 'db' in output_type:
+                # Each file is written all-or-nothing, but several files share a transaction
+                if not conn.in_transaction:
+                    conn.execute('BEGIN')
+                conn.execute('SAVEPOINT ingest_file')
+                if entry is not None and not resumed:
+                    # Changed since it was last decoded; replace its packets
+                    delete_file_packets(conn, job['path'])
+
+            counts = dict()
+            packet_count = 0
+            next_offset = job['start_offset']
+            for packets, next_offset in decoder(counts=counts):
+                if packets:
+                    if 'files' in output_type:
+                        save_packets_to_file_tree(packets, out_root)
+                    if 'db' in output_type:
+                        line_id = write_to_db(conn, packets, db_field='packets', path=job['path'])
+                        logging.info(f'wrote to db: line ID = {line_id}')
+                        uncommitted += len(packets)
+                    packet_count += len(packets)
+
+            if 'db' in output_type:
+                # Remember how far we got, in the same transaction as the packets
+                checksum_failures = counts.get('checksum_failures', 0)
+                if resumed:
+                    packet_count += entry['packet_count'] or 0
+                    checksum_failures += entry['checksum_failures'] or 0
+                set_file_entry(conn, job['path'], fname, job['size'], job['mtime'],
+                               job['size'] if next_offset is None else next_offset, 'decoded',
+                               packet_count=packet_count, checksum_failures=checksum_failures,
+                               digest=job['digest'], data_time=job['data_time'])
+                conn.execute('RELEASE ingest_file')
+
+        except:
+            logging.warning(f'Problem loading {fname}')
+            if 'db' in output_type:
+                conn.execute('ROLLBACK TO ingest_file')
+                conn.execute('RELEASE ingest_file')
+                # Don't try it again until it changes (unless an earlier version decoded fine)
+                if entry is None or entry['status'] != 'decoded':
+                    set_file_entry(conn, job['path'], fname, job['size'], job['mtime'], 0, 'failed',
+                                   digest=job['digest'], data_time=job['data_time'])
+
+        if 'db' in output_type and uncommitted >= COMMIT_PACKETS:
+            logging.info(f'committing {uncommitted} packets')
+            conn.commit()
+            uncommitted = 0
+
+    if pool is not None:
+        pool.shutdown()
 
+    if 'db' in output_type:
+        conn.commit()
+        if jobs:
+            # Keep the query planner's statistics up to date, as the database grows
+            # (sampling a limited number of rows from each index, so it's quick)
+            conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+            conn.execute('ANALYZE packets')
+            conn.commit()
+        conn.close()
 
     if 'db' in output_type:
         log_access_time(access_log, 'process_packets')
 
+    return remaining
+
 
 if __name__ == "__main__":
     process_packets()
\ No newline at end of file
@@ -0,0 +1,538 @@
+import os
+import time
+import datetime
+import logging
+import importlib
+import numpy as np
+import matplotlib.pyplot as plt
+from configparser import ConfigParser
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from db_handlers import get_packets_within_range, iter_packets_within_range, get_time_range_for_updated_packets
+from db_handlers import connect_packet_db, get_packet_summary, get_task_records, set_task_record
+from log_handlers import get_last_access_time, log_access_time
+from packet_batch import PacketBatch
+
+# Packet counts are summarized in bins of this many seconds, to work out
+# which days have new data for each stage
+SUMMARY_BIN = 3600
+
+# The packets shared with the per-day tasks in this process (see run_task)
+_shared = None
+
+# The most packets SharedPackets holds the headers of; beyond that (e.g., on the
+# first run, or after a long gap), every stage reads from the database
+SHARED_MAX_PACKETS = 2000000
+
+# The most memory (in bytes) SharedPackets uses for whole packets, payloads and
+# all, unless [pipeline_config] shared_memory_mb says otherwise; beyond that, it
+# spills to holding just their headers (SHARED_COLUMNS)
+SHARED_MAX_BYTES = 1024*1024*1024
+
+# The columns SharedPackets holds, for each packet, once it has spilled
+SHARED_COLUMNS = ['dtype', 'header_timestamp', 'added']
+
+def _batch_nbytes(batch):
+    ''' Roughly the memory a PacketBatch takes up: its payloads, and its columns '''
+    return batch.payload.nbytes + batch.offsets.nbytes + batch.lengths.nbytes + \
+           sum(c.nbytes for c in batch.columns.values())
+
+def _headers(batch):
+    ''' Just the SHARED_COLUMNS of a PacketBatch, without its payloads '''
+    n = len(batch)
+    return PacketBatch(np.zeros(0, dtype=np.uint8), np.zeros(n), np.zeros(n),
+                       {k: batch.columns[k] for k in SHARED_COLUMNS})
+
+class SharedPackets:
+    '''
+    The packets added to the database since a given time (a unix timestamp), loaded
+    once and shared by each processing stage, along with any older packets on the
+    same UTC days, or within margin (a timedelta) of them -- e.g., the start of a
+    burst which was downlinked on a previous pass.
+
+    Answers get_time_range_for_updated_packets from memory, and the same queries
+    as get_packets_within_range: the part of a time range inside the days (+/-
+    margin) it holds is served from memory, and only the part outside them goes to
+    the database. If the packets take more than max_bytes, it spills to holding
+    just their headers (SHARED_COLUMNS): ranges with no packets (of the type asked
+    for) still come back empty without going to the database, and the rest are
+    read from the database, just for that range. Raises ValueError if there are
+    more than max_packets to hold.
+    '''
+
+    def __init__(self, packet_db, since, margin=datetime.timedelta(hours=2), max_packets=SHARED_MAX_PACKETS,
+                 max_bytes=SHARED_MAX_BYTES):
+        logger = logging.getLogger('SharedPackets')
+
+        self.packet_db = packet_db
+        self.since = since
+        self.max_packets = max_packets
+        self.max_bytes = max_bytes
+        self.spilled = False
+        self.count = 0
+        self.nbytes = 0
+        added = datetime.datetime.fromtimestamp(since, tz=datetime.timezone.utc)
+
+        new = self.load(date_added=added)
+        ts = new['header_timestamp']
+        ts = ts[~np.isnan(ts)]
+
+        # The header timestamps we hold every packet for: each day with new packets
+        # (for the per-day tasks), +/- margin, as a list of [start, end] spans
+        self.spans = []
+        for d in np.unique(np.floor(ts/86400)):
+            t1, t2 = d*86400 - margin.total_seconds(), (d + 1)*86400 + margin.total_seconds()
+            if self.spans and t1 <= self.spans[-1][1]:
+                self.spans[-1][1] = t2
+            else:
+                self.spans.append([t1, t2])
+
+        batches = [new]
+        for t1, t2 in self.spans:
+            batches.append(self.load(added_before=added,
+                                     t1=datetime.datetime.fromtimestamp(t1, tz=datetime.timezone.utc),
+                                     t2=datetime.datetime.fromtimestamp(t2, tz=datetime.timezone.utc)))
+        if self.spilled:
+            batches = [_headers(b) for b in batches]
+        self.packets = PacketBatch.concatenate(batches).sort('header_timestamp')
+        # (A selection, sharing the payloads)
+        self.new = self.packets[self.packets['added'] > since]
+
+        logger.info(f'{len(self.new)} new packets, {len(self.packets) - len(self.new)} older packets '
+                    f'on {len(self.spans)} spans of days (+/- {margin})' +
+                    (f'; headers only, past {self.max_bytes/2**20:.0f} MB' if self.spilled else ''))
+
+    def load(self, **kwargs):
+        '''
+        The packets from get_packets_within_range(**kwargs) -- just their headers, once
+        we've spilled. Raises ValueError past max_packets.
+        '''
+        batches = []
+        for batch in iter_packets_within_range(self.packet_db, columns=SHARED_COLUMNS if self.spilled else None,
+                                               batch_size=100000, **kwargs):
+            self.count += len(batch)
+            if self.count > self.max_packets:
+                raise ValueError(f'more than {self.max_packets} packets to share')
+            if not self.spilled:
+                self.nbytes += _batch_nbytes(batch)
+                if self.nbytes > self.max_bytes:
+                    self.spilled = True
+            batches.append(_headers(batch) if self.spilled else batch)
+        if not batches:
+            return PacketBatch.empty(SHARED_COLUMNS if self.spilled else None)
+        return PacketBatch.concatenate(batches)
+
+    def covers(self, t1, t2):
+        ''' Whether we hold every packet with a header timestamp between t1 and t2 (unix timestamps) '''
+        return any(a <= t1 and t2 <= b for a, b in self.spans)
+
+    def select(self, packets, dtype, added, t1, t2):
+        ''' The packets of type dtype, added after added, with t1 <= header_timestamp <= t2 '''
+        packets = packets.in_time_range(t1, t2)
+        if dtype:
+            packets = packets.by_dtype(dtype)
+        return packets[packets['added'] > added]
+
+    def get_packets_within_range(self, dtype=None, date_added=None, t1=None, t2=None):
+        ''' As db_handlers.get_packets_within_range, from memory where possible '''
+        added = date_added.timestamp() if date_added is not None else 0
+        t1 = t1 if t1 is not None else datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+        t2 = t2 if t2 is not None else datetime.datetime.now()
+        ts1, ts2 = t1.timestamp(), t2.timestamp()
+
+        if self.spilled:
+            packets = self.new if added >= self.since else self.packets if self.covers(ts1, ts2) else None
+            if packets is not None and not len(self.select(packets, dtype, added, ts1, ts2)):
+                return PacketBatch.empty()
+            return get_packets_within_range(self.packet_db, dtype=dtype, date_added=date_added, t1=t1, t2=t2)
+
+        if added >= self.since:
+            # (We hold every new packet, whatever its time)
+            packets = self.select(self.new, dtype, added, ts1, ts2)
+            ts = packets['header_timestamp']
+            return packets[(ts > ts1) & (ts < ts2)]
+
+        # Walk through the range: the parts inside our spans come from memory (the
+        # packets are loaded strictly inside each span, so we serve the whole seconds
+        # within it, ends included), and the parts between them from the database
+        # (ends excluded, as get_packets_within_range does)
+        utc = lambda x: datetime.datetime.fromtimestamp(x, tz=datetime.timezone.utc)
+        pieces = []
+        start, start_ts = t1, ts1
+        for a, b in self.spans:
+            a, b = np.floor(a) + 1, np.ceil(b) - 1
+            if b < start_ts or a >= ts2:
+                continue
+            if start_ts < a:
+                pieces.append(get_packets_within_range(self.packet_db, dtype=dtype, date_added=date_added,
+                                                       t1=start, t2=utc(a)))
+            packets = self.select(self.packets, dtype, added, max(start_ts, a), min(ts2, b))
+            ts = packets['header_timestamp']
+            pieces.append(packets[(ts > ts1) & (ts < ts2)])
+            start, start_ts = utc(b), b
+        if start_ts < ts2:
+            pieces.append(get_packets_within_range(self.packet_db, dtype=dtype, date_added=date_added,
+                                                   t1=start, t2=t2))
+        if len(pieces) == 1:
+            return pieces[0]
+        return PacketBatch.concatenate(pieces)
+
+    def get_time_range_for_updated_packets(self, ts):
+        ''' As db_handlers.get_time_range_for_updated_packets, from memory where possible '''
+        if ts < self.since:
+            return get_time_range_for_updated_packets(self.packet_db, ts)
+
+        t = self.new['header_timestamp'][self.new['added'] > ts]
+        t = t[~np.isnan(t)]
+        if not len(t):
+            return None, None
+        return t.min(), t.max()
+
+
+def run_stage(name, func, *args, **kwargs):
+    '''
+    Run one processing stage, in this process, and return its result.
+    A stage which fails is logged and skipped (returning None).
+    '''
+    logger = logging.getLogger('run_stage')
+
+    t0 = time.time()
+    try:
+        result = getattr(importlib.import_module(name), func)(*args, **kwargs)
+        logger.info(f'{name} done in {time.time() - t0:.1f} seconds')
+        return result
+    except:
+        logger.exception(f'{name} failed')
+    finally:
+        # (Don't let any figures pile up between runs)
+        plt.close('all')
+
+def task_stages(config):
+    '''
+    The per-day processing stages, in the order automate.sh used to run them.
+    Each one is a dict of:
+        stage:      the module (and its source string in the access log)
+        func:       the function to run for each UTC day, as func(day, **kwargs)
+        kwargs:     its settings, from the configuration file
+        dtypes:     the packet types it reads. Days with packets of the first type are run.
+        margin:     how far before / after each day it reads packets (timedeltas)
+        depends_on: a stage which has to finish the same day first, if any
+        shared:     whether func takes the packets shared by SharedPackets
+        since_arg:  a keyword argument to pass the time of the day's last successful run in, if any
+        finish:     a function to call with every day's results, once the stage is done, if any
+    '''
+    packet_db = config['db_locations']['packet_db_file']
+    survey_root = config['db_locations']['survey_tree_root']
+    survey_types = [x.strip() for x in config['survey_config']['file_types'].split(',')]
+    burst_types = [x.strip() for x in config['burst_config']['file_types'].split(',')]
+    max_lookback_time = datetime.timedelta(minutes=int(config['burst_config']['lookback_time_minutes']))
+    margin = datetime.timedelta(hours=2)
+    no_margin = datetime.timedelta(0)
+
+    return [dict(stage='process_status_data', func='process_status_day',
+                 kwargs=dict(packet_db=packet_db, out_root=config['db_locations']['status_tree_root']),
+                 dtypes='I', margin=(no_margin, no_margin), depends_on=None, shared=True),
+
+            dict(stage='process_survey_data', func='process_survey_day',
+                 kwargs=dict(packet_db=packet_db, out_root=survey_root, file_types=survey_types,
+                             fill_GPS=int(config['survey_config']['fill_missing_GPS']) > 0, margin=margin),
+                 dtypes='S', margin=(margin, margin), depends_on=None, shared=True,
+                 finish=('save_invalid_survey_entries', dict(out_root=survey_root, file_types=survey_types))),
+
+            # (Same data as the survey stage, so it's run whenever the survey day is)
+            dict(stage='generate_survey_quicklooks', func='generate_survey_quicklooks_day',
+                 kwargs=dict(in_root=os.path.join(survey_root, 'xml'), out_root=os.path.join(survey_root, 'figures'),
+                             line_plots=[x.strip() for x in config['survey_config']['line_plots'].split(',')],
+                             plot_length=int(config['survey_config']['plot_length']),
+                             read_ahead=config.getint('survey_config', 'read_ahead', fallback=0)),
+                 dtypes='S', margin=(margin, margin), depends_on='process_survey_data', shared=False),
+
+            dict(stage='process_burst_data', func='process_burst_day',
+                 kwargs=dict(packet_db=packet_db, out_root=config['db_locations']['burst_tree_root'],
+                             file_types=burst_types, max_lookback_time=max_lookback_time,
+                             fill_GPS=int(config['burst_config']['fill_missing_GPS']) > 0,
+                             do_plots=int(config['burst_config']['do_plots']) > 0,
+                             do_maps=int(config['burst_config']['do_maps']) > 0,
+                             dpi=int(config['burst_config']['dpi']),
+                             cal_file=config['burst_config']['calibration_file'],
+                             TLE_file=config['burst_config']['TLE_file'].strip(),
+                             TX_file=config['burst_config']['TX_file'].strip()),
+                 dtypes='IEBG', margin=(max_lookback_time, no_margin), depends_on=None, shared=True,
+                 since_arg='date_added')]
+
+def data_version(summary, dtypes, day, margin):
+    '''
+    The version of the packet data a task reads, from get_packet_summary: the number of
+    packets of each type in dtypes, and the latest time one was added, between
+    margin[0] before the day and margin[1] after it.
+    '''
+    first = int(np.floor((day - margin[0]).timestamp()/SUMMARY_BIN))
+    last = int(np.ceil((day + datetime.timedelta(days=1) + margin[1]).timestamp()/SUMMARY_BIN))
+    count = 0
+    added = 0
+    for dtype in dtypes:
+        for ind in range(first, last):
+            c, a = summary.get((dtype, ind), (0, 0))
+            count += c
+            added = max(added, a)
+    return f'{count}:{added:.6f}', added
+
+def plan_tasks(packet_db, access_log, stages, after=None):
+    '''
+    Every (stage, day) task which needs running: days with packets for the stage,
+    whose data has changed since the task last completed (or which failed last time).
+    If after is given (a UTC datetime), days before it are left for later.
+    Returns a dict of (stage, day string): dict(stage, day, version, kwargs, depends_on, completed),
+    newest day first (and in stage order within each day).
+    '''
+    logger = logging.getLogger('plan_tasks')
+
+    summary = get_packet_summary(packet_db, SUMMARY_BIN)
+    records = get_task_records(packet_db)
+    conn = connect_packet_db(packet_db)
+
+    tasks = dict()
+    for st in stages:
+        # Days processed by the stage itself (before it was run as tasks) count as done
+        last_access = get_last_access_time(access_log, st['stage'])
+        days = sorted(set(ind*SUMMARY_BIN//86400 for dtype, ind in summary if dtype == st['dtypes'][0]))
+
+        for d in days:
+            day = datetime.datetime.fromtimestamp(d*86400, tz=datetime.timezone.utc)
+            if after is not None and day < after:
+                continue
+            day_str = day.strftime('%Y-%m-%d')
+            version, added = data_version(summary, st['dtypes'], day, st['margin'])
+            record = records.get((st['stage'], day_str))
+
+            if record is not None:
+                if record['status'] == 'completed' and record['version'] == version:
+                    continue
+                last_completed = record['completed']
+            elif added <= last_access:
+                set_task_record(conn, st['stage'], day_str, version, 'completed', last_access)
+                continue
+            else:
+                last_completed = None
+
+            kwargs = dict(st['kwargs'])
+            if st.get('since_arg'):
+                since = last_completed if last_completed is not None else last_access
+                kwargs[st['since_arg']] = datetime.datetime.fromtimestamp(since, tz=datetime.timezone.utc)
+            depends_on = (st['depends_on'], day_str) if st['depends_on'] else None
+            tasks[(st['stage'], day_str)] = dict(stage=st, day=day, version=version, kwargs=kwargs,
+                                                 depends_on=depends_on, completed=last_completed)
+
+        logger.info(f"{st['stage']}: {sum(1 for x in tasks if x[0] == st['stage'])} of {len(days)} days to do")
+
+    conn.close()
+
+    # The latest data first, so recent products aren't held up behind a backlog
+    order = [st['stage'] for st in stages]
+    return dict(sorted(tasks.items(), key=lambda x: (-x[1]['day'].timestamp(), order.index(x[0][0]))))
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+def run_task(stage, func, day, kwargs, takes_shared):
+    ''' Run one stage for one day (in a worker process, or this one). Returns the stage's result. '''
+    if takes_shared and _shared is not None:
+        kwargs = dict(kwargs, shared=_shared)
+    try:
+        return getattr(importlib.import_module(stage), func)(day, **kwargs)
+    finally:
+        # (Don't let any figures pile up between tasks)
+        plt.close('all')
+
+def run_tasks(packet_db, access_log, stages, shared=None, workers=1, after=None):
+    '''
+    Run every (stage, day) task from plan_tasks, newest day first, on workers
+    processes: each task starts as soon as the task it depends on (if any) has
+    completed, so different stages and days run side by side. Each task's outcome
+    is recorded in the tasks table; a failed task (and anything depending on it)
+    is run again next time. If after is given (a UTC datetime), only days from
+    then on are run.
+    '''
+    global _shared
+    logger = logging.getLogger('run_tasks')
+
+    run_start = datetime.datetime.now().timestamp()
+    tasks = plan_tasks(packet_db, access_log, stages, after)
+    if not tasks:
+        logger.info('No new data to process')
+
+    conn = connect_packet_db(packet_db)
+    results = {st['stage']: [] for st in stages}
+    completed, failed = set(), set()
+
+    def record_result(key, get_result):
+        task = tasks[key]
+        try:
+            result = get_result()
+        except:
+            logger.exception(f'{key[0]} failed for {key[1]}')
+            failed.add(key)
+            set_task_record(conn, key[0], key[1], task['version'], 'failed', task['completed'])
+            return
+        logger.info(f'{key[0]} done for {key[1]}')
+        completed.add(key)
+        if result:
+            results[key[0]].extend(result)
+        set_task_record(conn, key[0], key[1], task['version'], 'completed', run_start)
+
+    def ready(key):
+        dep = tasks[key]['depends_on']
+        return dep is None or dep not in tasks or dep in completed
+
+    def blocked(key):
+        dep = tasks[key]['depends_on']
+        return dep is not None and dep in failed
+
+    pending = list(tasks)
+    if workers > 1 and len(tasks) > 1:
+        logger.info(f'running {len(tasks)} tasks with {workers} workers')
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared,)) as pool:
+            running = dict()
+            while pending or running:
+                for key in [x for x in pending if blocked(x)]:
+                    logger.warning(f'skipping {key[0]} for {key[1]}: {tasks[key]["depends_on"][0]} failed')
+                    pending.remove(key)
+                    failed.add(key)
+                for key in [x for x in pending if ready(x)]:
+                    task = tasks[key]
+                    running[pool.submit(run_task, key[0], task['stage']['func'], task['day'],
+                                        task['kwargs'], task['stage']['shared'])] = key
+                    pending.remove(key)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record_result(running.pop(future), future.result)
+    else:
+        # One at a time, in this process, in plan_tasks' order (so dependencies come first)
+        _shared = shared
+        for key in pending:
+            if blocked(key):
+                logger.warning(f'skipping {key[0]} for {key[1]}: {tasks[key]["depends_on"][0]} failed')
+                failed.add(key)
+                continue
+            task = tasks[key]
+            record_result(key, partial(run_task, key[0], task['stage']['func'], task['day'],
+                                       task['kwargs'], task['stage']['shared']))
+        _shared = None
+
+    for st in stages:
+        if 'finish' in st and results[st['stage']]:
+            func, kwargs = st['finish']
+            try:
+                getattr(importlib.import_module(st['stage']), func)(results[st['stage']], **kwargs)
+            except:
+                logger.exception(f"{st['stage']}.{func} failed")
+
+        # Record the stage's run in the access log, as it does when run on its own
+        # (only once every day is done: plan_tasks counts older days as done by then)
+        if after is None and not any(key[0] == st['stage'] for key in failed):
+            log_access_time(access_log, st['stage'])
+
+    conn.close()
+    logger.info(f'{len(completed)} tasks completed, {len(failed)} failed or skipped')
+    return completed, failed
+
+def share_packets(packet_db, access_log, margin, max_bytes=SHARED_MAX_BYTES):
+    ''' SharedPackets for everything added since the status and survey stages last ran (or None) '''
+    # (The burst stage only logs a run once it finds something, so it may look
+    # further back; those queries go to the database)
+    logger = logging.getLogger('run_pipeline')
+    since = min(get_last_access_time(access_log, 'process_status_data'),
+                get_last_access_time(access_log, 'process_survey_data'))
+    try:
+        return SharedPackets(packet_db, since, margin, max_bytes=max_bytes)
+    except ValueError as e:
+        logger.info(f'not sharing new packets ({e}); stages will read from the database')
+    except:
+        logger.exception('failed to load new packets; stages will read from the database')
+    return None
+
+def run_pipeline():
+    '''
+    Run each processing stage once: ingest any new telemetry, then load the newly-added
+    packets once (see SharedPackets), and run the status, survey, quicklook and burst
+    stages for each UTC day with new data (see run_tasks).
+
+    The latest data goes first, in two lanes: files with data from the last
+    fresh_hours are ingested and processed before anything else, then up to
+    backlog_files older files (see [pipeline_config]). Returns whether there are
+    any files left in the backlog, for the next run.
+    '''
+    logger = logging.getLogger('run_pipeline')
+
+    config = ConfigParser()
+    fp = open('GSS_settings.conf')
+    config.read_file(fp)
+    fp.close()
+
+    packet_db = config['db_locations']['packet_db_file']
+    access_log = config['logging']['access_log'].strip()
+
+    workers = config.getint('pipeline_config', 'workers', fallback=1)
+    if workers < 1:
+        workers = os.cpu_count()
+
+    fresh_hours = config.getfloat('pipeline_config', 'fresh_hours', fallback=0)
+    backlog_files = config.getint('pipeline_config', 'backlog_files', fallback=0)
+    shared_bytes = int(config.getfloat('pipeline_config', 'shared_memory_mb',
+                                       fallback=SHARED_MAX_BYTES/2**20)*2**20)
+
+    # Enough margin for both the survey stage (2 hours either side of each day)
+    # and the longest burst we'd look back for
+    lookback_mins = int(config['burst_config']['lookback_time_minutes'])
+    margin = max(datetime.timedelta(hours=2), datetime.timedelta(minutes=lookback_mins, seconds=2))
+    stages = task_stages(config)
+
+    if fresh_hours > 0:
+        # The fresh lane: the latest passes, start to finish, ahead of any backlog
+        fresh_after = datetime.datetime.now().timestamp() - fresh_hours*3600
+        logger.info(f'fresh lane: data since {datetime.datetime.utcfromtimestamp(fresh_after)}')
+        run_stage('process_packets', 'process_packets', lane='fresh', fresh_after=fresh_after)
+
+        first_day = datetime.datetime.fromtimestamp(np.floor(fresh_after/86400)*86400, tz=datetime.timezone.utc)
+        run_tasks(packet_db, access_log, stages, shared=share_packets(packet_db, access_log, margin, shared_bytes),
+                  workers=workers, after=first_day)
+
+        # Then the backlog lane: older files, a few at a time
+        logger.info('backlog lane')
+        remaining = run_stage('process_packets', 'process_packets', lane='backlog',
+                              fresh_after=fresh_after, max_files=backlog_files)
+    else:
+        # Everything else depends on the packet database being up to date
+        remaining = run_stage('process_packets', 'process_packets', max_files=backlog_files)
+
+    run_tasks(packet_db, access_log, stages, shared=share_packets(packet_db, access_log, margin, shared_bytes), workers=workers)
+
+    if remaining:
+        logger.info(f'{remaining} files left in the backlog')
+    return bool(remaining)
+
+def main():
+    # -------- Load configuration file --------
+    config = ConfigParser()
+    fp = open('GSS_settings.conf')
+    config.read_file(fp)
+    fp.close()
+
+    # -------- Configure logger ---------
+    logfile = config['logging']['log_file']
+    logging.basicConfig(level=eval(f"logging.{config['logging']['log_level']}"),
+             filename = logfile,
+             format='[%(asctime)s]\t%(module)s.%(name)s\t%(levelname)s\t%(message)s',
+             datefmt='%Y-%m-%d %H:%M:%S')
+    logging.getLogger('matplotlib').setLevel(logging.WARNING)
+    np.seterr(divide='ignore')
+
+    run_pipeline()
+
+
+if __name__ == "__main__":
+    main()
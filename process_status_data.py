@@ -10,6 +10,7 @@ from configparser import ConfigParser
 from file_handlers import load_packets_from_tree
 from data_handlers import decode_status, unique_entries
 from file_handlers import read_status_XML, write_status_XML
+from time_handlers import UTC_days
 from db_handlers import get_packets_within_range, get_time_range_for_updated_packets
 # from db_handlers import get_last_access_time, log_access_time
 from log_handlers import get_last_access_time, log_access_time
@@ -18,8 +19,7 @@ def save_status_to_file_tree(stat_data, out_root):
     
     logger = logging.getLogger(__name__ + '.save_status_to_file_tree')
 
-    dates = [datetime.datetime.fromtimestamp(x['header_timestamp'], tz=datetime.timezone.utc) for x in stat_data]
-    days_to_do = np.unique([x.replace(hour=0, minute=0, second=0, microsecond=0) for x in dates])
+    days_to_do = UTC_days([x['header_timestamp'] for x in stat_data])
     # print(days_to_do)
 
     for d in days_to_do:
@@ -55,7 +55,29 @@ def save_status_to_file_tree(stat_data, out_root):
             write_status_XML(stat_filt, outfile)
 
 
-def main():
+def process_status_day(day, packet_db, out_root, shared=None):
+    '''
+    Decode every status message with a header timestamp on one UTC day (a timezone-aware
+    datetime at midnight), and write that day's file. Run per day by process_pipeline;
+    packets are read from shared (a process_pipeline.SharedPackets), if provided.
+    '''
+    logger = logging.getLogger(__name__ + '.process_status_day')
+
+    t1 = day
+    t2 = day + datetime.timedelta(days=1)
+    if shared is not None:
+        packets = shared.get_packets_within_range(dtype='I', t1=t1, t2=t2)
+    else:
+        packets = get_packets_within_range(packet_db, dtype='I', t1=t1, t2=t2)
+    logger.info(f"loaded {len(packets)} packets for {day.strftime('%Y-%m-%d')}")
+
+    if packets:
+        stats = decode_status(packets)
+        logger.info(f'Decoded {len(stats)} status messages')
+        if stats:
+            save_status_to_file_tree(stats, out_root)
+
+def main(shared=None):
   # -------- Load configuration file --------
     config = ConfigParser()
     fp = open('GSS_settings.conf')
@@ -80,7 +102,11 @@ def main():
     last_time = datetime.datetime.utcfromtimestamp(last_timestamp)
     logging.info(f'Last run time: {last_time} UTC')
 
-    tsmin, tsmax = get_time_range_for_updated_packets(packet_db, last_timestamp)
+    # Read from the packets shared by process_pipeline, if we were given them
+    if shared is not None:
+        tsmin, tsmax = shared.get_time_range_for_updated_packets(last_timestamp)
+    else:
+        tsmin, tsmax = get_time_range_for_updated_packets(packet_db, last_timestamp)
 
     if (not tsmin) or (not tsmax):
         logging.info('No new data to process')
@@ -94,7 +120,10 @@ def main():
         stats = []
         # ---------------- Load packets --------------------
         # packets = load_packets_from_tree(in_root)
-        packets = get_packets_within_range(packet_db, dtype='I', t1=tmin, t2=tmax)
+        if shared is not None:
+            packets = shared.get_packets_within_range(dtype='I', t1=tmin, t2=tmax)
+        else:
+            packets = get_packets_within_range(packet_db, dtype='I', t1=tmin, t2=tmax)
 
 
         logging.info(f'loaded {len(packets)} packets')
@@ -50,7 +50,12 @@ def valid_GPS_mask(s):
     
     return temp
 
-def save_survey_to_file_tree(S_data, out_root, file_types=['xml', 'mat']):
+def save_survey_to_file_tree(S_data, out_root, file_types=['xml', 'mat'], save_invalid=True):
+    '''
+    Merge survey products into the daily files under out_root. Products without a valid
+    GPS fix are also cached in the invalid_entries files, unless save_invalid is False
+    (e.g., when several days are being saved in parallel); they're returned either way.
+    '''
     logger = logging.getLogger('save_survey_to_file_tree')
 
     # -------------------- Filter out invalid entries -----------------------------
@@ -149,6 +154,14 @@ def save_survey_to_file_tree(S_data, out_root, file_types=['xml', 'mat']):
                         pickle.dump(S_filt, file)                    
 
     # ---------------- Cache invalid packets -----------------------------
+    if save_invalid:
+        save_invalid_survey_entries(S_invalid, out_root, file_types)
+
+    return S_invalid
+
+def save_invalid_survey_entries(S_invalid, out_root, file_types=['xml', 'mat']):
+    ''' Merge survey products without a valid GPS fix into the invalid_entries files '''
+    logger = logging.getLogger('save_invalid_survey_entries')
 
     if S_invalid:
         invalid_xml_file = os.path.join(out_root,'xml','invalid_entries.xml')
@@ -176,11 +189,51 @@ def save_survey_to_file_tree(S_data, out_root, file_types=['xml', 'mat']):
                 savemat(invalid_file, {'survey_data': S_invalid})
 
             if ftype=='pkl':
-                with open(outfile,'wb') as file:
+                with open(invalid_file,'wb') as file:
                     pickle.dump(S_invalid, file)
 
 
-def main():
+def process_survey_day(day, packet_db, out_root, file_types=['xml', 'mat'], fill_GPS=True,
+                       margin=datetime.timedelta(hours=2), shared=None):
+    '''
+    Decode the survey products on one UTC day (a timezone-aware datetime at midnight),
+    and merge them into that day's files. Packets within margin of the day are decoded
+    too, for products which straddle midnight. Run per day by process_pipeline;
+    packets are read from shared (a process_pipeline.SharedPackets), if provided.
+
+    Returns the products without a valid GPS fix, rather than caching them, since
+    days may be run in parallel: pass them on to save_invalid_survey_entries.
+    '''
+    logger = logging.getLogger('process_survey_day')
+
+    t1 = day - margin
+    t2 = day + datetime.timedelta(days=1) + margin
+    if shared is not None:
+        packets = shared.get_packets_within_range(dtype='S', t1=t1, t2=t2)
+    else:
+        packets = get_packets_within_range(packet_db, dtype='S', t1=t1, t2=t2)
+    logger.info(f"loaded {len(packets)} packets for {day.strftime('%Y-%m-%d')}")
+
+    if not packets:
+        return []
+
+    S_data, unused = decode_survey_data(packets, separation_time=4.5)
+    logger.info(f'Decoded {len(S_data)} survey products, ({len(unused)}) unused packets remaining')
+
+    # Replace any missing GPS positions with TLE-propagated data
+    if fill_GPS and S_data:
+        fill_missing_GPS_entries([x['GPS'][0] for x in S_data])
+
+    # Just this day's products (the neighbouring days' tasks save the rest)
+    day_start = day.timestamp()
+    day_end = (day + datetime.timedelta(days=1)).timestamp()
+    S_data = [x for x in S_data if day_start <= get_timestamp(x) < day_end]
+
+    if not S_data:
+        return []
+    return save_survey_to_file_tree(S_data, out_root, file_types=file_types, save_invalid=False)
+
+def main(shared=None):
     # -------- Load configuration file --------
     config = ConfigParser()
     fp = open('GSS_settings.conf')
@@ -214,7 +267,11 @@ def main():
     # Get the range of header timestamps corresponding to
     # packets added after the last time we ran:
     
-    tsmin, tsmax = get_time_range_for_updated_packets(packet_db, last_timestamp)
+    # Read from the packets shared by process_pipeline, if we were given them
+    if shared is not None:
+        tsmin, tsmax = shared.get_time_range_for_updated_packets(last_timestamp)
+    else:
+        tsmin, tsmax = get_time_range_for_updated_packets(packet_db, last_timestamp)
 
     if (not tsmin) or (not tsmax):
         logging.info('No new data to process')
@@ -230,7 +287,10 @@ def main():
         # packets = load_packets_from_tree(in_root)
 
         # this version from the database!
-        packets = get_packets_within_range(packet_db, dtype='S', t1=tmin, t2 = tmax)
+        if shared is not None:
+            packets = shared.get_packets_within_range(dtype='S', t1=tmin, t2=tmax)
+        else:
+            packets = get_packets_within_range(packet_db, dtype='S', t1=tmin, t2 = tmax)
 
 
         # -------------------- Decode survey data from packets --------------------
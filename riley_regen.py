@@ -6,7 +6,7 @@ import json
 import datetime
 
 from process_packets import load_from_telemetry, save_packets_to_file_tree
-from file_handlers import load_packets_from_tree, read_burst_XML, read_survey_XML
+from file_handlers import load_packets_from_tree, read_burst_XML, read_survey_XML, prefetch
 from data_handlers import decode_packets_TLM, decode_packets_CSV, decode_survey_data, unique_entries, decode_burst_data_between_status_packets, decode_burst_data_by_experiment_number, decode_burst_data_in_range, decode_burst_data_by_trailing_status_packet
 from process_survey_data import save_survey_to_file_tree
 from compute_ground_track import fill_missing_GPS_entries
@@ -59,7 +59,8 @@ for root, dirs, files in os.walk(check_for_bursts):
         if 'burst' in fname and fname.endswith('.xml'):
             bursts_to_do.append(os.path.join(root, fname))
 print(bursts_to_do)
-burst_data = [read_burst_XML(burst_file) for burst_file in bursts_to_do]
+# (Reading the next few files in while each one is parsed)
+burst_data = [burst.result() for burst_file, burst in prefetch(bursts_to_do, read_burst_XML)]
 gen_burst_plots(burst_data, out_root + '/figures/')
 """
 # correct the uBBr calibration inputs
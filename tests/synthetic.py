@@ -0,0 +1,137 @@
+'''
+Synthetic VPM telemetry for the tests: .TLM and .CSV files built from known
+packets, so the decoders' output can be checked against what went in.
+'''
+import struct
+import itertools
+import datetime
+import numpy as np
+
+PACKET_SIZE = 512
+
+# The CCSDS time of the first packet in each file (then about one second per packet)
+EPOCH_SEC = 1270000000
+
+# GPS time (in the CCSDS headers) is ahead of UTC by the leap seconds since 1980: 18, in 2020
+GPS_EPOCH = datetime.datetime(1980, 1, 6, tzinfo=datetime.timezone.utc)
+LEAP_SECONDS = 18
+
+
+def escape(data):
+    ''' Escapes 0x7E / 0x7D bytes, as VPM does '''
+    out = []
+    for x in data:
+        if x == 0x7E:
+            out += [0x7D, 0x5E]
+        elif x == 0x7D:
+            out += [0x7D, 0x5D]
+        else:
+            out.append(x)
+    return out
+
+def make_frame(rng, start_ind, dtype, exp_num, corrupt=False):
+    '''
+    A raw (escaped) PACKET_SIZE-byte frame, with a random payload (including some
+    bytes which need escaping). Returns the frame, and the payload. If corrupt is
+    set, the checksum is wrong.
+    '''
+    while True:
+        body = escape(list(struct.pack('>I', start_ind)) + [ord(dtype), exp_num])
+        data = []
+        while True:
+            x = int(rng.choice([0x7E, 0x7D])) if rng.random() < 0.02 else int(rng.integers(0, 0x7D))
+            if len(body) + len(escape([x])) > PACKET_SIZE - 7:
+                break
+            data.append(x)
+            body += escape([x])
+        # (Pad to length with bytes which don't need escaping)
+        while len(body) < PACKET_SIZE - 7:
+            data.append(1)
+            body.append(1)
+
+        bytecount = list(struct.pack('>H', len(data)))
+        frame = [0x7E] + body + bytecount + [0, 0, 0, 0x7E]
+        checksum = sum(frame[2:PACKET_SIZE - 3]) % 256
+        if corrupt:
+            checksum = (checksum + 1) % 256
+        if 0x7E in bytecount or 0x7D in bytecount or checksum in (0x7E, 0x7D):
+            continue
+        frame[PACKET_SIZE - 3] = checksum
+        return frame, data
+
+def unflagged(x):
+    ''' Whether the 4 bytes of x are free of 0x7E / 0x7D (so x can go in a CCSDS header) '''
+    return not {0x7E, 0x7D} & set(struct.pack('>I', x))
+
+def make_packets(n, seed=0):
+    ''' n packets to send: dicts of start_ind, dtype, exp_num, epoch_sec, ns and corrupt '''
+    rng = np.random.default_rng(seed)
+    epochs = (x for x in itertools.count(EPOCH_SEC) if unflagged(x))
+    packets = []
+    for i in range(n):
+        ns = int(rng.integers(0, 10**9))
+        while not unflagged(ns):
+            ns = int(rng.integers(0, 10**9))
+        packets.append(dict(start_ind=int(rng.integers(0, 10**6)), dtype=str(rng.choice(list('SEBGI'))),
+                            exp_num=int(rng.integers(0, 256)), epoch_sec=next(epochs), ns=ns,
+                            corrupt=bool(rng.random() < 0.05)))
+    return packets
+
+def CCSDS_header(epoch_sec, ns):
+    ''' The 26-byte CCSDS header which precedes each frame in a .TLM file '''
+    return list(struct.pack('>I', PACKET_SIZE + 22)) + [0, 34, 1, 2] + \
+           list(struct.pack('>I', epoch_sec)) + list(struct.pack('>I', ns)) + \
+           list(struct.pack('>H', 3)) + [0]*8
+
+def make_tlm(packets, seed=0, junk=True):
+    '''
+    The contents of a .TLM file holding packets (from make_packets), with some junk
+    between them. Returns the file contents, and the packets which should decode
+    (the ones which aren't corrupt), each with its payload ('data'), CCSDS header
+    fields (header_epoch_sec, header_ns) and the UTC time they give (header_timestamp).
+    '''
+    rng = np.random.default_rng(seed)
+    out = []
+    expected = []
+    for p in packets:
+        if junk and rng.random() < 0.1:
+            out += [int(x) for x in rng.integers(0, 0x7D, int(rng.integers(1, 700)))]
+        frame, data = make_frame(rng, p['start_ind'], p['dtype'], p['exp_num'], p['corrupt'])
+        header = CCSDS_header(p['epoch_sec'], p['ns'])
+        assert 0x7E not in header
+        out += header + frame
+        if not p['corrupt']:
+            t = GPS_EPOCH + datetime.timedelta(seconds=p['epoch_sec'] - LEAP_SECONDS, microseconds=p['ns']/1000)
+            expected.append(dict(p, data=data, header_epoch_sec=p['epoch_sec'], header_ns=p['ns'],
+                                 header_timestamp=t.timestamp()))
+    return bytes(out), expected
+
+def make_csv(packets, seed=0, delimiter=','):
+    '''
+    The contents of a .CSV file (in the KSat format) holding packets (from make_packets),
+    with some rows for other packet types, and some garbage. Returns the file contents,
+    and the packets which should decode, each with its payload ('data'), receive time
+    ('header_timestamp') and row number ('file_index').
+    '''
+    rng = np.random.default_rng(seed)
+    lines = ['Some preamble', 'Exported by KSat', '',
+             delimiter.join(['TARGET', 'PACKET', 'UTC_TIME', 'EXTRA', 'DYNAMIC_DATA', 'OTHER'])]
+    rows = 0
+    expected = []
+    t0 = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+    for i, p in enumerate(packets):
+        if rng.random() < 0.05:
+            lines.append(delimiter.join(['VPM-1', 'SOMETHING_ELSE', '2020-06-01T00:00:00.000000Z', 'x', 'abcd', 'y']))
+            rows += 1
+        if rng.random() < 0.02:
+            lines.append('garbage')
+            rows += 1
+
+        t = t0 + datetime.timedelta(seconds=i, microseconds=int(rng.integers(0, 10**6)))
+        frame, data = make_frame(rng, p['start_ind'], p['dtype'], p['exp_num'], p['corrupt'])
+        lines.append(delimiter.join(['VPM-1', 'PAYLOAD_INTERFACE_RECEIVE_RAW_PAYLOAD_DATA',
+                                     t.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), 'x', bytes(frame).hex().upper(), 'y']))
+        if not p['corrupt']:
+            expected.append(dict(p, data=data, header_timestamp=t.timestamp(), file_index=rows))
+        rows += 1
+    return ('\n'.join(lines) + '\n').encode(), expected
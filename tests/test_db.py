@@ -0,0 +1,278 @@
+import os
+import sqlite3
+import datetime
+import numpy as np
+import pytest
+
+from db_handlers import connect_packet_db, write_to_db, get_file_manifest, set_file_entry, delete_file_packets
+from db_handlers import get_table_columns, set_file_data_times, remove_duplicate_packets
+from db_handlers import get_last_access_time, log_access_time
+from db_handlers import db_connection, get_packets_within_range, iter_packets_within_range, packet_hashes
+from db_handlers import PACKET_DB_VERSION, PACKET_INDEXES
+from data_handlers import decode_packets_TLM, decode_packets_CSV
+from packet_batch import PacketBatch, HEADER_FIELDS
+from synthetic import make_packets, make_tlm, make_csv
+
+# The packets table, as created before the database was versioned
+LEGACY_PACKETS_TABLE = ''' CREATE TABLE packets (data BLOB, start_ind INTEGER, dtype TEXT, exp_num INTEGER,
+                           bytecount INTEGER, checksum_verify INTEGER, packet_length INTEGER, fname TEXT,
+                           header_timestamp REAL, file_index INTEGER, hash INTEGER, header_ns INTEGER,
+                           header_epoch_sec INTEGER, header_reboots INTEGER, added REAL) '''
+
+
+@pytest.fixture(scope='module')
+def tlm_packets(tmp_path_factory):
+    root = tmp_path_factory.mktemp('tlm')
+    (root / 'a.TLM').write_bytes(make_tlm(make_packets(200, seed=4), seed=4)[0])
+    return decode_packets_TLM(root, 'a.TLM')
+
+@pytest.fixture(scope='module')
+def csv_packets(tmp_path_factory):
+    ''' CSV packets, where every payload is received twice (at different times) '''
+    root = tmp_path_factory.mktemp('csv')
+    packets = make_packets(100, seed=5)
+    (root / 'a.csv').write_bytes(make_csv(packets + packets, seed=5)[0])
+    return decode_packets_CSV(root, 'a.csv')
+
+def count(conn, sql='SELECT COUNT(*) FROM packets', params=()):
+    return conn.execute(sql, params).fetchone()[0]
+
+def stored_hashes(conn):
+    rows = conn.execute('SELECT hash FROM packets ORDER BY rowid').fetchall()
+    return [x[0] for x in rows]
+
+def write_legacy(conn, packets, fname):
+    ''' Inserts packets as the original write_to_db did, with python's (per-process) hash '''
+    packets = list(packets)
+    names = [k for k in HEADER_FIELDS if k in packets[0] and k not in ('fname', 'hash', 'added')]
+    rows = [(bytes(np.asarray(p['data'], dtype=np.uint8)), *[p[k] for k in names], fname,
+             hash(str([p[k] for k in names])), 1.0) for p in packets]
+    conn.executemany(f"INSERT INTO packets (data, {', '.join(names)}, fname, hash, added) "
+                     f"VALUES ({', '.join('?'*(len(names) + 4))})", rows)
+
+
+def test_migrate_legacy(tmp_path, tlm_packets, csv_packets):
+    ''' A database from before the migrations: python hashes, duplicates, and no file manifest '''
+    db = str(tmp_path / 'packets.db')
+    conn = sqlite3.connect(db)
+    conn.execute(LEGACY_PACKETS_TABLE)
+    write_legacy(conn, tlm_packets, 'a.TLM')
+    write_legacy(conn, csv_packets, 'a.csv')
+    # The same file decoded twice, and a copy of a packet (in another file) with a different reboot count
+    write_legacy(conn, tlm_packets[:50], 'a.TLM')
+    changed = PacketBatch.concatenate([tlm_packets[60:61]])
+    changed.columns['header_reboots'] = changed['header_reboots'] + 1
+    write_legacy(conn, changed, 'b.TLM')
+    conn.commit()
+    conn.close()
+
+    conn = connect_packet_db(db)
+    assert count(conn, 'PRAGMA user_version') == PACKET_DB_VERSION
+    # The exact copies are gone; the CSV repeats are kept, and so is the one that differs
+    assert count(conn) == len(tlm_packets) + len(csv_packets) + 1
+    hashes = stored_hashes(conn)
+    assert hashes[:-1] == packet_hashes(tlm_packets) + packet_hashes(csv_packets)
+    assert hashes[-1] is None
+
+    indexes = [x[1] for x in conn.execute('PRAGMA index_list(packets)').fetchall()]
+    assert {name for name, cols in PACKET_INDEXES} | {'packets_hash', 'packets_path'} <= set(indexes)
+    assert 'path' in get_table_columns(conn, 'packets')
+
+    # The files with packets are listed, by name
+    manifest = get_file_manifest(db)
+    assert sorted(manifest) == ['a.TLM', 'a.csv', 'b.TLM']
+    assert manifest['a.TLM']['status'] == 'decoded'
+    assert manifest['a.TLM']['packet_count'] == len(tlm_packets)
+
+    # ... and the unique index works from now on
+    write_to_db(conn, tlm_packets)
+    conn.commit()
+    assert count(conn) == len(tlm_packets) + len(csv_packets) + 1
+
+def test_migrate_manifest(tmp_path, tlm_packets):
+    ''' A version 2 database, whose files table was keyed by file name '''
+    db = str(tmp_path / 'packets.db')
+    conn = sqlite3.connect(db)
+    conn.execute(LEGACY_PACKETS_TABLE)
+    write_legacy(conn, tlm_packets, 'a.TLM')
+    conn.executemany('UPDATE packets SET hash=? WHERE rowid=?',
+                     zip(packet_hashes(tlm_packets), range(1, len(tlm_packets) + 1)))
+    conn.execute('''CREATE TABLE files (fname TEXT PRIMARY KEY, path TEXT, size INTEGER, bytes_decoded INTEGER,
+                    updated REAL, mtime REAL, digest TEXT, status TEXT, packet_count INTEGER,
+                    checksum_failures INTEGER)''')
+    conn.execute("INSERT INTO files VALUES ('a.TLM', '/data/a.TLM', 100, 100, 1, 2, NULL, 'decoded', ?, 0)",
+                 (len(tlm_packets),))
+    conn.execute('PRAGMA user_version = 2')
+    conn.commit()
+    conn.close()
+
+    conn = connect_packet_db(db)
+    assert count(conn, 'PRAGMA user_version') == PACKET_DB_VERSION
+    assert get_table_columns(conn, 'files')[:1] == ['path']
+    manifest = get_file_manifest(db)
+    assert list(manifest) == ['/data/a.TLM']
+    assert manifest['/data/a.TLM']['fname'] == 'a.TLM'
+    assert manifest['/data/a.TLM']['size'] == 100
+    assert manifest['/data/a.TLM']['data_time'] is None
+    assert count(conn, 'SELECT COUNT(*) FROM packets WHERE path=?', ('/data/a.TLM',)) == len(tlm_packets)
+    assert stored_hashes(conn) == packet_hashes(tlm_packets)
+
+def test_hash_collision(tmp_path):
+    ''' Different packets with the same hash are both kept, and lose their hash '''
+    conn = sqlite3.connect(str(tmp_path / 'packets.db'))
+    conn.execute(LEGACY_PACKETS_TABLE)
+    rows = [(b'\x01', 1, 7), (b'\x01', 1, 7), (b'\x02', 2, 7), (b'\x03', 3, 8)]
+    conn.executemany('INSERT INTO packets (data, start_ind, hash) VALUES (?, ?, ?)', rows)
+    assert remove_duplicate_packets(conn) == (1, 1)
+    assert conn.execute('SELECT start_ind, hash FROM packets ORDER BY rowid').fetchall() == [(1, 7), (2, None), (3, 8)]
+
+def test_manifest(tmp_path, tlm_packets):
+    db = str(tmp_path / 'packets.db')
+    conn = connect_packet_db(db)
+    # Two files with the same name, in different directories
+    for path in ['/x/a.TLM', '/y/a.TLM']:
+        write_to_db(conn, tlm_packets[:100] if path[1] == 'x' else tlm_packets[100:], path=path)
+        set_file_entry(conn, path, 'a.TLM', 1000, 5.0, 1000, 'decoded', packet_count=100, data_time=7.0)
+    set_file_entry(conn, '/x/b.TLM', 'b.TLM', 10, 6.0, 0, 'failed')
+    set_file_data_times(conn, [('/y/a.TLM', 'a.TLM', 1000, 5.0, 8.0), ('/z/c.TLM', 'c.TLM', 10, 6.0, 9.0)])
+    conn.commit()
+
+    manifest = get_file_manifest(db)
+    assert sorted(manifest) == ['/x/a.TLM', '/x/b.TLM', '/y/a.TLM', '/z/c.TLM']
+    assert manifest['/x/a.TLM']['fname'] == 'a.TLM'
+    assert manifest['/y/a.TLM']['bytes_decoded'] == 1000
+    assert manifest['/x/b.TLM']['status'] == 'failed'
+    # (A data time is kept for files yet to be decoded, and updated for the rest)
+    assert manifest['/x/a.TLM']['data_time'] == 7.0
+    assert manifest['/y/a.TLM']['data_time'] == 8.0
+    assert manifest['/y/a.TLM']['status'] == 'decoded'
+    assert manifest['/z/c.TLM']['status'] == 'pending'
+
+    assert delete_file_packets(conn, '/x/a.TLM') == 100
+    conn.commit()
+    assert count(conn) == len(tlm_packets) - 100
+
+def test_journal_mode(tmp_path):
+    ''' synchronous is only relaxed in WAL mode '''
+    conn = connect_packet_db(str(tmp_path / 'wal.db'), journal_mode='WAL')
+    assert count(conn, 'PRAGMA synchronous') == 1
+    conn = connect_packet_db(str(tmp_path / 'delete.db'))
+    assert count(conn, 'PRAGMA synchronous') == 2
+
+def test_hashes(tlm_packets, csv_packets):
+    hashes = packet_hashes(tlm_packets)
+    assert len(set(hashes)) == len(hashes)
+    # The same packet, from another file or another run, hashes the same
+    moved = PacketBatch.concatenate([tlm_packets])
+    moved.columns['fname'] = np.full(len(moved), 'b.TLM', dtype=object)
+    moved.columns['added'] = np.full(len(moved), 5.0)
+    assert packet_hashes(moved) == hashes
+
+    # Repeats of the same CSV payload hash differently, by receive time and row
+    hashes = packet_hashes(csv_packets)
+    assert len(set(hashes)) == len(hashes) == len(csv_packets)
+
+def test_write_dedup(tmp_path, tlm_packets, csv_packets):
+    db = str(tmp_path / 'packets.db')
+    conn = connect_packet_db(db)
+    write_to_db(conn, tlm_packets, path='/x/a.TLM')
+    write_to_db(conn, csv_packets, path='/x/a.csv')
+    conn.commit()
+    assert count(conn) == len(tlm_packets) + len(csv_packets)
+
+    # Writing any of them again (e.g. a second downlink of the same data) adds nothing
+    write_to_db(conn, tlm_packets[::3], path='/y/a.TLM')
+    write_to_db(conn, csv_packets, path='/y/a.csv')
+    conn.commit()
+    assert count(conn) == len(tlm_packets) + len(csv_packets)
+    assert count(conn, 'SELECT COUNT(*) FROM packets WHERE path=?', ('/x/a.TLM',)) == len(tlm_packets)
+    assert stored_hashes(conn) == packet_hashes(tlm_packets) + packet_hashes(csv_packets)
+
+def test_read_back(tmp_path, tlm_packets):
+    ''' A batch of packets reads back as it went in, with one time added per batch '''
+    db = str(tmp_path / 'packets.db')
+    conn = connect_packet_db(db)
+    write_to_db(conn, tlm_packets)
+    conn.commit()
+    conn.close()
+
+    stored = get_packets_within_range(db)
+    order = np.argsort(tlm_packets['header_timestamp'], kind='stable')
+    assert len(stored) == len(tlm_packets)
+    for k in ('start_ind', 'dtype', 'exp_num', 'bytecount', 'header_timestamp', 'header_ns'):
+        assert list(stored[k]) == list(tlm_packets[order][k])
+    assert [bytes(x) for x in stored['data']] == [bytes(x) for x in tlm_packets[order]['data']]
+    assert len(set(stored['added'])) == 1
+    assert len(set(stored['hash'])) == len(stored)
+
+    # Only the columns asked for, in batches
+    ts = stored['header_timestamp']
+    t1, t2 = (datetime.datetime.fromtimestamp(x) for x in (ts[20], ts[150]))
+    batches = list(iter_packets_within_range(db, t1=t1, t2=t2, columns=['dtype', 'header_timestamp'], batch_size=40))
+    assert [len(b) for b in batches] == [40, 40, 40, 9]
+    assert list(batches[0].columns) == ['dtype', 'header_timestamp']
+    assert (PacketBatch.concatenate(batches)['header_timestamp'] == ts[21:150]).all()
+    assert len(get_packets_within_range(db, dtype='S', t1=t1, t2=t2)) == np.sum(stored[21:150]['dtype'] == 'S')
+    with pytest.raises(ValueError):
+        list(iter_packets_within_range(db, columns=['nonsense']))
+
+def test_indexes(tmp_path):
+    ''' A new database is indexed, and queries by type and time use the index '''
+    db = str(tmp_path / 'packets.db')
+    conn = connect_packet_db(db)
+    indexes = {x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert {name for name, columns in PACKET_INDEXES} <= indexes
+    assert count(conn, 'PRAGMA user_version') == PACKET_DB_VERSION
+
+    plan = conn.execute('''EXPLAIN QUERY PLAN SELECT * FROM packets
+                           WHERE dtype=? AND header_timestamp > ? AND header_timestamp < ?''', ('S', 0, 1)).fetchall()
+    assert 'packets_dtype_time' in str(plan)
+    conn.close()
+
+def test_db_connection(tmp_path, tlm_packets):
+    ''' One connection per database, reused until its file is replaced; queries can't write '''
+    db = str(tmp_path / 'packets.db')
+    conn = connect_packet_db(db)
+    write_to_db(conn, tlm_packets)
+    conn.commit()
+    conn.close()
+
+    with db_connection(db) as a:
+        assert count(a) == len(tlm_packets)
+        with pytest.raises(sqlite3.OperationalError):
+            a.execute('DELETE FROM packets')
+    with db_connection(db) as b:
+        assert b is a
+    with db_connection(db, read_only=False) as c:
+        assert c is not a
+        c.execute('DELETE FROM packets WHERE dtype=?', ('S',))
+    assert len(get_packets_within_range(db)) == np.sum(tlm_packets['dtype'] != 'S')
+
+    os.replace(db, str(tmp_path / 'old.db'))
+    conn = connect_packet_db(db)
+    conn.close()
+    with db_connection(db) as d:
+        assert count(d) == 0
+
+    # A missing database isn't created by a query
+    missing = str(tmp_path / 'missing.db')
+    with pytest.raises(sqlite3.OperationalError):
+        get_packets_within_range(missing)
+    assert not os.path.exists(missing)
+
+def test_access_log(tmp_path):
+    ''' A log which hasn't been written yet reads as never accessed, and isn't created by reading it '''
+    (tmp_path / 'CU data').mkdir()
+    log = str(tmp_path / 'CU data' / 'access #1.db')
+    assert get_last_access_time(log, 'process_survey_data') == 0
+    assert not os.path.exists(log)
+
+    # (Nor one with no log table)
+    empty = str(tmp_path / 'empty.db')
+    sqlite3.connect(empty).execute('CREATE TABLE x (y)')
+    assert get_last_access_time(empty, 'process_survey_data') == 0
+
+    log_access_time(log, 'process_survey_data')
+    t = get_last_access_time(log, 'process_survey_data')
+    assert abs(t - datetime.datetime.now().timestamp()) < 60
+    assert get_last_access_time(log, 'process_status_data') == 0
@@ -0,0 +1,145 @@
+import io
+import numpy as np
+import pytest
+
+from data_handlers import decode_packets_TLM, iter_packets_TLM, find_sequences
+from data_handlers import decode_packets_CSV
+from data_handlers import iter_packets_TLM_stream, decode_packets_CSV_stream
+from synthetic import make_packets, make_tlm, make_csv
+
+
+def as_dicts(packets):
+    ''' Decoded packets as plain dictionaries, with their payloads as lists, for comparing '''
+    return [dict(p, data=np.asarray(p['data']).tolist()) for p in packets]
+
+def check_packets(packets, expected, fields=('start_ind', 'dtype', 'exp_num', 'header_epoch_sec', 'header_ns')):
+    ''' Checks decoded packets against the packets from synthetic.make_tlm / make_csv '''
+    packets = as_dicts(packets)
+    assert len(packets) == len(expected)
+    for p, e in zip(packets, expected):
+        assert p['data'] == e['data']
+        assert p['bytecount'] == len(e['data'])
+        assert p['checksum_verify']
+        for k in fields:
+            assert p[k] == e[k], k
+    np.testing.assert_allclose([p['header_timestamp'] for p in packets],
+                               [e['header_timestamp'] for e in expected], rtol=0, atol=1e-6)
+
+def find_naive(arr, seq):
+    return [i for i in range(len(arr) - len(seq) + 1) if list(arr[i:i + len(seq)]) == list(seq)]
+
+
+@pytest.fixture
+def tlm_file(tmp_path):
+    contents, expected = make_tlm(make_packets(300, seed=1), seed=1)
+    (tmp_path / 'test.TLM').write_bytes(contents)
+    return tmp_path, 'test.TLM', contents, expected
+
+@pytest.fixture
+def csv_file(tmp_path):
+    contents, expected = make_csv(make_packets(300, seed=2), seed=2)
+    (tmp_path / 'test.csv').write_bytes(contents)
+    return tmp_path, 'test.csv', contents, expected
+
+
+def test_decode_TLM(tlm_file):
+    ''' Every packet with a good checksum is decoded, however much junk there is between them '''
+    root, fname, contents, expected = tlm_file
+    counts = dict()
+    packets = decode_packets_TLM(root, fname, counts=counts)
+
+    check_packets(packets, expected)
+    assert counts['frames'] == 300
+    assert counts['checksum_failures'] == 300 - len(expected) > 0
+    assert all(p['fname'] == fname for p in packets)
+
+def test_decode_TLM_short(tmp_path):
+    ''' Files with no complete packets '''
+    contents, expected = make_tlm(make_packets(1), junk=False)
+    (tmp_path / 'a.TLM').write_bytes(contents[:-1])
+    assert len(decode_packets_TLM(tmp_path, 'a.TLM')) == 0
+    (tmp_path / 'b.TLM').write_bytes(b'')
+    assert len(decode_packets_TLM(tmp_path, 'b.TLM')) == 0
+
+@pytest.mark.parametrize('chunk_size', [1000, 4096, 100000, 10**8])
+def test_iter_TLM_chunks(tlm_file, chunk_size):
+    ''' Packets straddling chunk boundaries are decoded exactly once '''
+    root, fname, contents, expected = tlm_file
+    packets = []
+    offsets = []
+    counts = dict()
+    for batch, next_offset in iter_packets_TLM(root, fname, chunk_size=chunk_size, counts=counts):
+        packets.extend(batch)
+        offsets.append(next_offset)
+    whole_counts = dict()
+    assert as_dicts(packets) == as_dicts(decode_packets_TLM(root, fname, counts=whole_counts))
+    assert offsets == sorted(offsets)
+    assert counts == whole_counts
+
+@pytest.mark.parametrize('cut', [5000, 5000 + 13, 60000 + 511])
+def test_iter_TLM_resume(tlm_file, cut):
+    ''' Resuming from next_offset after the file grows picks up every packet, once '''
+    root, fname, contents, expected = tlm_file
+    (root / fname).write_bytes(contents[:cut])
+    first = []
+    for batch, next_offset in iter_packets_TLM(root, fname, chunk_size=2000):
+        first.extend(batch)
+    assert next_offset <= cut
+
+    (root / fname).write_bytes(contents)
+    rest = [p for batch, _ in iter_packets_TLM(root, fname, chunk_size=2000, start_offset=next_offset) for p in batch]
+    check_packets(first + rest, expected)
+
+@pytest.mark.parametrize('chunk_size', [1000, 100000])
+def test_iter_TLM_stream(tlm_file, chunk_size):
+    ''' Reading a file from start to finish (e.g., while decompressing it) gives the same packets '''
+    root, fname, contents, expected = tlm_file
+    packets = [p for batch, _ in iter_packets_TLM_stream(io.BytesIO(contents), fname, chunk_size=chunk_size)
+               for p in batch]
+    assert as_dicts(packets) == as_dicts(decode_packets_TLM(root, fname))
+
+def test_decode_CSV(csv_file):
+    root, fname, contents, expected = csv_file
+    counts = dict()
+    packets = decode_packets_CSV(root, fname, counts=counts)
+    check_packets(packets, expected, fields=('start_ind', 'dtype', 'exp_num', 'file_index'))
+    assert counts['checksum_failures'] == 300 - len(expected) > 0
+    assert counts['rows'] == len(contents.split(b'TARGET')[1].splitlines()) - 1
+
+@pytest.mark.parametrize('chunk_size', [1000, 5000])
+def test_decode_CSV_chunks(csv_file, chunk_size):
+    ''' Lines straddling chunk boundaries are decoded in full, with the right row numbers '''
+    root, fname, contents, expected = csv_file
+    assert as_dicts(decode_packets_CSV(root, fname, chunk_size=chunk_size)) == as_dicts(decode_packets_CSV(root, fname))
+
+@pytest.mark.parametrize('delimiter', [' ', '\t'])
+def test_decode_CSV_delimiter(tmp_path, delimiter):
+    contents, expected = make_csv(make_packets(50, seed=3), seed=3, delimiter=delimiter)
+    (tmp_path / 'test.csv').write_bytes(contents)
+    check_packets(decode_packets_CSV(tmp_path, 'test.csv'), expected, fields=('start_ind', 'file_index'))
+
+def test_decode_CSV_parallel(csv_file):
+    ''' Splitting the file into byte ranges doesn't change the packets or their row numbers '''
+    root, fname, contents, expected = csv_file
+    serial_counts, parallel_counts = dict(), dict()
+    serial = decode_packets_CSV(root, fname, chunk_size=5000, counts=serial_counts)
+    parallel = decode_packets_CSV(root, fname, chunk_size=5000, workers=3, min_range_size=20000,
+                                  counts=parallel_counts)
+    assert as_dicts(parallel) == as_dicts(serial)
+    assert parallel_counts == serial_counts
+
+def test_decode_CSV_stream(csv_file):
+    root, fname, contents, expected = csv_file
+    packets = decode_packets_CSV_stream(io.BytesIO(contents), fname, chunk_size=3000)
+    assert as_dicts(packets) == as_dicts(decode_packets_CSV(root, fname))
+
+def test_find_sequences():
+    ''' Every match of each pattern (including overlapping ones, and ones at the ends) '''
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 4, 5000).astype(np.uint8)
+    arr[-3:] = [1, 2, 1]
+    seqs = [[1, 2], [1, 2, 1], [2, 2, 2], [3], [0, 1, 2, 3, 0, 1], [7, 1]]
+    found = find_sequences(arr, seqs)
+    assert len(found) == len(seqs)
+    for seq, inds in zip(seqs, found):
+        assert inds.tolist() == find_naive(arr, seq)
@@ -0,0 +1,33 @@
+import threading
+import pytest
+
+from file_handlers import prefetch
+
+
+@pytest.mark.parametrize('read_ahead', [0, 1, 3])
+def test_prefetch(read_ahead):
+    ''' Items come back in order, with their loads; a failed load raises when its result is taken '''
+    def load(x):
+        if x == 5:
+            raise ValueError(x)
+        return x*x
+    out = []
+    for item, future in prefetch(range(10), load, read_ahead):
+        if item == 5:
+            with pytest.raises(ValueError):
+                future.result()
+        else:
+            out.append((item, future.result()))
+    assert out == [(x, x*x) for x in range(10) if x != 5]
+
+def test_prefetch_bounded():
+    ''' No more than read_ahead loads are started past the item the caller is on '''
+    started = []
+    lock = threading.Lock()
+    def load(x):
+        with lock:
+            started.append(x)
+        return x
+    for item, future in prefetch(range(20), load, read_ahead=3):
+        future.result()
+        assert max(started) <= item + 3
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from packet_batch import PacketBatch, HEADER_FIELDS
+
+
+def make_list(n=20, seed=0):
+    ''' A list of packet dictionaries, as the decoders used to return '''
+    rng = np.random.default_rng(seed)
+    packets = []
+    for i in range(n):
+        packets.append(dict(data=rng.integers(0, 256, int(rng.integers(1, 50))).astype(np.uint8),
+                            start_ind=int(rng.integers(0, 1000)), dtype=str(rng.choice(list('SEB'))),
+                            exp_num=int(rng.integers(0, 4)), bytecount=0, checksum_verify=True,
+                            packet_length=512, fname='a.TLM', header_timestamp=float(rng.integers(0, 100)),
+                            file_index=None))
+    return packets
+
+def payloads(packets):
+    return [np.asarray(p['data']).tolist() for p in packets]
+
+
+def test_round_trip():
+    packets = make_list()
+    batch = PacketBatch.from_packets(packets)
+    assert len(batch) == len(packets)
+    assert payloads(batch) == payloads(packets)
+    for p, q in zip(batch, packets):
+        assert {k: v for k, v in p.items() if k != 'data'} == {k: v for k, v in q.items() if k != 'data'}
+    # Missing values are stored as their placeholder, and come back as None
+    assert (batch['file_index'] == HEADER_FIELDS['file_index'][1]).all()
+
+def test_payload_read_only():
+    ''' Payloads are read-only views into the batch's buffer, not copies '''
+    batch = PacketBatch.from_packets(make_list())
+    p = batch[3]
+    assert isinstance(p['data'], np.ndarray)
+    assert np.shares_memory(p['data'], batch.payload)
+    with pytest.raises(ValueError):
+        p['data'][0] = 1
+
+def test_selection_shares_payload():
+    batch = PacketBatch.from_packets(make_list())
+    views = [batch[2:7], batch[batch['exp_num'] == 1], batch.by_dtype('S'),
+             batch.in_time_range(20, 60), batch.sort()] + list(batch.group_by_exp_num().values())
+    for view in views:
+        assert np.shares_memory(view.payload, batch.payload)
+
+    sub = batch[[5, 1, 3]]
+    assert payloads(sub) == [batch.data(i).tolist() for i in [5, 1, 3]]
+    assert sub['start_ind'].tolist() == batch['start_ind'][[5, 1, 3]].tolist()
+    assert payloads([batch[4]]) == [batch.data(4).tolist()]
+
+def test_views():
+    packets = make_list(50)
+    batch = PacketBatch.from_packets(packets)
+
+    assert batch.by_dtype('SE')['dtype'].tolist() == [p['dtype'] for p in packets if p['dtype'] in 'SE']
+    ts = batch.in_time_range(20, 60)['header_timestamp']
+    assert ((ts >= 20) & (ts <= 60)).all()
+    assert len(ts) == sum(20 <= p['header_timestamp'] <= 60 for p in packets)
+
+    s = batch.sort()
+    assert (np.diff(s['header_timestamp']) >= 0).all()
+
+    groups = batch.group_by_exp_num()
+    assert list(groups) == sorted(groups)
+    assert sum(len(g) for g in groups.values()) == len(batch)
+    for e, g in groups.items():
+        assert (g['exp_num'] == e).all()
+        # (Keeping their order)
+        assert g['start_ind'].tolist() == [p['start_ind'] for p in packets if p['exp_num'] == e]
+
+def test_concatenate():
+    a, b = make_list(10, seed=1), make_list(7, seed=2)
+    for p in b:
+        del p['file_index']
+        p['header_epoch_sec'] = 5
+
+    batch = PacketBatch.concatenate([PacketBatch.from_packets(a)[::2], b, PacketBatch.empty()])
+    expected = a[::2] + b
+    assert len(batch) == len(expected)
+    assert payloads(batch) == payloads(expected)
+    # Columns missing from some batches are filled in with placeholders
+    assert [p['header_epoch_sec'] for p in batch] == [None]*5 + [5]*7
+    assert len(batch.payload) == sum(len(p['data']) for p in expected)
+
+    assert len(PacketBatch.concatenate([])) == 0
+
+def test_from_rows():
+    names = ['data', 'start_ind', 'dtype', 'header_timestamp', 'file_index']
+    rows = [(b'\x01\x02', 10, 'S', 1.5, None), (b'', 20, 'E', None, 3), (b'\x7e', 30, 'B', 2.5, 4)]
+    batch = PacketBatch.from_rows(names, rows)
+    assert [p['data'].tolist() for p in batch] == [[1, 2], [], [0x7E]]
+    assert batch.column_values('header_timestamp') == [1.5, None, 2.5]
+    assert batch.column_values('file_index') == [None, 3, 4]
+
+    # Header fields only
+    batch = PacketBatch.from_rows(names[1:], [r[1:] for r in rows])
+    assert batch.lengths.tolist() == [0, 0, 0]
+    assert batch['start_ind'].tolist() == [10, 20, 30]
+
+def test_reassemble():
+    batch = PacketBatch.from_packets([dict(data=[1, 2], start_ind=2), dict(data=[3], start_ind=5)])
+    out = batch.reassemble()
+    assert len(out) == 6
+    np.testing.assert_array_equal(out, [np.nan, np.nan, 1, 2, np.nan, 3])
+    with pytest.raises(ValueError):
+        batch.reassemble(5)
+
+def test_column_lengths():
+    with pytest.raises(ValueError):
+        PacketBatch(np.zeros(4), [0, 2], [2, 2], dict(start_ind=[1, 2, 3]))
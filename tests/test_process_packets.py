@@ -0,0 +1,247 @@
+import os
+import time
+import gzip
+import lzma
+import shutil
+import sqlite3
+import zipfile
+import pytest
+
+import process_packets
+from process_packets import process_packets as run_ingest
+from data_handlers import decode_packets_TLM
+from db_handlers import get_file_manifest
+from synthetic import make_packets, make_tlm, make_csv
+
+SETTINGS = '''
+[db_locations]
+telemetry_watch_directory = {watch}
+packet_db_file = {db}
+
+[packet_config]
+tail_follow = 1
+csv_workers = 1
+ingest_workers = {ingest_workers}
+read_ahead = {read_ahead}
+
+[pipeline_config]
+fresh_hours = {fresh_hours}
+
+[logging]
+log_level = INFO
+log_file =
+access_log = {access_log}
+'''
+
+
+@pytest.fixture
+def ingest(tmp_path, monkeypatch):
+    '''
+    A watch directory (ingest.watch) and a packet database (ingest.db) in tmp_path;
+    ingest(ingest_workers, read_ahead, fresh_hours, **kwargs) runs
+    process_packets(**kwargs) on them. Calls to file_digest and file_data_time are counted in ingest.calls.
+    '''
+    watch = tmp_path / 'watch'
+    watch.mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    calls = dict(file_digest=0, file_data_time=0)
+    for name in calls:
+        def counted(*args, name=name, func=getattr(process_packets, name)):
+            calls[name] += 1
+            return func(*args)
+        monkeypatch.setattr(process_packets, name, counted)
+
+    def ingest(ingest_workers=1, read_ahead=0, fresh_hours=0, **kwargs):
+        for k in calls:
+            calls[k] = 0
+        (tmp_path / 'GSS_settings.conf').write_text(SETTINGS.format(
+            watch=watch, db=ingest.db, access_log=tmp_path / 'access.log',
+            ingest_workers=ingest_workers, read_ahead=read_ahead, fresh_hours=fresh_hours))
+        return run_ingest(**kwargs)
+
+    ingest.watch = watch
+    ingest.db = str(tmp_path / 'packets.db')
+    ingest.calls = calls
+    return ingest
+
+def add_tlm(path, seed, n=150):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    contents = make_tlm(make_packets(n, seed=seed), seed=seed)[0]
+    path.write_bytes(contents)
+    return contents
+
+def packet_counts(db):
+    ''' Number of packets in the database from each file, by path '''
+    conn = sqlite3.connect(db)
+    rows = conn.execute('SELECT path, COUNT(*) FROM packets GROUP BY path').fetchall()
+    conn.close()
+    return dict(rows)
+
+def stored_packets(db, columns='path, header_timestamp, file_index, start_ind, data'):
+    conn = sqlite3.connect(db)
+    rows = conn.execute(f'SELECT {columns} FROM packets ORDER BY {columns}').fetchall()
+    conn.close()
+    return rows
+
+def num_decoded(path):
+    return len(decode_packets_TLM(path.parent, path.name))
+
+
+def test_ingest(ingest):
+    ''' Every file is decoded, once '''
+    x = ingest.watch / 'x' / 'a.tlm'
+    add_tlm(x, seed=10)
+    contents, expected = make_csv(make_packets(80, seed=12), seed=12)
+    (ingest.watch / 'b.csv').write_bytes(contents)
+
+    y = ingest.watch / 'b.csv'
+    ingest()
+    assert packet_counts(ingest.db) == {str(x): num_decoded(x), str(y): len(expected)}
+    manifest = get_file_manifest(ingest.db)
+    assert sorted(manifest) == sorted([str(x), str(y)])
+    assert all(v['status'] == 'decoded' and v['digest'] for v in manifest.values())
+    assert manifest[str(x)]['fname'] == 'a.tlm'
+    assert manifest[str(x)]['packet_count'] == num_decoded(x)
+    assert manifest[str(x)]['size'] == os.path.getsize(x)
+
+    # Nothing to do the second time
+    before = stored_packets(ingest.db)
+    ingest()
+    assert stored_packets(ingest.db) == before
+    assert ingest.calls == dict(file_digest=0, file_data_time=0)
+
+def test_changed(ingest):
+    '''
+    A changed file replaces its own packets (and only its own, even with the same name
+    in another folder); a touched file is skipped
+    '''
+    x, y = ingest.watch / 'x' / 'a.tlm', ingest.watch / 'y' / 'a.tlm'
+    add_tlm(x, seed=10)
+    add_tlm(y, seed=11)
+    ingest()
+    before = packet_counts(ingest.db)
+
+    add_tlm(y, seed=13, n=100)
+    ingest()
+    assert packet_counts(ingest.db) == {str(x): before[str(x)], str(y): num_decoded(y)}
+    assert get_file_manifest(ingest.db)[str(y)]['packet_count'] == num_decoded(y)
+
+    os.utime(x, (1, 1))
+    before = stored_packets(ingest.db)
+    ingest()
+    assert stored_packets(ingest.db) == before
+    assert ingest.calls['file_digest'] == 1
+    assert get_file_manifest(ingest.db)[str(x)]['mtime'] == 1
+
+def test_duplicate(ingest):
+    ''' A copy of a file already decoded (under any name) is listed, but not decoded again '''
+    x = ingest.watch / 'x' / 'a.tlm'
+    add_tlm(x, seed=10)
+    ingest()
+    before = stored_packets(ingest.db)
+
+    shutil.copy(x, ingest.watch / 'copy.tlm')
+    ingest()
+    assert stored_packets(ingest.db) == before
+    assert get_file_manifest(ingest.db)[str(ingest.watch / 'copy.tlm')]['status'] == 'duplicate'
+
+def test_resume(ingest):
+    ''' A growing .tlm file is picked up where it left off, without hashing the whole file again '''
+    x = ingest.watch / 'x' / 'a.tlm'
+    contents = add_tlm(x, seed=14, n=300)
+    x.write_bytes(contents[:40000 + 77])
+    ingest()
+    assert packet_counts(ingest.db) == {str(x): num_decoded(x)}
+
+    first = get_file_manifest(ingest.db)[str(x)]
+    assert 0 < first['bytes_decoded'] <= 40077
+
+    x.write_bytes(contents)
+    ingest()
+    assert packet_counts(ingest.db) == {str(x): num_decoded(x)}
+    # (Only the new bytes are read: the file isn't hashed, and its data time is kept)
+    entry = get_file_manifest(ingest.db)[str(x)]
+    assert ingest.calls == dict(file_digest=0, file_data_time=0)
+    assert entry['digest'] is None
+    assert entry['data_time'] == first['data_time']
+    assert get_file_manifest(ingest.db)[str(x)]['packet_count'] == num_decoded(x)
+
+@pytest.mark.parametrize('settings', [dict(ingest_workers=3), dict(read_ahead=2)])
+def test_parallel(ingest, settings):
+    ''' Decoding in worker processes gives the same database '''
+    for k in range(5):
+        add_tlm(ingest.watch / f'{k}.tlm', seed=20 + k)
+    contents, expected = make_csv(make_packets(80, seed=12), seed=12)
+    (ingest.watch / 'b.csv').write_bytes(contents)
+
+    ingest()
+    serial = stored_packets(ingest.db)
+    os.remove(ingest.db)
+    ingest(**settings)
+    assert stored_packets(ingest.db) == serial
+
+def test_compressed(ingest):
+    ''' Compressed files and zip archives are decoded without unpacking them, to the same packets '''
+    tlm = add_tlm(ingest.watch / 'plain' / 'a.tlm', seed=30)
+    csv = make_csv(make_packets(80, seed=31), seed=31)[0]
+    (ingest.watch / 'plain' / 'b.csv').write_bytes(csv)
+    ingest()
+    plain = stored_packets(ingest.db, columns='header_timestamp, file_index, start_ind, data')
+    shutil.rmtree(ingest.watch / 'plain')
+    os.remove(ingest.db)
+
+    with gzip.open(ingest.watch / 'a.tlm.gz', 'wb') as f:
+        f.write(tlm)
+    with lzma.open(ingest.watch / 'b.csv.xz', 'wb') as f:
+        f.write(csv)
+    ingest()
+    assert stored_packets(ingest.db, columns='header_timestamp, file_index, start_ind, data') == plain
+    assert sorted(packet_counts(ingest.db)) == [str(ingest.watch / x) for x in ['a.tlm.gz', 'b.csv.xz']]
+    os.remove(ingest.db)
+
+    for name in ['a.tlm.gz', 'b.csv.xz']:
+        os.remove(ingest.watch / name)
+    with zipfile.ZipFile(ingest.watch / 'pass.zip', 'w') as archive:
+        archive.writestr('a.tlm', tlm)
+        archive.writestr('notes.txt', 'not telemetry')
+        archive.writestr('b.csv.gz', gzip.compress(csv))
+    ingest()
+    assert stored_packets(ingest.db, columns='header_timestamp, file_index, start_ind, data') == plain
+
+def test_lanes(ingest):
+    ''' Files with recent data are done first, and the fresh lane leaves the older ones for the backlog '''
+    now = time.time()
+    for name, seed, mtime in [('old.csv', 20, now - 86400*30), ('new.csv', 21, now - 60), ('newer.csv', 22, now)]:
+        (ingest.watch / name).write_bytes(make_csv(make_packets(50, seed=seed), seed=seed)[0])
+        os.utime(ingest.watch / name, (mtime, mtime))
+    files = lambda: {os.path.basename(x) for x in packet_counts(ingest.db)}
+
+    assert ingest(lane='fresh', fresh_after=now - 3600, max_files=1) == 1
+    assert files() == {'newer.csv'}
+    # (Every file's data time is worked out once, and kept for the next run)
+    assert ingest.calls['file_data_time'] == 3
+    assert get_file_manifest(ingest.db)[str(ingest.watch / 'old.csv')]['status'] == 'pending'
+    assert ingest(lane='fresh', fresh_after=now - 3600) == 0
+    assert files() == {'newer.csv', 'new.csv'}
+    assert ingest.calls['file_data_time'] == 0
+    assert ingest(lane='backlog', fresh_after=now - 3600) == 0
+    assert files() == {'newer.csv', 'new.csv', 'old.csv'}
+
+def test_lane_cutoff(ingest):
+    ''' A lane without fresh_after is cut off fresh_hours ago, or refused if that isn't set either '''
+    now = time.time()
+    for name, seed, mtime in [('old.csv', 20, now - 86400*30), ('new.csv', 21, now - 60)]:
+        (ingest.watch / name).write_bytes(make_csv(make_packets(50, seed=seed), seed=seed)[0])
+        os.utime(ingest.watch / name, (mtime, mtime))
+
+    with pytest.raises(ValueError):
+        ingest(lane='fresh')
+    with pytest.raises(ValueError):
+        ingest(lane='newest', fresh_after=now)
+    assert not os.path.exists(ingest.db)
+
+    assert ingest(lane='fresh', fresh_hours=1) == 0
+    assert {os.path.basename(x) for x in packet_counts(ingest.db)} == {'new.csv'}
+    assert ingest(lane='backlog', fresh_hours=1) == 0
+    assert {os.path.basename(x) for x in packet_counts(ingest.db)} == {'new.csv', 'old.csv'}
@@ -0,0 +1,166 @@
+import sys
+import types
+import datetime
+import numpy as np
+import pytest
+
+import db_handlers
+import process_pipeline
+from process_pipeline import SharedPackets, run_stage
+from db_handlers import connect_packet_db, write_to_db
+from data_handlers import decode_packets_TLM
+from synthetic import make_packets, make_tlm
+
+UTC = datetime.timezone.utc
+
+
+def utc(ts):
+    return datetime.datetime.fromtimestamp(ts, tz=UTC)
+
+@pytest.fixture
+def packet_db(tmp_path):
+    '''
+    A database with some packets added long ago, and some just now (on the same day),
+    and some more added long ago, three days later. Returns its path, and the time
+    between the old and new packets being added.
+    '''
+    (tmp_path / 'a.TLM').write_bytes(make_tlm(make_packets(200, seed=5), seed=5)[0])
+    (tmp_path / 'b.TLM').write_bytes(make_tlm(make_packets(50, seed=6), seed=6)[0])
+    packets = list(decode_packets_TLM(tmp_path, 'a.TLM'))
+
+    db = str(tmp_path / 'packets.db')
+    conn = connect_packet_db(db)
+    write_to_db(conn, packets[:len(packets)//2])
+    conn.execute('UPDATE packets SET added = 1000')
+    write_to_db(conn, decode_packets_TLM(tmp_path, 'b.TLM'))
+    conn.execute('UPDATE packets SET added = 1000, header_timestamp = header_timestamp + 3*86400 WHERE added > 1000')
+    write_to_db(conn, packets[len(packets)//2:])
+    conn.commit()
+    conn.close()
+    return db, 2000
+
+def same(a, b):
+    assert len(a) == len(b)
+    for k in b.columns:
+        np.testing.assert_array_equal(a[k], b[k])
+    assert [bytes(np.asarray(x)) for x in a['data']] == [bytes(np.asarray(x)) for x in b['data']]
+
+@pytest.fixture
+def db_calls(monkeypatch):
+    ''' The keyword arguments of each query SharedPackets sends to the database '''
+    calls = []
+    def counted(*args, **kwargs):
+        calls.append(kwargs)
+        return db_handlers.get_packets_within_range(*args, **kwargs)
+    monkeypatch.setattr(process_pipeline, 'get_packets_within_range', counted)
+    return calls
+
+
+@pytest.mark.parametrize('max_bytes', [process_pipeline.SHARED_MAX_BYTES, 1000])
+def test_queries(packet_db, max_bytes):
+    ''' The shared packets answer queries as the database does (whether or not they've spilled) '''
+    db, since = packet_db
+    shared = SharedPackets(db, since, max_bytes=max_bytes)
+    assert shared.spilled == (max_bytes == 1000)
+    ts = db_handlers.get_packets_within_range(db, date_added=utc(since))['header_timestamp']
+    t_mid = (ts.min() + ts.max()) / 2
+
+    queries = [dict(), dict(date_added=utc(since)), dict(dtype='S'), dict(dtype='B', date_added=utc(since)),
+               dict(t1=utc(ts.min() - 1), t2=utc(t_mid)), dict(t1=utc(t_mid), t2=utc(ts.max() + 1), dtype='E'),
+               dict(t1=utc(ts.min() - 86400), t2=utc(ts.max())), dict(t1=utc(t_mid), t2=utc(ts.max() + 5*86400)),
+               dict(t1=utc(ts.min()), t2=utc(ts.max()))]
+    for q in queries:
+        same(shared.get_packets_within_range(**q), db_handlers.get_packets_within_range(db, **q))
+
+    assert shared.get_time_range_for_updated_packets(since) == \
+           db_handlers.get_time_range_for_updated_packets(db, since)
+    assert shared.get_time_range_for_updated_packets(0) == \
+           db_handlers.get_time_range_for_updated_packets(db, 0)
+
+def test_covered_range(packet_db, db_calls):
+    ''' A time range within the days held is served without going to the database, and the rest only reads the part outside '''
+    db, since = packet_db
+    shared = SharedPackets(db, since)
+    ts = db_handlers.get_packets_within_range(db, date_added=utc(since))['header_timestamp']
+    t1, t2 = utc(ts.min() - 60), utc(ts.max() + 60)
+
+    packets = shared.get_packets_within_range(t1=t1, t2=t2)
+    same(packets, db_handlers.get_packets_within_range(db, t1=t1, t2=t2))
+    assert len(packets) > len(ts)
+    assert db_calls == []
+
+    t2 = utc(ts.max() + 5*86400)
+    packets = shared.get_packets_within_range(t1=t1, t2=t2)
+    same(packets, db_handlers.get_packets_within_range(db, t1=t1, t2=t2))
+    (a, b), = shared.spans
+    assert len(db_calls) == 1
+    assert db_calls[0]['t1'].timestamp() >= b - 1 and db_calls[0]['t2'] == t2
+
+def test_spill(packet_db, db_calls):
+    ''' Past max_bytes, only headers are held: they answer empty ranges, and the rest goes to the database '''
+    db, since = packet_db
+    shared = SharedPackets(db, since, max_bytes=1000)
+    assert shared.spilled and shared.packets.payload.nbytes == 0
+    assert sorted(shared.packets.columns) == sorted(process_pipeline.SHARED_COLUMNS)
+    ts = db_handlers.get_packets_within_range(db, date_added=utc(since))['header_timestamp']
+
+    assert len(shared.get_packets_within_range(t1=utc(ts.max() + 60), t2=utc(ts.max() + 120))) == 0
+    assert db_calls == []
+    shared.get_packets_within_range(t1=utc(ts.min() - 60), t2=utc(ts.max() + 60))
+    assert len(db_calls) == 1
+
+    with pytest.raises(ValueError):
+        SharedPackets(db, since, max_packets=len(ts))
+
+def test_run_stage(monkeypatch):
+    ''' A stage which fails is logged, and doesn't stop the others '''
+    runs = []
+    def ok(**kwargs):
+        runs.append(('ok', kwargs))
+    def broken():
+        runs.append(('broken', {}))
+        raise RuntimeError('oops')
+    monkeypatch.setitem(sys.modules, 'fake_stages', types.SimpleNamespace(ok=ok, broken=broken))
+
+    run_stage('fake_stages', 'broken')
+    run_stage('fake_stages', 'ok', shared='x')
+    assert runs == [('broken', {}), ('ok', dict(shared='x'))]
+
+def test_run_tasks(packet_db, tmp_path, monkeypatch):
+    ''' Each day's tasks run in dependency order; unchanged days aren't run again, and failed ones are '''
+    db, since = packet_db
+    access_log = str(tmp_path / 'access.db')
+    runs = []
+    fail = set()
+    def stage(name):
+        def run(day, **kwargs):
+            runs.append((name, day.strftime('%Y-%m-%d')))
+            if name in fail:
+                raise RuntimeError('oops')
+        return run
+    monkeypatch.setitem(sys.modules, 'fake_stages', types.SimpleNamespace(a=stage('a'), b=stage('b')))
+    no_margin = (datetime.timedelta(0), datetime.timedelta(0))
+    stages = [dict(stage='fake_stages', func='a', kwargs=dict(), dtypes='SEBGI', margin=no_margin,
+                   depends_on=None, shared=False),
+              dict(stage='fake_b', func='b', kwargs=dict(), dtypes='SEBGI', margin=no_margin,
+                   depends_on='fake_stages', shared=False)]
+    monkeypatch.setitem(sys.modules, 'fake_b', sys.modules['fake_stages'])
+
+    ts = db_handlers.get_packets_within_range(db)['header_timestamp']
+    # (Newest day first)
+    days = sorted(set(utc(t).strftime('%Y-%m-%d') for t in ts), reverse=True)
+
+    fail.add('a')
+    completed, failed = process_pipeline.run_tasks(db, access_log, stages)
+    assert runs == [('a', d) for d in days]
+    assert not completed and len(failed) == 2*len(days)
+
+    fail.clear()
+    runs.clear()
+    completed, failed = process_pipeline.run_tasks(db, access_log, stages)
+    assert runs == [(x, d) for d in days for x in 'ab']
+    assert len(completed) == 2*len(days) and not failed
+
+    runs.clear()
+    process_pipeline.run_tasks(db, access_log, stages)
+    assert runs == []
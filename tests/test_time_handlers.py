@@ -0,0 +1,47 @@
+import datetime
+import numpy as np
+
+from time_handlers import GPS_EPOCH, GPS_to_timestamp, CCSDS_to_timestamp, GPS_week_to_timestamp
+from time_handlers import GPS_UTC_offset, ISO_to_timestamp, UTC_days
+
+UTC = datetime.timezone.utc
+
+
+def test_leap_seconds():
+    ''' GPS - UTC: 0 in 1980, 17 in 2016, 18 from 2017 on -- changing exactly at the leap second '''
+    def gps(t, offset):
+        return (t - GPS_EPOCH).total_seconds() + offset
+    t = datetime.datetime(2017, 1, 1, tzinfo=UTC)
+    assert GPS_UTC_offset(gps(t, 18)) == 18
+    assert GPS_UTC_offset(gps(t, 18) - 1) == 17
+    assert GPS_UTC_offset(0) == 0
+    assert GPS_UTC_offset(gps(datetime.datetime(2020, 6, 1, tzinfo=UTC), 18)) == 18
+
+def test_GPS_to_timestamp():
+    ''' The same as adding a timedelta (with the leap seconds) to the GPS epoch, for whole arrays '''
+    rng = np.random.default_rng(0)
+    sec = rng.integers(0, 1300000000, 1000)
+    ns = rng.integers(0, 10**9, 1000)
+    expected = [(GPS_EPOCH + datetime.timedelta(seconds=int(s) - int(GPS_UTC_offset(s)), microseconds=int(n)/1000)).timestamp()
+                for s, n in zip(sec, ns)]
+    np.testing.assert_allclose(CCSDS_to_timestamp(sec, ns), expected, rtol=0, atol=2e-6)
+    np.testing.assert_allclose(GPS_to_timestamp(sec, ns), expected, rtol=0, atol=2e-6)
+
+def test_GPS_week():
+    t = GPS_week_to_timestamp(2100, 3600.5)
+    assert t == GPS_to_timestamp(2100*7*86400 + 3600.5)
+    assert datetime.datetime.fromtimestamp(float(t), UTC) == \
+        datetime.datetime(2020, 4, 5, 1, 0, 0, 500000, tzinfo=UTC) - datetime.timedelta(seconds=18)
+
+def test_ISO_to_timestamp():
+    times = ['2020-06-12T01:02:03.456789Z', b'2020-06-12T01:02:03Z', 'not a time', '2020-13-01T00:00:00Z']
+    out = ISO_to_timestamp(times)
+    assert out[0] == datetime.datetime(2020, 6, 12, 1, 2, 3, 456789, tzinfo=UTC).timestamp()
+    assert out[1] == datetime.datetime(2020, 6, 12, 1, 2, 3, tzinfo=UTC).timestamp()
+    assert np.isnan(out[2:]).all()
+
+def test_UTC_days():
+    t = datetime.datetime(2020, 6, 1, 23, 59, tzinfo=UTC).timestamp()
+    days = UTC_days([t + 120, t, np.nan, t + 60])
+    assert days == [datetime.datetime(2020, 6, 1, tzinfo=UTC), datetime.datetime(2020, 6, 2, tzinfo=UTC)]
+    assert UTC_days([]) == []
@@ -0,0 +1,36 @@
+import pytest
+
+import watch_daemon
+from watch_daemon import scan_watch_directories, watch
+
+
+class Stop(Exception):
+    pass
+
+def test_scan(tmp_path):
+    (tmp_path / 'a').mkdir()
+    for name in ['a/x.tlm', 'y.csv', 'z.tlm.gz', 'pass.zip', 'notes.txt']:
+        (tmp_path / name).write_bytes(b'123')
+    snapshot = scan_watch_directories([str(tmp_path)])
+    assert sorted(snapshot) == sorted(str(tmp_path / x) for x in ['a/x.tlm', 'y.csv', 'z.tlm.gz', 'pass.zip'])
+    assert snapshot[str(tmp_path / 'y.csv')][0] == 3
+
+def test_watch(tmp_path, monkeypatch):
+    ''' The stages run once at startup, then once new files have settled for the debounce time '''
+    clock = [0]
+    events = {30: 'a.tlm', 50: 'b.tlm', 200: None}
+    def sleep(dt):
+        clock[0] += dt
+        if clock[0] in events:
+            if events[clock[0]] is None:
+                raise Stop
+            (tmp_path / events[clock[0]]).write_bytes(b'1')
+    monkeypatch.setattr(watch_daemon.time, 'sleep', sleep)
+    monkeypatch.setattr(watch_daemon.time, 'monotonic', lambda: clock[0])
+
+    runs = []
+    monkeypatch.setattr(watch_daemon, 'run_pipeline', lambda: runs.append(clock[0]))
+    with pytest.raises(Stop):
+        watch([str(tmp_path)], poll_interval=10, debounce=30)
+    # (b.tlm arrives before a.tlm has settled, so they're done together)
+    assert runs == [0, 80]
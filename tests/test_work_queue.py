@@ -0,0 +1,141 @@
+import sqlite3
+import datetime
+import threading
+import pytest
+
+from work_queue import connect_queue_db, claim_job, finish_job, retry_failed_jobs
+from work_queue import acquire_lock, release_lock, retry_locked
+from work_queue import PENDING, RUNNING, DONE, FAILED
+
+
+@pytest.fixture
+def queue(tmp_path):
+    ''' A queue with survey and quicklook jobs for two days (quicklooks wait for the survey) '''
+    queue_file = str(tmp_path / 'queue.db')
+    conn = connect_queue_db(queue_file)
+    now = datetime.datetime.now().timestamp()
+    for day in ['2020-06-01', '2020-06-02']:
+        conn.execute('''INSERT INTO jobs (stage, day, depends_on, version, status, attempts, max_attempts, enqueued)
+                        VALUES(?, ?, ?, 'v', ?, 0, 2, ?)''', ('survey', day, None, PENDING, now))
+        conn.execute('''INSERT INTO jobs (stage, day, depends_on, version, status, attempts, max_attempts, enqueued)
+                        VALUES(?, ?, ?, 'v', ?, 0, 2, ?)''', ('quicklook', day, 'survey', PENDING, now))
+    yield conn
+    conn.close()
+
+def status(conn, stage, day):
+    return conn.execute('SELECT status FROM jobs WHERE stage=? AND day=?', (stage, day)).fetchone()[0]
+
+
+def test_claim_order(queue):
+    ''' Newest day first, and the quicklooks only once the day's survey is done '''
+    a = claim_job(queue, 'a')
+    b = claim_job(queue, 'b')
+    assert [(a['stage'], a['day']), (b['stage'], b['day'])] == [('survey', '2020-06-02'), ('survey', '2020-06-01')]
+    assert a['attempts'] == 1 and status(queue, 'survey', '2020-06-02') == RUNNING
+    assert claim_job(queue, 'c') is None
+
+    assert finish_job(queue, b, 'b')
+    c = claim_job(queue, 'c')
+    assert (c['stage'], c['day']) == ('quicklook', '2020-06-01')
+    assert status(queue, 'survey', '2020-06-01') == DONE
+
+def test_retries(queue):
+    ''' A failed job is retried, up to max_attempts times '''
+    job = claim_job(queue, 'a')
+    assert finish_job(queue, job, 'a', error='oops')
+    assert status(queue, job['stage'], job['day']) == PENDING
+
+    job = claim_job(queue, 'a')
+    assert job['attempts'] == 2
+    assert finish_job(queue, job, 'a', error='oops')
+    assert status(queue, job['stage'], job['day']) == FAILED
+
+def test_lease_expiry(queue):
+    ''' A job whose lease has run out is taken over, and its first worker can't finish it '''
+    job = claim_job(queue, 'a', lease=-1)
+    taken = claim_job(queue, 'b')
+    assert (taken['stage'], taken['day'], taken['attempts']) == (job['stage'], job['day'], 2)
+    assert not finish_job(queue, job, 'a')
+    assert finish_job(queue, taken, 'b')
+
+    # On its last attempt, it fails instead
+    job = claim_job(queue, 'a')
+    queue.execute('UPDATE jobs SET attempts=2, lease_expires=0 WHERE stage=? AND day=?', (job['stage'], job['day']))
+    assert claim_job(queue, 'b')['day'] != job['day']
+    assert status(queue, job['stage'], job['day']) == FAILED
+
+def test_failed_dependency(queue):
+    ''' Jobs waiting on one which has failed for good fail too, and are queued again with it '''
+    for attempt in range(2):
+        job = claim_job(queue, 'a')
+        assert (job['stage'], job['day']) == ('survey', '2020-06-02')
+        assert finish_job(queue, job, 'a', error='oops')
+    assert status(queue, 'survey', '2020-06-02') == FAILED
+
+    # (The other day's jobs carry on)
+    job = claim_job(queue, 'a')
+    assert (job['stage'], job['day']) == ('survey', '2020-06-01')
+    assert status(queue, 'quicklook', '2020-06-02') == FAILED
+    assert queue.execute("SELECT error FROM jobs WHERE stage='quicklook' AND day='2020-06-02'").fetchone() == \
+           ('survey failed',)
+    assert finish_job(queue, job, 'a')
+    job = claim_job(queue, 'a')
+    assert (job['stage'], job['day']) == ('quicklook', '2020-06-01')
+    assert finish_job(queue, job, 'a')
+    assert claim_job(queue, 'a') is None
+
+    # Retrying queues the whole chain again
+    assert retry_failed_jobs(queue) == 2
+    job = claim_job(queue, 'a')
+    assert (job['stage'], job['day'], job['attempts']) == ('survey', '2020-06-02', 1)
+    assert finish_job(queue, job, 'a')
+    job = claim_job(queue, 'a')
+    assert (job['stage'], job['day']) == ('quicklook', '2020-06-02')
+
+def test_lock(tmp_path, queue):
+    ''' Only one worker holds a lock at a time, until it's released or its lease runs out '''
+    queue_file = str(tmp_path / 'queue.db')
+    acquire_lock(queue, 'finish survey', 'a')
+
+    def take():
+        conn = connect_queue_db(queue_file)
+        acquire_lock(conn, 'finish survey', 'b', poll_interval=0.05)
+        conn.close()
+    waiting = threading.Thread(target=take)
+    waiting.start()
+    waiting.join(0.5)
+    assert waiting.is_alive()
+    # (Other workers can still use the queue in the meantime)
+    assert claim_job(queue, 'c') is not None
+
+    release_lock(queue, 'finish survey', 'a')
+    waiting.join(5)
+    assert not waiting.is_alive()
+    assert queue.execute('SELECT worker FROM locks').fetchall() == [('b',)]
+
+    # An expired lock is taken over
+    queue.execute("UPDATE locks SET expires=0")
+    acquire_lock(queue, 'finish survey', 'a')
+    assert queue.execute('SELECT worker FROM locks').fetchall() == [('a',)]
+
+def test_retry_locked():
+    calls = []
+    def flaky(x):
+        calls.append(x)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError('database is locked')
+        return x*2
+    assert retry_locked(flaky, 4, backoff=0) == 8
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(sqlite3.OperationalError):
+        retry_locked(flaky, 4, retries=2, backoff=0)
+
+    def broken():
+        calls.append(None)
+        raise sqlite3.OperationalError('no such table: jobs')
+    calls.clear()
+    with pytest.raises(sqlite3.OperationalError):
+        retry_locked(broken, backoff=0)
+    assert len(calls) == 1
@@ -0,0 +1,94 @@
+import numpy as np
+import datetime
+
+# GPS time counts from 1980-01-06, and doesn't include leap seconds.
+GPS_EPOCH = datetime.datetime(1980,1,6,0,0, tzinfo=datetime.timezone.utc)
+SECONDS_PER_WEEK = 7*24*60*60
+
+# Leap second table: (UTC date the offset took effect, GPS - UTC in seconds).
+# Add a row here when IERS announces a new leap second.
+LEAP_SECONDS = [
+    (datetime.datetime(1981,7,1, tzinfo=datetime.timezone.utc), 1),
+    (datetime.datetime(1982,7,1, tzinfo=datetime.timezone.utc), 2),
+    (datetime.datetime(1983,7,1, tzinfo=datetime.timezone.utc), 3),
+    (datetime.datetime(1985,7,1, tzinfo=datetime.timezone.utc), 4),
+    (datetime.datetime(1988,1,1, tzinfo=datetime.timezone.utc), 5),
+    (datetime.datetime(1990,1,1, tzinfo=datetime.timezone.utc), 6),
+    (datetime.datetime(1991,1,1, tzinfo=datetime.timezone.utc), 7),
+    (datetime.datetime(1992,7,1, tzinfo=datetime.timezone.utc), 8),
+    (datetime.datetime(1993,7,1, tzinfo=datetime.timezone.utc), 9),
+    (datetime.datetime(1994,7,1, tzinfo=datetime.timezone.utc), 10),
+    (datetime.datetime(1996,1,1, tzinfo=datetime.timezone.utc), 11),
+    (datetime.datetime(1997,7,1, tzinfo=datetime.timezone.utc), 12),
+    (datetime.datetime(1999,1,1, tzinfo=datetime.timezone.utc), 13),
+    (datetime.datetime(2006,1,1, tzinfo=datetime.timezone.utc), 14),
+    (datetime.datetime(2009,1,1, tzinfo=datetime.timezone.utc), 15),
+    (datetime.datetime(2012,7,1, tzinfo=datetime.timezone.utc), 16),
+    (datetime.datetime(2015,7,1, tzinfo=datetime.timezone.utc), 17),
+    (datetime.datetime(2017,1,1, tzinfo=datetime.timezone.utc), 18),
+]
+
+_GPS_EPOCH_SEC = int(GPS_EPOCH.timestamp())
+# The GPS time (seconds since GPS_EPOCH) at which each leap second took effect
+_LEAP_GPS_SEC = np.array([int(d.timestamp()) - _GPS_EPOCH_SEC + n for d, n in LEAP_SECONDS])
+_LEAP_OFFSETS = np.array([0] + [n for d, n in LEAP_SECONDS])
+
+
+def GPS_UTC_offset(gps_sec):
+    ''' GPS - UTC (leap seconds) at GPS time gps_sec (seconds since GPS_EPOCH; scalar or array) '''
+    return _LEAP_OFFSETS[np.searchsorted(_LEAP_GPS_SEC, gps_sec, side='right')]
+
+def GPS_to_timestamp(gps_sec, ns=0):
+    '''
+    Converts GPS times (seconds since GPS_EPOCH, plus nanoseconds) to unix timestamps (UTC).
+    Works on whole arrays at once. Rounds to the microsecond, the same as adding
+    a datetime.timedelta.
+    '''
+    t = np.asarray(gps_sec, dtype=float) + np.asarray(ns)*1e-9
+    whole_sec = np.floor(t)
+    microseconds = (whole_sec - GPS_UTC_offset(whole_sec)).astype(np.int64)*1000000 + \
+                   np.round((t - whole_sec)*1e6).astype(np.int64)
+    return (_GPS_EPOCH_SEC*1000000 + microseconds)/1e6
+
+def CCSDS_to_timestamp(epoch_sec, ns):
+    '''
+    Converts CCSDS header times (GPS seconds + nanoseconds) to unix timestamps.
+    '''
+    return GPS_to_timestamp(epoch_sec, ns)
+
+def GPS_week_to_timestamp(weeknum, sec_offset):
+    '''
+    Converts GPS receiver times (week number + seconds into the week) to unix timestamps.
+    '''
+    return GPS_to_timestamp(np.asarray(weeknum, dtype=float)*SECONDS_PER_WEEK + np.asarray(sec_offset, dtype=float))
+
+def ISO_to_timestamp(times):
+    '''
+    Converts ISO-8601 UTC time strings (str or bytes, with a trailing "Z";
+    e.g., 2020-06-12T01:02:03.456789Z) to unix timestamps, to the microsecond.
+    Any which can't be parsed come back as NaN.
+    '''
+    times = [t[:-1] for t in times]
+    try:
+        t = np.array(times, dtype='datetime64[us]')
+    except ValueError:
+        # Fall back to one at a time, to find the bad ones
+        t = np.full(len(times), np.datetime64('NaT'), dtype='datetime64[us]')
+        for ind, x in enumerate(times):
+            try:
+                t[ind] = np.datetime64(x, 'us')
+            except ValueError:
+                pass
+
+    out = (t - np.datetime64(0, 'us')).astype(np.int64)/1e6
+    out[np.isnat(t)] = np.nan
+    return out
+
+def UTC_days(timestamps):
+    '''
+    The (sorted, unique) UTC days covered by an array of unix timestamps,
+    as timezone-aware datetimes at midnight.
+    '''
+    timestamps = np.asarray(timestamps, dtype=float)
+    days = np.unique(np.floor(timestamps[~np.isnan(timestamps)]/86400))
+    return [datetime.datetime.fromtimestamp(x*86400, tz=datetime.timezone.utc) for x in days]
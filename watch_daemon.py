@@ -0,0 +1,103 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+from configparser import ConfigParser
+
+from file_handlers import telemetry_type
+from process_pipeline import run_pipeline
+
+
+def scan_watch_directories(in_roots):
+    ''' The (size, mtime) of every telemetry file under the watch directories, as a dict by path '''
+    snapshot = dict()
+    for in_root in in_roots:
+        for root, dirs, files in os.walk(in_root):
+            for fname in files:
+                if telemetry_type(fname) is not None:
+                    fpath = os.path.join(root, fname)
+                    try:
+                        stat = os.stat(fpath)
+                    except OSError:
+                        # (Removed since the directory was listed)
+                        continue
+                    snapshot[fpath] = (stat.st_size, stat.st_mtime)
+    return snapshot
+
+def watch(in_roots, poll_interval=10, debounce=30):
+    '''
+    Polls the watch directories every poll_interval seconds. Once files have
+    appeared or changed, and then nothing has changed for debounce seconds
+    (so files still being copied in aren't picked up half-way), runs every
+    processing stage. Each stage only processes what's new since its last run.
+    While there's a backlog of older files left (see run_pipeline), keeps working
+    through it between polls -- new files still go first.
+    '''
+    logger = logging.getLogger('watch')
+
+    # Catch up on anything which arrived while we weren't running
+    last_seen = scan_watch_directories(in_roots)
+    logger.info(f'watching {len(last_seen)} files in {in_roots}')
+    backlog = run_pipeline()
+
+    changed_at = None
+    while True:
+        if not backlog or changed_at is not None:
+            time.sleep(poll_interval)
+        current = scan_watch_directories(in_roots)
+
+        if current != last_seen:
+            new_files = [x for x in current if current[x] != last_seen.get(x)]
+            logger.info(f'{len(new_files)} new or changed files; waiting for them to settle')
+            last_seen = current
+            changed_at = time.monotonic()
+
+        elif changed_at is not None and time.monotonic() - changed_at >= debounce:
+            logger.info('running processing stages')
+            backlog = run_pipeline()
+            changed_at = None
+
+        elif changed_at is None and backlog:
+            logger.info('working through the backlog')
+            backlog = run_pipeline()
+
+def main():
+    parser = argparse.ArgumentParser(description="VPM Ground Support Software: watch for new telemetry, and process it as it arrives")
+    parser.add_argument("--once", action='store_true', help="run each processing stage once, and exit (e.g., from cron)")
+    parser.add_argument("--poll_interval", required=False, type=float, default=None, help="seconds between scans of the watch directories (overrides GSS_settings.conf)")
+    parser.add_argument("--debounce", required=False, type=float, default=None, help="seconds without changes before processing new files (overrides GSS_settings.conf)")
+    args = parser.parse_args()
+
+    # -------- Load configuration file --------
+    config = ConfigParser()
+    fp = open('GSS_settings.conf')
+    config.read_file(fp)
+    fp.close()
+
+    # -------- Configure logger ---------
+    logfile = config['logging']['log_file']
+    logging.basicConfig(level=eval(f"logging.{config['logging']['log_level']}"),
+             filename = logfile,
+             format='[%(asctime)s]\t%(module)s.%(name)s\t%(levelname)s\t%(message)s',
+             datefmt='%Y-%m-%d %H:%M:%S')
+    logging.getLogger('matplotlib').setLevel(logging.WARNING)
+    np.seterr(divide='ignore')
+
+    if args.once:
+        # (Through the whole backlog, newest first)
+        while run_pipeline():
+            pass
+        return
+
+    in_roots = config['db_locations']['telemetry_watch_directory'].split(',')
+    poll_interval = args.poll_interval if args.poll_interval is not None else \
+                    config.getfloat('daemon_config', 'poll_interval', fallback=10)
+    debounce = args.debounce if args.debounce is not None else \
+               config.getfloat('daemon_config', 'debounce', fallback=30)
+
+    watch(in_roots, poll_interval=poll_interval, debounce=debounce)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+'''
+A queue of (stage, UTC day) processing jobs, in an SQLite file on a shared
+filesystem, for reprocessing the whole mission (or any span of it) on as
+many worker processes -- on one host or several -- as are available:
+
+    python work_queue.py enqueue --t1 2020-01-01 --t2 2020-06-30
+    python work_queue.py work --workers 4      (on each host)
+    python work_queue.py status
+
+Each worker claims one job at a time, holding a lease on it which it renews
+(its heartbeat) while the job runs. A job whose worker has died is picked up
+by another worker once its lease runs out. Failed jobs are retried, up to
+max_attempts times. Jobs which depend on another stage (the quicklooks for a
+day wait for its survey data) are only claimed once that job is done, and
+fail along with it if it fails for good ('retry' queues both again).
+
+(SQLite's locking relies on the filesystem's: this works on local disks and
+on most NFS/SMB mounts, but not on ones with broken or disabled locking.)
+'''
+import os
+import time
+import importlib
+import socket
+import datetime
+import logging
+import sqlite3
+import argparse
+import threading
+import traceback
+import numpy as np
+from configparser import ConfigParser
+from concurrent.futures import ProcessPoolExecutor
+
+from db_handlers import create_connection, create_table, connect_packet_db
+from db_handlers import get_packet_summary, get_task_records, set_task_record
+from process_pipeline import SUMMARY_BIN, task_stages, data_version, run_task
+
+
+# The states a job can be in
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+def connect_queue_db(queue_file, busy_timeout=60):
+    '''
+    Connect to the work queue database, and create the jobs table if it doesn't
+    already exist. Transactions are begun explicitly (see claim_job), and other
+    workers' locks are waited on for up to busy_timeout seconds.
+    '''
+    logger = logging.getLogger('connect_queue_db')
+
+    # One row per (stage, day). attempts counts the times it's been claimed;
+    # lease_expires is when another worker may take it over, if the one running
+    # it stops renewing the lease (heartbeat is when it last did).
+    sql_create_jobs_table = """ CREATE TABLE IF NOT EXISTS jobs (
+                                    stage TEXT,
+                                    day TEXT,
+                                    depends_on TEXT,
+                                    version TEXT,
+                                    status TEXT,
+                                    attempts INTEGER,
+                                    max_attempts INTEGER,
+                                    worker TEXT,
+                                    lease_expires REAL,
+                                    heartbeat REAL,
+                                    enqueued REAL,
+                                    started REAL,
+                                    finished REAL,
+                                    error TEXT,
+                                    PRIMARY KEY (stage, day)
+                                ); """
+
+    conn = create_connection(queue_file)
+    if conn is None:
+        logger.error("Error! cannot create the queue database connection.")
+        return None
+
+    # Named locks, for steps which only one worker may run at a time (see acquire_lock)
+    sql_create_locks_table = """ CREATE TABLE IF NOT EXISTS locks (
+                                    name TEXT PRIMARY KEY,
+                                    worker TEXT,
+                                    expires REAL
+                                ); """
+
+    conn.isolation_level = None
+    conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout*1000)}')
+    create_table(conn, sql_create_jobs_table)
+    create_table(conn, sql_create_locks_table)
+    return conn
+
+def retry_locked(func, *args, retries=5, backoff=1):
+    '''
+    func(*args), tried again (after backoff seconds, doubling each time) if the queue
+    database is still locked by another worker once the busy timeout runs out.
+    '''
+    for attempt in range(retries):
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or attempt == retries - 1:
+                raise
+            logging.getLogger('retry_locked').warning(f'queue database is locked; trying again in {backoff} seconds')
+            time.sleep(backoff)
+            backoff *= 2
+
+def enqueue_jobs(conn, packet_db, stages, t1=None, t2=None, force=False, max_attempts=3):
+    '''
+    Add a job for each stage (from process_pipeline.task_stages), and each UTC day
+    with packets for it between t1 and t2 (UTC datetimes; None for no limit).
+    Days which process_pipeline has already done on the current packet data are
+    skipped, unless force is set. Jobs already in the queue are reset to pending,
+    unless they're running. Returns the number of jobs queued.
+    '''
+    logger = logging.getLogger('enqueue_jobs')
+
+    summary = get_packet_summary(packet_db, SUMMARY_BIN)
+    records = get_task_records(packet_db) if not force else dict()
+    now = datetime.datetime.now().timestamp()
+
+    sql = '''INSERT INTO jobs (stage, day, depends_on, version, status, attempts, max_attempts, enqueued)
+             VALUES(?, ?, ?, ?, ?, 0, ?, ?)
+             ON CONFLICT (stage, day) DO UPDATE SET
+                depends_on=excluded.depends_on, version=excluded.version, status=excluded.status,
+                attempts=0, max_attempts=excluded.max_attempts, enqueued=excluded.enqueued,
+                worker=NULL, lease_expires=NULL, error=NULL
+             WHERE jobs.status != ?'''
+
+    rows = []
+    for st in stages:
+        days = sorted(set(ind*SUMMARY_BIN//86400 for dtype, ind in summary if dtype == st['dtypes'][0]))
+        queued = 0
+        for d in days:
+            day = datetime.datetime.fromtimestamp(d*86400, tz=datetime.timezone.utc)
+            if (t1 is not None and day < t1) or (t2 is not None and day > t2):
+                continue
+            day_str = day.strftime('%Y-%m-%d')
+            version, added = data_version(summary, st['dtypes'], day, st['margin'])
+            record = records.get((st['stage'], day_str))
+            if record is not None and record['status'] == 'completed' and record['version'] == version:
+                continue
+            rows.append((st['stage'], day_str, st['depends_on'], version, PENDING, max_attempts, now, RUNNING))
+            queued += 1
+        logger.info(f"{st['stage']}: {queued} of {len(days)} days queued")
+
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany(sql, rows)
+    conn.execute('COMMIT')
+    return len(rows)
+
+def claim_job(conn, worker, lease=600):
+    '''
+    Claim the next job for worker (newest day first), for lease seconds: a pending
+    job whose dependency (if any) is done, or a running job whose lease has run out.
+    Returns the job as a dict, or None if there's nothing to claim right now.
+    '''
+    now = datetime.datetime.now().timestamp()
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Jobs abandoned by their worker on the last attempt have failed for good
+        conn.execute('''UPDATE jobs SET status=?, error=?, finished=?
+                        WHERE status=? AND lease_expires < ? AND attempts >= max_attempts''',
+                     (FAILED, 'lease expired', now, RUNNING, now))
+
+        # ... and so have the jobs waiting on them (down the chain), which 'retry'
+        # queues again along with them
+        while conn.execute('''UPDATE jobs SET status=?, error=depends_on || ' failed', finished=?
+                              WHERE status=? AND EXISTS (SELECT 1 FROM jobs d WHERE d.stage=jobs.depends_on
+                                                         AND d.day=jobs.day AND d.status=?)''',
+                           (FAILED, now, PENDING, FAILED)).rowcount:
+            pass
+
+        cur = conn.execute('''SELECT * FROM jobs j
+                              WHERE (j.status=? OR (j.status=? AND j.lease_expires < ?))
+                              AND j.attempts < j.max_attempts
+                              AND NOT EXISTS (SELECT 1 FROM jobs d WHERE d.stage=j.depends_on
+                                              AND d.day=j.day AND d.status != ?)
+                              ORDER BY j.day DESC, j.rowid LIMIT 1''', (PENDING, RUNNING, now, DONE))
+        row = cur.fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+        job = dict(zip([x[0] for x in cur.description], row))
+
+        if job['status'] == RUNNING:
+            logging.getLogger('claim_job').warning(
+                f"taking over {job['stage']} for {job['day']} from {job['worker']} (lease expired)")
+        conn.execute('''UPDATE jobs SET status=?, attempts=attempts + 1, worker=?, lease_expires=?,
+                        heartbeat=?, started=? WHERE stage=? AND day=?''',
+                     (RUNNING, worker, now + lease, now, now, job['stage'], job['day']))
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+    job['attempts'] += 1
+    return job
+
+def finish_job(conn, job, worker, error=None):
+    '''
+    Record the outcome of a job claimed by worker: done, or (with an error message)
+    pending again for a retry -- or failed, once it's out of attempts. Returns False
+    if the job has been taken over by another worker in the meantime.
+    '''
+    now = datetime.datetime.now().timestamp()
+    if error is None:
+        status = DONE
+    else:
+        status = PENDING if job['attempts'] < job['max_attempts'] else FAILED
+
+    cur = conn.execute('''UPDATE jobs SET status=?, error=?, finished=?, lease_expires=NULL
+                          WHERE stage=? AND day=? AND worker=? AND status=?''',
+                       (status, error, now, job['stage'], job['day'], worker, RUNNING))
+    return cur.rowcount > 0
+
+def acquire_lock(conn, name, worker, lease=600, poll_interval=1):
+    '''
+    Take the named lock for worker, waiting until no other worker holds it (or the
+    lease of the one which does has run out). The queue itself isn't locked in the
+    meantime, so other workers carry on claiming and finishing jobs.
+    '''
+    while True:
+        now = datetime.datetime.now().timestamp()
+        cur = conn.execute('''INSERT INTO locks (name, worker, expires) VALUES(?, ?, ?)
+                              ON CONFLICT (name) DO UPDATE SET worker=excluded.worker, expires=excluded.expires
+                              WHERE locks.expires < ?''', (name, worker, now + lease, now))
+        if cur.rowcount > 0:
+            return
+        time.sleep(poll_interval)
+
+def release_lock(conn, name, worker):
+    ''' Release a lock taken by acquire_lock '''
+    conn.execute('DELETE FROM locks WHERE name=? AND worker=?', (name, worker))
+
+class Heartbeat(threading.Thread):
+    '''
+    Renews a job's lease every lease/3 seconds, on a thread of its own (with its
+    own connection to the queue), for as long as the job runs.
+    '''
+
+    def __init__(self, queue_file, job, worker, lease=600):
+        super().__init__(daemon=True)
+        self.queue_file = queue_file
+        self.job = job
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def run(self):
+        logger = logging.getLogger('Heartbeat')
+        conn = connect_queue_db(self.queue_file)
+        while not self.stopped.wait(self.lease/3):
+            now = datetime.datetime.now().timestamp()
+            try:
+                cur = conn.execute('''UPDATE jobs SET heartbeat=?, lease_expires=?
+                                      WHERE stage=? AND day=? AND worker=? AND status=?''',
+                                   (now, now + self.lease, self.job['stage'], self.job['day'], self.worker, RUNNING))
+                if cur.rowcount == 0:
+                    logger.warning(f"lost the lease on {self.job['stage']} for {self.job['day']}")
+                    break
+            except:
+                logger.exception('failed to renew lease')
+        conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def run_worker(queue_file, worker=None, lease=600, poll_interval=10, wait=False):
+    '''
+    Claim and run jobs from the queue, one at a time, until there are none left
+    (or, with wait set, forever -- polling every poll_interval seconds). Each stage
+    is run with this host's settings from GSS_settings.conf, reading its packets
+    from the database. Returns the number of jobs completed.
+    '''
+    logger = logging.getLogger('run_worker')
+
+    config = ConfigParser()
+    fp = open('GSS_settings.conf')
+    config.read_file(fp)
+    fp.close()
+
+    packet_db = config['db_locations']['packet_db_file']
+    stages = {st['stage']: st for st in task_stages(config)}
+    if worker is None:
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    conn = connect_queue_db(queue_file)
+    done = 0
+    while True:
+        job = retry_locked(claim_job, conn, worker, lease)
+        if job is None:
+            # Nothing we can claim: once no other jobs are running, there's nothing
+            # left to wait for
+            cur = conn.execute('SELECT COUNT(*) FROM jobs WHERE status=?', (RUNNING,))
+            if not wait and cur.fetchone()[0] == 0:
+                break
+            # (Waiting on other workers' jobs, or for new ones)
+            time.sleep(poll_interval)
+            continue
+
+        st = stages[job['stage']]
+        day = datetime.datetime.strptime(job['day'], '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+        logger.info(f"{worker}: running {job['stage']} for {job['day']} (attempt {job['attempts']})")
+
+        heartbeat = Heartbeat(queue_file, job, worker, lease)
+        heartbeat.start()
+        t0 = time.time()
+        error = None
+        try:
+            result = run_task(job['stage'], st['func'], day, st['kwargs'], False)
+            if 'finish' in st and result:
+                # (The finishing step merges into files shared by every day, so
+                # only one worker runs it at a time)
+                func, kwargs = st['finish']
+                retry_locked(acquire_lock, conn, f"finish {job['stage']}", worker, lease)
+                try:
+                    getattr(importlib.import_module(job['stage']), func)(result, **kwargs)
+                finally:
+                    retry_locked(release_lock, conn, f"finish {job['stage']}", worker)
+        except:
+            logger.exception(f"{job['stage']} failed for {job['day']}")
+            error = traceback.format_exc(limit=1).strip().splitlines()[-1]
+        finally:
+            heartbeat.stop()
+
+        if not retry_locked(finish_job, conn, job, worker, error):
+            logger.warning(f"{job['stage']} for {job['day']} was taken over by another worker")
+        elif error is None:
+            done += 1
+            logger.info(f"{job['stage']} done for {job['day']} in {time.time() - t0:.1f} seconds")
+            # (So process_pipeline doesn't run the day again)
+            packet_conn = connect_packet_db(packet_db)
+            set_task_record(packet_conn, job['stage'], job['day'], job['version'], 'completed',
+                            datetime.datetime.now().timestamp())
+            packet_conn.close()
+
+    conn.close()
+    logger.info(f'{worker}: {done} jobs completed')
+    return done
+
+def retry_failed_jobs(conn):
+    '''
+    Queue every failed job again, with its attempts reset -- including the jobs which
+    failed because a job they were waiting on did. Returns the number of jobs queued.
+    '''
+    cur = conn.execute('UPDATE jobs SET status=?, attempts=0, error=NULL WHERE status=?', (PENDING, FAILED))
+    return cur.rowcount
+
+def queue_status(conn):
+    ''' The number of jobs in each state, for each stage, as a dict of stage: dict(status: count) '''
+    status = dict()
+    for stage, state, count in conn.execute('SELECT stage, status, COUNT(*) FROM jobs GROUP BY 1, 2'):
+        status.setdefault(stage, dict())[state] = count
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description="VPM Ground Support Software: a queue of processing jobs, for (re)processing many days on several workers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('enqueue', help="queue a job for each stage and UTC day with packets")
+    p.add_argument("--t1", required=False, type=str, default=None, help="first day to queue. YYYY-MM-DD")
+    p.add_argument("--t2", required=False, type=str, default=None, help="last day to queue. YYYY-MM-DD")
+    p.add_argument("--stages", required=False, type=str, default=None, help="comma-separated list of stages to queue (default: all)")
+    p.add_argument("--force", action='store_true', help="queue days which have already been processed on the current data")
+
+    p = subparsers.add_parser('work', help="claim and run jobs, until there are none left")
+    p.add_argument("--workers", required=False, type=int, default=1, help="number of worker processes to run on this host (0 for one per CPU core)")
+    p.add_argument("--wait", action='store_true', help="keep waiting for new jobs, rather than exiting once the queue is empty")
+
+    subparsers.add_parser('status', help="show the number of jobs in each state")
+    subparsers.add_parser('retry', help="queue failed jobs (and the jobs waiting on them) again")
+    args = parser.parse_args()
+
+    # -------- Load configuration file --------
+    config = ConfigParser()
+    fp = open('GSS_settings.conf')
+    config.read_file(fp)
+    fp.close()
+
+    # -------- Configure logger ---------
+    logfile = config['logging']['log_file']
+    logging.basicConfig(level=eval(f"logging.{config['logging']['log_level']}"),
+             filename = logfile,
+             format='[%(asctime)s]\t%(module)s.%(name)s\t%(levelname)s\t%(message)s',
+             datefmt='%Y-%m-%d %H:%M:%S')
+    logging.getLogger('matplotlib').setLevel(logging.WARNING)
+    np.seterr(divide='ignore')
+
+    # -------- Load some settings -------
+    queue_file = config['queue_config']['queue_file'].strip()
+    lease = config.getfloat('queue_config', 'lease_seconds', fallback=600)
+    max_attempts = config.getint('queue_config', 'max_attempts', fallback=3)
+    poll_interval = config.getfloat('queue_config', 'poll_interval', fallback=10)
+
+    conn = connect_queue_db(queue_file)
+
+    if args.command == 'enqueue':
+        stages = task_stages(config)
+        if args.stages:
+            names = [x.strip() for x in args.stages.split(',')]
+            stages = [st for st in stages if st['stage'] in names]
+        t1 = datetime.datetime.strptime(args.t1, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc) if args.t1 else None
+        t2 = datetime.datetime.strptime(args.t2, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc) if args.t2 else None
+        n = enqueue_jobs(conn, config['db_locations']['packet_db_file'], stages, t1, t2,
+                         force=args.force, max_attempts=max_attempts)
+        print(f'{n} jobs queued')
+
+    elif args.command == 'work':
+        conn.close()
+        workers = args.workers if args.workers > 0 else os.cpu_count()
+        if workers == 1:
+            run_worker(queue_file, lease=lease, poll_interval=poll_interval, wait=args.wait)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(run_worker, queue_file, lease=lease, poll_interval=poll_interval,
+                                       wait=args.wait) for i in range(workers)]
+                print(f'{sum(f.result() for f in futures)} jobs completed')
+        return
+
+    elif args.command == 'retry':
+        print(f'{retry_failed_jobs(conn)} failed jobs queued again')
+
+    elif args.command == 'status':
+        for stage, counts in queue_status(conn).items():
+            print(f"{stage}: " + ', '.join(f'{counts[s]} {s}' for s in [PENDING, RUNNING, DONE, FAILED] if s in counts))
+        for stage, day, attempts, error in conn.execute(
+                'SELECT stage, day, attempts, error FROM jobs WHERE status=? ORDER BY day', (FAILED,)):
+            print(f'  failed: {stage} {day} after {attempts} attempts: {error}')
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()